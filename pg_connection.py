@@ -79,15 +79,17 @@ class pg_connection:
     else:
       return psycopg2.connect(dsn)
 
-  def close(self, conn):
+  def close(self, conn, discard = False):
     """
     Close the connection
+    conn    : connection returned by connect()
+    discard : True if the connection is broken, and not to be reused by pooling
     """
     if conn is None:
       raise ValueError
 
     if self._connect_info['pooling'] > 0:
-      self._conn_pool.putconn(conn)
+      self._conn_pool.putconn(conn, close = discard)
     else:
       conn.close()
 
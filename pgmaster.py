@@ -25,12 +25,18 @@ import datetime, time
 import fcntl
 import configparser
 import traceback
+import re
 import html
+import hashlib
+import threading
+import collections
+from psycopg2 import sql
 from git import *
 from flask import *
 
 from pg_connection import pg_connection
 import pgmaster_utils
+import pgmaster_cache
 import webapi_v1
 
 def create_app():
@@ -61,6 +67,36 @@ def create_app():
   # Register pg_connection instance to WebAPI (and others) via app.config
   app.config['PG_CONNECTION'] = pg_conn
 
+  # Seconds to wait while the repository is locked by update_master.py
+  app.config['LOCK_TIMEOUT'] = config_ini.getfloat('WEB', 'LockTimeout', fallback = 10.0)
+
+  # On-disk cache of diffs shared by workers (None if disabled)
+  diff_cache_dir = config_ini.get('WEB', 'DiffCacheDir', fallback = None)
+  app.config['DIFF_CACHE'] = pgmaster_cache.diff_cache(
+    diff_cache_dir,
+    max_size = config_ini.getint('WEB', 'DiffCacheSize', fallback = 1024) * 1024 * 1024
+  ) if diff_cache_dir else None
+
+  # Commits changing more files or lines than these load each patch on demand.
+  app.config['LAZY_DIFF_FILES'] = config_ini.getint('WEB', 'LazyDiffFiles', fallback = 50)
+  app.config['LAZY_DIFF_LINES'] = config_ini.getint('WEB', 'LazyDiffLines', fallback = 5000)
+  # Maximum bytes of the patch of each file loaded on demand
+  app.config['MAX_PATCH_SIZE'] = config_ini.getint('WEB', 'MaxPatchSize', fallback = 1024 * 1024)
+
+  # Salt of ETag, to be changed when this application is upgraded.
+  salt = hashlib.sha1()
+  template_dir = os.path.join(app.root_path, app.template_folder)
+  # Responses (e.g. patches) are also made by other modules.
+  sources = [os.path.abspath(m.__file__) for m in (sys.modules[__name__], pgmaster_utils, webapi_v1)]
+  for path in sources + [os.path.join(template_dir, f) for f in sorted(os.listdir(template_dir))]:
+    salt.update((u'%s:%d\n' % (path, os.stat(path).st_mtime_ns)).encode('utf-8'))
+  app.config['ETAG_SALT'] = salt.hexdigest()
+
+  # Register opened git repositories to WebAPI (and others) via app.config
+  app.config['GIT_REPOSITORIES'] = pgmaster_utils.git_repositories(
+    max_commits = config_ini.getint('WEB', 'MaxCachedCommits', fallback = 1024)
+  )
+
   # Register WebAPI v1
   app.register_blueprint(webapi_v1.api, url_prefix=u'/api/v1')
 
@@ -68,6 +104,201 @@ def create_app():
 
 app = create_app()
 
+# Index of object ids for each project, to calculate short commit ids.
+abbrev_cache = {}
+abbrev_cache_lock = threading.Lock()
+
+def get_abbrev(project):
+  """
+  get_abbrev() - Get pgmaster_utils.git_abbrev instance of project
+    project : project name
+  """
+  with abbrev_cache_lock:
+    abbrev = abbrev_cache.get(project)
+    if abbrev is None:
+      abbrev = pgmaster_utils.git_abbrev(u'git/' + project + u'.git')
+      abbrev_cache[project] = abbrev
+    return abbrev
+
+# Patterns to create links in commit messages.
+# Only the first matched pattern is applied to each line,
+# and commit ids are linked only in lines not matched to any of them.
+message_link_patterns = [
+  (  # for Web link (http(s)://...)
+    re.compile(r"https?://[\w!?/+\-_~=;.,*&@#$%()'[\]]+"),
+    u"<a href=\"%s\" target=\"_blank\">%s</a>"
+  ),
+  (  # for CVE (link to MITRE)
+    re.compile(r"CVE-[0-9]{4}-[0-9]+"),
+    u"<a href=\"https://cve.mitre.org/cgi-bin/cvename.cgi?name=%s\" target=\"_blank\">%s</a>"
+  )
+]
+ptrn_commitid = re.compile(r"[0-9a-fA-F]{6,40}")
+ptrn_commitid_before = re.compile(r'[ ({<"\'[]')  # Charactors allowed BEFORE commit id
+ptrn_commitid_after = re.compile(r'[ )}>"\'\].,!:;]')  # Charactors allowed AFTER commit id
+
+# Rendered commit messages for each commit.
+html_message_cache = collections.OrderedDict()
+html_message_cache_lock = threading.Lock()
+HTML_MESSAGE_CACHE_SIZE = 1024
+
+def is_commitid_token(x) -> bool:
+  """
+  is_commitid_token() - Check if the part matched to ptrn_commitid looks like a commit id
+    x : re.Match instance
+  """
+  return (
+    (  # Check the charactor BEFORE matched part.
+      (x.start(0) == 0) or ptrn_commitid_before.match(x.string[x.start(0) - 1])
+    ) and ( # Check the charactor AFTER matched part.
+      (x.end(0) == len(x.string)) or ptrn_commitid_after.match(x.string[x.end(0)])
+    )
+  )
+
+def resolve_commitids(cursor, project: str, branch: str, tokens) -> dict:
+  """
+  resolve_commitids() - Get URLs of commits by (a part of) commit ids at once
+    cursor  : psycopg2.extensions.cursor instance of databse
+    project : project name
+    branch  : branch name preferred if the commit is on it
+    tokens  : set of (a part of) commit ids in lowercase
+  Returns dict of token and URL. Tokens not matched to any commits are not included.
+  """
+  if len(tokens) <= 0:
+    return {}
+
+  # "commitid LIKE ..." with pattern of each token can't use index,
+  # so range of commitid is specified by operators of "text_pattern_ops" (see _branch_commitid_prefix_idx).
+  # LATERAL makes it index lookup for each token.
+  cursor.execute(u"""SELECT
+      t.token,
+      x.count,
+      x.commitid,
+      x.branch
+    FROM
+      unnest(%s::text[]) AS t(token)
+      CROSS JOIN LATERAL (
+        SELECT
+          count(DISTINCT b.commitid) AS count,
+          min(b.commitid) AS commitid,
+          (array_agg(b.branch ORDER BY b.branch = %s DESC, b.branch))[1] AS branch
+        FROM
+          _branch b
+        WHERE
+          b.project = %s AND
+          b.commitid ~>=~ t.token AND b.commitid ~<~ (t.token || 'g')
+      ) AS x
+    WHERE
+      x.count > 0""",
+    [sorted(tokens), branch, project]
+  )
+
+  urls = {}
+  for (token, count, commitid, commit_branch) in cursor.fetchall():
+    if count == 1:
+      urls[token] = url_for('investigate', project = project, branch = commit_branch, commitid = commitid)
+    else:
+      # Ambiguous. Let user select one of them.
+      urls[token] = url_for('search_commit', project = project, commitid = token)
+  return urls
+
+def resolve_short_commitids(cursor, project: str, branch: str, commitids) -> dict:
+  """
+  resolve_short_commitids() - Get short commit ids and branches of commits at once
+    cursor    : psycopg2.extensions.cursor instance of databse
+    project   : project name
+    branch    : branch name preferred if the commit is on it
+    commitids : list of (full) commit ids
+  Returns dict of commit id and tuple (short commit id, branch name).
+  Short commit ids of commits not ingested are calculated from git repository,
+  and the branch of them is the specified one.
+  """
+  result = {}
+  if len(commitids) <= 0:
+    return result
+
+  cursor.execute(u"""SELECT
+      b.commitid,
+      min(b.scommitid),
+      (array_agg(b.branch ORDER BY b.branch = %s DESC, b.branch))[1]
+    FROM
+      _branch b
+    WHERE
+      b.project = %s AND b.commitid = ANY(%s)
+    GROUP BY
+      b.commitid""",
+    [branch, project, list(commitids)]
+  )
+  for (commit_id, s_commit_id, commit_branch) in cursor.fetchall():
+    result[commit_id] = (s_commit_id, commit_branch)
+
+  missing = [commit_id for commit_id in commitids if commit_id not in result]
+  if len(missing) > 0:
+    s_commit_ids = get_abbrev(project).abbrev(missing)
+    for commit_id in missing:
+      result[commit_id] = (s_commit_ids[commit_id], branch)
+  return result
+
+def make_html_message(cursor, project: str, branch: str, message: str) -> str:
+  """
+  make_html_message() - Make HTML of commit message with links
+    cursor  : psycopg2.extensions.cursor instance of databse
+    project : project name
+    branch  : branch name
+    message : commit message
+  Commit ids in the message are linked only if they are found in the project.
+  """
+  # Split lines (and chop CR and LF)
+  lines = html.escape(message).splitlines()
+  commitid_lines = []
+  tokens = set()
+  # Create links
+  for (n, line) in enumerate(lines):
+    for (pattern, replace) in message_link_patterns:
+      if pattern.search(line):
+        lines[n] = pattern.sub(lambda x : replace % (x.group(0), x.group(0)), line)
+        break
+    else:
+      # Collect commit ids to be checked at once.
+      found = [x.group(0).lower() for x in ptrn_commitid.finditer(line) if is_commitid_token(x)]
+      if len(found) > 0:
+        commitid_lines.append(n)
+        tokens.update(found)
+
+  urls = resolve_commitids(cursor, project, branch, tokens)
+  for n in commitid_lines:
+    lines[n] = ptrn_commitid.sub(
+      lambda x : (
+        u"<a href=\"%s\" target=\"_blank\">%s</a>" % (urls[x.group(0).lower()], x.group(0))
+      ) if is_commitid_token(x) and x.group(0).lower() in urls else x.group(0),
+      lines[n]
+    )
+
+  return u'<br>\n'.join(lines)
+
+def get_html_message(cursor, project: str, branch: str, commit, version) -> str:
+  """
+  get_html_message() - Get HTML of commit message (see make_html_message()), memoized for each commit
+    cursor  : psycopg2.extensions.cursor instance of databse
+    project : project name
+    branch  : branch name
+    commit  : git.Commit instance
+    version : version of ingested commits (links are changed when other commits are ingested)
+  """
+  key = (project, branch, commit.hexsha, version)
+  with html_message_cache_lock:
+    result = html_message_cache.get(key)
+    if result is not None:
+      html_message_cache.move_to_end(key)
+      return result
+
+  result = make_html_message(cursor, project, branch, commit.message)
+  with html_message_cache_lock:
+    html_message_cache[key] = result
+    while len(html_message_cache) > HTML_MESSAGE_CACHE_SIZE:
+      html_message_cache.popitem(last = False)
+  return result
+
 @app.route('/')
 def root():
   """
@@ -117,9 +348,12 @@ def project(project):
   try:
     with conn.cursor() as cursor:
       cursor.execute(u"""SELECT
-        branch
+        r.branch,
+        s.commits,
+        s.newest
       FROM
-        repository_info
+        repository_info r
+        LEFT JOIN branch_stats s USING (project, branch)
       WHERE
         project = %s
       ORDER BY
@@ -131,10 +365,12 @@ def project(project):
       if len(rows) <= 0:
         raise FileNotFoundError
 
-      for (b,) in rows:
+      for (b, commits, newest) in rows:
         b_info = {
-          'name' : b,
-          'url'  : url_for(
+          'name'    : b,
+          'commits' : commits if commits is not None else 0,
+          'newest'  : newest.strftime(u'%Y-%m-%d') if newest is not None else None,
+          'url'     : url_for(
             'branch',
             project=project,
             branch=b
@@ -170,95 +406,160 @@ def validate_page_number(request_args, page = 1, num = 20):
   
   return (page, num)
 
+def validate_cursor(request_args):
+  """
+  validate_cursor() - Get cursor of keyset pagination
+  after  : list commits older than this cursor
+  before : list commits newer than this cursor
+  Cursor is "<commitdate (seconds since epoch)>_<short commit id>" of the commit at the edge of the page.
+  Returns tuple (True if "after", commitdate, short commit id), or None if not specified.
+  """
+  for (key, after) in (('after', True), ('before', False)):
+    value = request_args.get(key)
+    if value is None:
+      continue
+    (date, sep, scommitid) = value.partition(u'_')
+    if sep == u'' or len(scommitid) < 6 or 40 < len(scommitid):
+      raise ValueError
+    int(scommitid, 16)  # Check if it is hex
+    return (after, int(date), scommitid)
+
+  return None
+
+def make_cursor(commit_date: int, scommitid: str) -> str:
+  """
+  make_cursor() - Make cursor of keyset pagination (see validate_cursor())
+  commit_date : commitdate (seconds since epoch)
+  scommitid   : short commit id
+  """
+  return u'%d_%s' % (commit_date, scommitid)
+
 @app.route('/p/<project>/b/<path:branch>/')
 def branch(project, branch):
   """
   branch() - Generate page for /p/<project>/b/<branch>/
     project : project name
     branch  : branch name
+  Commits are listed by "after" or "before" cursor (keyset pagination),
+  or by "page" number (compatible with older URLs).
   """
   page = None
   num = None
+  cursor_key = None
 
   try:
     (page, num) = validate_page_number(request.args)
+    cursor_key = validate_cursor(request.args)
   except ValueError as e:
     abort(403)
   except Exception as e:
     abort(500, traceback.format_exc())
 
-  if request.args.get('page') is None or request.args.get('num') is None:
+  if cursor_key is not None:
+    page = None
+  elif request.args.get('page') is None or request.args.get('num') is None:
     return redirect(
       url_for('branch', project = project, branch = branch, page = page, num = num)
     )
 
   commits = []
-  max_page = 0
-  fd = None
+  max_page = None
+  has_newer = False
+  has_older = False
   conn = pg_conn.connect()
 
   try:
-    # Connect to git repository
-    fd = open(u'git/.lock.' + project, 'r')
-    fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)  # LOCK!
-    repo = Repo(u'git/' + project + u'.git')
-
-    if not repo.bare:
-      raise FileNotFoundError
-
-    # Calcurate max number of page.
-    with conn.cursor() as cursor:
-      cursor.execute(u"""SELECT
-        count(*)
-      FROM
-        _branch
-      WHERE
-        project = %s AND branch = %s
-      """,
-      [project, branch])
-
-      rows = cursor.fetchall()
-      if len(rows) <= 0:
-        raise FileNotFoundError
-
-      # This returns only 1 row with 1 column.
-      rows_count = rows[0][0]
-      if rows_count <= 0:
-        raise FileNotFoundError
-      max_page = rows_count // num + (0 if rows_count % num == 0 else 1)
+    # Commits are listed only from the database, without any git access (and lock).
+    if page is not None:
+      # Calcurate max number of page.
+      # Number of commits is maintained by update_master.py.
+      with conn.cursor() as cursor:
+        cursor.execute(u"""SELECT
+          commits
+        FROM
+          branch_stats
+        WHERE
+          project = %s AND branch = %s
+        """,
+        [project, branch])
+
+        rows = cursor.fetchall()
+        if len(rows) <= 0:
+          raise FileNotFoundError
+
+        # This returns only 1 row with 1 column.
+        rows_count = rows[0][0]
+        if rows_count <= 0:
+          raise FileNotFoundError
+        max_page = rows_count // num + (0 if rows_count % num == 0 else 1)
+
+    # Commits are ordered by (commitdate DESC, scommitid) with index "_branch_keyset_idx".
+    # One more row is read to know whether there are more commits.
+    if cursor_key is None:
+      condition = sql.SQL(u"")
+      order = sql.SQL(u"b.commitdate DESC, b.scommitid")
+      params = [project, branch, (page - 1) * num, num + 1]
+    elif cursor_key[0]:
+      # Older than the cursor.
+      # "commitdate <= ..." is used for index scan, and the rest is checked only for same commitdate.
+      condition = sql.SQL(u"""AND
+        b.commitdate <= to_timestamp(%s) AND
+        (b.commitdate < to_timestamp(%s) OR b.scommitid > %s)""")
+      order = sql.SQL(u"b.commitdate DESC, b.scommitid")
+      params = [project, branch, cursor_key[1], cursor_key[1], cursor_key[2], 0, num + 1]
+    else:
+      # Newer than the cursor, read backward and reversed later.
+      condition = sql.SQL(u"""AND
+        b.commitdate >= to_timestamp(%s) AND
+        (b.commitdate > to_timestamp(%s) OR b.scommitid < %s)""")
+      order = sql.SQL(u"b.commitdate, b.scommitid DESC")
+      params = [project, branch, cursor_key[1], cursor_key[1], cursor_key[2], 0, num + 1]
 
     with conn.cursor() as cursor:
-      cursor.execute(u"""SELECT
+      cursor.execute(sql.SQL(u"""SELECT
         b.commitid,
         b.scommitid,
         b.commitdate_l,
         b.timezone_int,
-        i.updatetime
+        i.updatetime,
+        ci.summary,
+        ci.author,
+        extract(epoch FROM b.commitdate)::bigint
       FROM
         _branch b
-        LEFT JOIN _investigation i USING (project, branch, commitid)
+        JOIN _commitinfo ci ON (b.project = ci.project AND b.commitid = ci.commitid)
+        LEFT JOIN _investigation i ON (b.project = i.project AND b.branch = i.branch AND b.commitid = i.commitid)
       WHERE
-        project = %s AND branch = %s
+        b.project = %s AND b.branch = %s {condition}
       ORDER BY
-        commitdate DESC, scommitid
+        {order}
       OFFSET %s
-      LIMIT %s""",
-      [project, branch, (page - 1) * num, num])
+      LIMIT %s""").format(condition = condition, order = order),
+      params)
 
       rows = cursor.fetchall()
       if len(rows) <= 0:
         raise FileNotFoundError
-      
+
+      has_more = len(rows) > num
+      rows = rows[:num]
+      if cursor_key is None:
+        (has_newer, has_older) = (page > 1, has_more)
+      elif cursor_key[0]:
+        (has_newer, has_older) = (True, has_more)
+      else:
+        rows.reverse()
+        (has_newer, has_older) = (has_more, True)
+
       for c in rows:
-        commit = repo.commit(c[0])
         c_info = {
           'id'      : c[0],
           'sid'     : c[1],
           'date'    : c[2],
           'tz'      : c[3],
           'updated' : c[4],
-          'summary' : html.escape(pgmaster_utils.json_escape(commit.summary)),
-          'author'  : html.escape(commit.author.name),
+          'summary' : html.escape(pgmaster_utils.json_escape(c[5])),
+          'author'  : html.escape(c[6]),
           'url'     : url_for(
             'investigate',
             project = project,
@@ -270,19 +571,9 @@ def branch(project, branch):
 
   except FileNotFoundError as e:
     abort(404)
-  except OSError as e:
-    # Can't aquire lock
-    if e.errno == errno.EACCES or e.errno == errno.EAGAIN:
-      abort(503)
-    else:
-      abort(500, traceback.format_exc())
   except Exception as e:
     abort(500, traceback.format_exc())
   finally:
-    if fd is not None:
-      fcntl.flock(fd, fcntl.LOCK_UN)  # UNLOCK!
-      fd.close()
-      fd = None
     pg_conn.close(conn)
 
   urls = {
@@ -290,6 +581,12 @@ def branch(project, branch):
     'num'  : num,
     'max_page' : max_page,
     'baseURL' : url_for('branch', project = project, branch = branch),
+    'newer' : url_for(
+      'branch', project = project, branch = branch, num = num, before = make_cursor(rows[0][7], rows[0][1])
+    ) if has_newer and len(rows) > 0 else None,
+    'older' : url_for(
+      'branch', project = project, branch = branch, num = num, after = make_cursor(rows[-1][7], rows[-1][1])
+    ) if has_older and len(rows) > 0 else None
   }
 
   return render_template(
@@ -309,105 +606,18 @@ def investigate(project, branch, commitid):
     commitid: commitid
   """
 
-  def make_patch(src, dst):
-    diffs = []
-    for d in src.diff(dst, create_patch = True):
-      a_path = 'a/%s' % d.a_rawpath.decode('utf-8') if d.a_rawpath is not None else '/dev/null'
-      b_path = 'b/%s' % d.b_rawpath.decode('utf-8') if d.b_rawpath is not None else '/dev/null'
-
-      # Sanitize diff
-      # This part will be inserted as Template string (ES6).
-      code_diff = pgmaster_utils.json_escape(d.diff.decode('utf-8'))
-
-      # Real LF are not accepted in JSON string.
-      # We use Template string (ES6) instead.
-      patch_str = (
-        u'--- %s\n'
-        u'+++ %s\n'
-        u'\n'
-        u'%s'
-      ) % (
-        a_path,
-        b_path,
-        code_diff
-      )
-
-      diffs.append(patch_str)
-
-    return diffs
-  # end of nested (internal) function
-  
-  def make_html_message(message):
-    import re
-    regex_patterns = [
-      {  # for Web link (http(s)://...)
-        'pattern' : re.compile(r"https?://[\w!?/+\-_~=;.,*&@#$%()'[\]]+"),
-        'replace' : u"<a href=\"%s\" target=\"_blank\">%s</a>"
-      },
-      {  # for CVE (link to MITRE)
-        'pattern' : re.compile(r"CVE-[0-9]{4}-[0-9]+"),
-        'replace' : u"<a href=\"https://cve.mitre.org/cgi-bin/cvename.cgi?name=%s\" target=\"_blank\">%s</a>"
-      }
-    ]
-    ptrn_commitid = re.compile(r"[0-9a-fA-F]{6,40}")
-
-    lines = []
-    # Split lines (and chop CR and LF)
-    msg_lines = html.escape(message).splitlines()
-    # Create links
-    for line in msg_lines:
-      for ptrn in regex_patterns:
-        if ptrn['pattern'].search(line):
-          line = re.sub(
-            ptrn['pattern'],
-            lambda x : ptrn['replace'] % (x.group(0), x.group(0)),
-            line
-          )
-          break
-        else:
-          pass
-      else:
-        if ptrn_commitid.search(line):
-          line = re.sub(
-            ptrn_commitid,
-            lambda x : (
-              u"<a href=\"%s\" target=\"_blank\">%s</a>" % (
-                url_for('search_commit', project = project, commitid = x.group(0)),
-                x.group(0)
-              ) if ( # Recheck if this part is a valid commit ID.
-                (    # Check the charactor BEFORE matched part.
-                  (x.start(0) == 0) or (
-                    (x.start(0) > 0) and re.match(r'[ ({<"\'[]', x.string[x.start(0) - 1])
-                  )
-                ) and ( # Check the charactor AFTER matched part.
-                  (x.end(0) == len(x.string)) or (
-                    (x.end(0) < len(x.string)) and re.match(r'[ )}>"\'\].,!:;]', x.string[x.end(0)])
-                  )
-                )
-              ) else x.group(0)
-            ), # end of lambda x
-            line
-          ) # end of re.sub
-
-      lines.append(line)
-
-    result = u'<br>\n'.join(lines)
-    return result
-  # end of nested (internal) function
-
-  def get_short_commitid(repo, commitid_list):
-    git_cmd = repo.git
-
+  def get_short_commitid(commitid_list, found):
     if commitid_list is None:
       return None
 
     result = []
     for commit_id in commitid_list:
-      s_commit_id = git_cmd.rev_parse(commit_id, short=7)
+      (s_commit_id, commit_branch) = found[commit_id]
       result.extend([
         {
-          'id'  : commit_id,
-          'sid' : s_commit_id
+          'id'     : commit_id,
+          'sid'    : s_commit_id,
+          'branch' : commit_branch
         }
       ])
 
@@ -417,42 +627,20 @@ def investigate(project, branch, commitid):
   urls = {
     'repo_browser' : None,
     'parents'      : None,
-    'children'     : None
+    'children'     : None,
+    'backpatches'  : None
   }
 
   fd = None
+  handle = None
+  etag = None
   conn = pg_conn.connect()
 
   try:
-    # Connect to git repository
-    fd = open(u'git/.lock.' + project, 'r')
-    fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)  # LOCK!
-    repo = Repo(u'git/' + project + u'.git')
-
-    if not repo.bare:
-      raise FileNotFoundError
-
-    # Get commit information
+    # Get commit information (and everything else in database) at once
     with conn.cursor() as cursor:
-      cursor.execute(u"""SELECT
-          b.scommitid,
-          b.commitdate_l,
-          b.timezone_int,
-          i.updatetime,
-          i.snote,
-          i.note,
-          i.analysis,
-          i.keywords
-        FROM
-          _branch b
-          LEFT JOIN _investigation i USING (project, branch, commitid)
-        WHERE
-          project = %s AND branch = %s AND commitid = %s""",
-        [project, branch, commitid]
-      )
-
-      c = cursor.fetchone()
-      if c is None:
+      detail = pgmaster_utils.get_commit_detail(cursor, project, branch, commitid)
+      if detail is None:
         # Fallback to project-wide search.
         return redirect(
           url_for(
@@ -461,72 +649,81 @@ def investigate(project, branch, commitid):
             commitid = commitid
           )
         )
-
-      commit = repo.commit(commitid)
-      urls['parents']  = get_short_commitid(repo, pgmaster_utils.git_ancestor(commit))
-      urls['children'] = get_short_commitid(repo, pgmaster_utils.git_children(cursor, project, commitid))
-      if len(commit.parents) > 0:
-        p_commit = commit.parents[0]
-        initial_commit = False
-      else:
-        # This is the magic ID of "empty tree". (not commit id)
-        # See https://stackoverflow.com/questions/40883798/how-to-get-git-diff-of-the-first-commit
-        p_commit = repo.tree('4b825dc642cb6eb9a060e54bf8d69288fbee4904')
-        initial_commit = True
+      investigation = detail['investigation'] or {}
+
+      # Except for the investigation of this commit, children (updatetime of _commitinfo),
+      # keywords of this project, URL of repository browser, links to other commits (lastingested)
+      # and back-patched commits (their group may be changed without ingesting any commits),
+      # this page is determined by commit id. So check it before reading the repository.
+      etag = hashlib.sha1(repr((
+        app.config['ETAG_SALT'], project, branch, commitid,
+        investigation.get('updatetime'), detail['updatetime'], detail['keywords'],
+        detail['repo_browse_url'], detail['lastingested'], detail['backpatches'],
+        app.config['LAZY_DIFF_FILES'], app.config['LAZY_DIFF_LINES']
+      )).encode('utf-8')).hexdigest()
+      if request.if_none_match.contains(etag):
+        response = Response(status = 304)
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = u'no-cache'
+        return response
+
+      # Connect to git repository
+      fd = open(u'git/.lock.' + project, 'r')
+      pgmaster_utils.lock_shared(fd, app.config['LOCK_TIMEOUT'])  # LOCK!
+      handle = app.config['GIT_REPOSITORIES'].acquire(project)
+
+      # Parents are read from the repository to keep order of them,
+      # but they are usually resolved above already.
+      commit = handle.commit(commitid)
+      parents = pgmaster_utils.git_ancestor(commit)
+      children = detail['children'] if len(detail['children']) > 0 else None
+      found = dict(detail['related'])
+      missing = [x for x in (parents or []) + (children or []) if x not in found]
+      if len(missing) > 0:
+        found.update(resolve_short_commitids(cursor, project, branch, missing))
+      urls['parents']  = get_short_commitid(parents, found)
+      urls['children'] = get_short_commitid(children, found)
+      urls['backpatches'] = [
+        {
+          'id'     : x[0],
+          'sid'    : x[1],
+          'branch' : x[2]
+        } for x in detail['backpatches']
+      ]
+
+      # Huge commit is not rendered at once.
+      # Only the list of files is shown, and each patch is loaded on demand by WebAPI.
+      # Diffs are cached by commit id, because commits are immutable.
+      (files, diffs) = pgmaster_utils.load_diffs(commit, app.config['DIFF_CACHE'], lambda files: (
+        len(files) > app.config['LAZY_DIFF_FILES'] or
+        sum([(f['added'] or 0) + (f['deleted'] or 0) for f in files]) > app.config['LAZY_DIFF_LINES']
+      ))
+      lazy = diffs is None
+      if lazy:
+        diffs = []
       c_info = {
         'id'         : commitid,
-        'sid'        : c[0],
-        'date'       : c[1],
-        'tz'         : c[2],
-        'updated'    : c[3],
+        'sid'        : detail['sid'],
+        'date'       : detail['date'],
+        'tz'         : detail['tz'],
+        'updated'    : investigation.get('updatetime'),
         'summary'    : html.escape(commit.summary),
-        'message'    : make_html_message(commit.message),
+        'message'    : get_html_message(cursor, project, branch, commit, detail['lastingested']),
         'author'     : html.escape(commit.author.name + ' <' + commit.author.email + '>'),
-        'diffs'      : make_patch(p_commit, commit),
-        'initial'    : initial_commit,
-        'snote'      : pgmaster_utils.json_escape(c[4]) if c[4] is not None else u'',
-        'note'       : pgmaster_utils.json_escape(c[5]) if c[5] is not None else u'',
-        'analysis'   : pgmaster_utils.json_escape(c[6]) if c[6] is not None else u'',
-        'keywords'   : c[7] if c[7] is not None else []
+        'diffs'      : diffs,
+        'files'      : files,
+        'lazy'       : lazy,
+        'initial'    : len(commit.parents) <= 0,
+        'snote'      : pgmaster_utils.json_escape(investigation['snote']) if investigation.get('snote') is not None else u'',
+        'note'       : pgmaster_utils.json_escape(investigation['note']) if investigation.get('note') is not None else u'',
+        'analysis'   : pgmaster_utils.json_escape(investigation['analysis']) if investigation.get('analysis') is not None else u'',
+        'keywords'   : investigation.get('keywords', [])
       }
+      if detail['repo_browse_url'] is not None:
+        urls['repo_browser'] = detail['repo_browse_url'].replace(u'%%COMMITID%%', commitid, 1)
+      keywords = detail['keywords']
     # End of "with conn.cursor()"
 
-    # Get keywords
-    # TODO: Commonalize logic between here and WebAPI.
-    keywords = []
-    with conn.cursor() as cursor:
-      cursor.execute(u"""SELECT
-          array_agg(DISTINCT k)
-        FROM (
-          SELECT
-            UNNEST(keywords) AS k
-          FROM
-            _investigation i
-          WHERE
-            project = %s AND keywords IS NOT NULL
-          ORDER BY
-            k
-        ) AS t""",
-        [project]
-      )
-
-      c = cursor.fetchone()
-      keywords.extend(c[0] if c[0] is not None else [])
-
-    # Get Git Repository Browser URL
-    with conn.cursor() as cursor:
-      cursor.execute(u"""SELECT
-          repo_browse_url
-        FROM
-          project_info
-        WHERE
-          project = %s""",
-        [project]
-      )
-
-      c = cursor.fetchone()
-      urls['repo_browser'] = c[0].replace(u'%%COMMITID%%', commitid, 1) if c[0] is not None else None
-
   except FileNotFoundError as e:
     abort(404)
   except OSError as e:
@@ -538,20 +735,27 @@ def investigate(project, branch, commitid):
   except Exception as e:
     abort(500, traceback.format_exc())
   finally:
+    if handle is not None:
+      app.config['GIT_REPOSITORIES'].release(project)
+      handle = None
     if fd is not None:
       fcntl.flock(fd, fcntl.LOCK_UN)  # UNLOCK!
       fd.close()
       fd = None
     pg_conn.close(conn)
 
-  return render_template(
+  # Caches must revalidate by ETag, because the investigation may be modified.
+  response = make_response(render_template(
     'investigate.html.jinja2',
     project = project,
     branch = branch,
     commit = c_info,
     keywords = keywords,
     urls = urls
-  )
+  ))
+  response.set_etag(etag)
+  response.headers['Cache-Control'] = u'no-cache'
+  return response
 
 @app.route('/p/<project>/c/<commitid>/')
 def search_commit(project, commitid):
@@ -561,9 +765,11 @@ def search_commit(project, commitid):
     commitid : a part of commit id search for
   """
   # Check if specified commit id is valid.
-  if len(commitid) < 6 or 40 < len(commitid):
+  # (Wildcards of LIKE must not be passed to prefix search.)
+  if ptrn_commitid.fullmatch(commitid) is None:
     # Return "Not found"
     abort(404)
+  commitid = commitid.lower()
 
   page = None
   num = None
@@ -578,18 +784,10 @@ def search_commit(project, commitid):
   urls = None
 
   commits = []
-  fd = None
   conn = pg_conn.connect()
 
   try:
-    # Connect to git repository
-    fd = open(u'git/.lock.' + project, 'r')
-    fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)  # LOCK!
-    repo = Repo(u'git/' + project + u'.git')
-
-    if not repo.bare:
-      raise FileNotFoundError
-
+    # Commits are listed only from the database, without any git access (and lock).
     with conn.cursor() as cursor:
       search_commitid = commitid if len(commitid) == 40 else u'%s%%' % (commitid)
       query_string = u"""SELECT
@@ -598,15 +796,18 @@ def search_commit(project, commitid):
         b.commitdate_l,
         b.timezone_int,
         i.updatetime,
-        b.branch
+        b.branch,
+        ci.summary,
+        ci.author
       FROM
         _branch b
-        LEFT JOIN _investigation i USING (project, branch, commitid)
+        JOIN _commitinfo ci ON (b.project = ci.project AND b.commitid = ci.commitid)
+        LEFT JOIN _investigation i ON (b.project = i.project AND b.branch = i.branch AND b.commitid = i.commitid)
       WHERE
-        project = %s AND """
-      query_string += u"commitid = %s " if len(commitid) == 40 else u"commitid like %s "
+        b.project = %s AND """
+      query_string += u"b.commitid = %s " if len(commitid) == 40 else u"b.commitid like %s "
       query_string += u"""ORDER BY
-        commitdate DESC, scommitid
+        b.commitdate DESC, b.scommitid
       OFFSET %s
       LIMIT %s"""
       cursor.execute(query_string,
@@ -629,7 +830,6 @@ def search_commit(project, commitid):
         )
       
       for c in rows:
-        commit = repo.commit(c[0])
         c_info = {
           'id'      : c[0],
           'sid'     : c[1],
@@ -637,8 +837,8 @@ def search_commit(project, commitid):
           'tz'      : c[3],
           'updated' : c[4],
           'branch'  : c[5],
-          'summary' : html.escape(commit.summary),
-          'author'  : html.escape(commit.author.name),
+          'summary' : html.escape(c[6]),
+          'author'  : html.escape(c[7]),
           'url'     : url_for(
             'investigate',
             project = project,
@@ -650,19 +850,9 @@ def search_commit(project, commitid):
 
   except FileNotFoundError as e:
     abort(404)
-  except OSError as e:
-    # Can't aquire lock
-    if e.errno == errno.EACCES or e.errno == errno.EAGAIN:
-      abort(503)
-    else:
-      abort(500, traceback.format_exc())
   except Exception as e:
     abort(500, traceback.format_exc())
   finally:
-    if fd is not None:
-      fcntl.flock(fd, fcntl.LOCK_UN)  # UNLOCK!
-      fd.close()
-      fd = None
     pg_conn.close(conn)
 
   return render_template(
@@ -703,18 +893,10 @@ def search_backpatch(project, branch, commitid):
     'id'  : commitid,
     'sid' : None
   }
-  fd = None
   conn = pg_conn.connect()
 
   try:
-    # Connect to git repository
-    fd = open(u'git/.lock.' + project, 'r')
-    fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)  # LOCK!
-    repo = Repo(u'git/' + project + u'.git')
-
-    if not repo.bare:
-      raise FileNotFoundError
-
+    # Commits are listed only from the database, without any git access (and lock).
     with conn.cursor() as cursor:
       cursor.execute(u"""SELECT
           a.commitid,
@@ -722,25 +904,17 @@ def search_backpatch(project, branch, commitid):
           a.commitdate_l,
           a.timezone_int,
           i.updatetime,
-          a.branch
+          a.branch,
+          c2.summary,
+          c2.author
         FROM
-          _commitinfo c1 JOIN _commitinfo c2
-              ON (c1.project = c2.project AND c1.author = c2.author AND c1.commitlog = c2.commitlog)
+          _commitinfo c1
+          JOIN _commitinfo c2 ON (c1.project = c2.project AND c1.bpgroup = c2.bpgroup)
           JOIN _branch a ON (c2.project = a.project AND c2.commitid = a.commitid)
           LEFT JOIN _investigation i ON (a.project = i.project AND a.branch = i.branch AND a.commitid = i.commitid)
         WHERE
           c1.project = %s AND
           c1.commitid = %s
-        GROUP BY
-          a.commitid,
-          a.scommitid,
-          a.commitdate,
-          a.commitdate_l,
-          a.timezone_int,
-          i.updatetime,
-          a.branch
-        HAVING
-          a.commitdate BETWEEN min(a.commitdate) AND min(a.commitdate + interval '1 day')
         ORDER BY
           a.commitdate DESC, a.branch
         OFFSET %s
@@ -753,7 +927,6 @@ def search_backpatch(project, branch, commitid):
         raise FileNotFoundError
 
       for c in rows:
-        commit = repo.commit(c[0])
         c_info = {
           'id'      : c[0],
           'sid'     : c[1],
@@ -761,8 +934,8 @@ def search_backpatch(project, branch, commitid):
           'tz'      : c[3],
           'updated' : c[4],
           'branch'  : c[5],
-          'summary' : html.escape(commit.summary),
-          'author'  : html.escape(commit.author.name),
+          'summary' : html.escape(c[6]),
+          'author'  : html.escape(c[7]),
           'url'     : url_for(
             'investigate',
             project = project,
@@ -776,19 +949,9 @@ def search_backpatch(project, branch, commitid):
 
   except FileNotFoundError as e:
     abort(404)
-  except OSError as e:
-    # Can't aquire lock
-    if e.errno == errno.EACCES or e.errno == errno.EAGAIN:
-      abort(503)
-    else:
-      abort(500, traceback.format_exc())
   except Exception as e:
     abort(500, traceback.format_exc())
   finally:
-    if fd is not None:
-      fcntl.flock(fd, fcntl.LOCK_UN)  # UNLOCK!
-      fd.close()
-      fd = None
     pg_conn.close(conn)
 
   return render_template(
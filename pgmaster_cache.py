@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2020-2026 Kondo Taiki
+#
+# This file is part of "pgmaster2".
+#
+# "pgmaster2" is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# "pgmaster2" is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with "pgmaster2".  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import re
+import json
+import time
+import threading
+
+from pgmaster_metrics import write_atomic
+
+# Format version of cached values.
+# Change this when the format of pgmaster_utils.load_diffs() is changed,
+# then old files are simply ignored (and evicted).
+CACHE_VERSION = u'v2'
+
+# Key must be a full object id (SHA-1 or SHA-256), not to be used as a path.
+_key_pattern = re.compile(r'[0-9a-f]{40}|[0-9a-f]{64}')
+
+class diff_cache:
+  """
+  diff_cache - On-disk cache of rendered diffs, keyed by commit id.
+  Commits are immutable, so cached values are never invalidated,
+  but evicted in LRU order (by modification time) when total size exceeds the limit.
+  Files are replaced atomically, so this can be shared by processes
+  (workers of uWSGI and update_master.py).
+  This is thread-safe.
+  """
+  def __init__(self, directory: str, max_size: int, check_interval: float = 60.0):
+    """
+    diff_cache() - Initialize cache
+      directory      : directory to store cached files (created if not exists)
+      max_size       : maximum total bytes of cached files
+      check_interval : minimum seconds between checking total size
+    """
+    self._directory = os.path.join(directory, CACHE_VERSION)
+    self._max_size = max_size
+    self._check_interval = check_interval
+    self._checked = 0.0
+    self._written = 0  # Bytes written since the last check
+    self._evicting = False  # True while evicting in background
+    self._lock = threading.Lock()
+    os.makedirs(self._directory, exist_ok = True)
+    return
+
+  def _path(self, key: str) -> str:
+    if _key_pattern.fullmatch(key) is None:
+      raise ValueError(key)
+    # Split into subdirectories, not to make a huge directory.
+    return os.path.join(self._directory, key[:2], key[2:] + u'.json')
+
+  def get(self, key: str):
+    """
+    get() - Get cached value
+      key : commit id
+    Returns None if not cached.
+    """
+    path = self._path(key)
+    try:
+      with open(path, 'r', encoding = 'utf-8') as f:
+        value = json.load(f)
+    except (FileNotFoundError, ValueError):
+      # Not cached (or evicted while reading)
+      return None
+
+    try:
+      # Mark as recently used.
+      os.utime(path)
+    except OSError:
+      pass
+    return value
+
+  def contains(self, key: str) -> bool:
+    """
+    contains() - Check if the value is cached
+      key : commit id
+    """
+    return os.path.exists(self._path(key))
+
+  def put(self, key: str, value) -> bool:
+    """
+    put() - Store value to cache
+      key   : commit id
+      value : value serializable to JSON
+    Returns False if failed to write (e.g. disk full), but not raised
+    because caching is not necessary.
+    Total size is checked in background (see evict()), not to delay the caller.
+    """
+    path = self._path(key)
+    text = json.dumps(value, ensure_ascii = False)
+    try:
+      os.makedirs(os.path.dirname(path), exist_ok = True)
+      write_atomic(path, text)
+    except OSError:
+      return False
+
+    with self._lock:
+      self._written += len(text.encode('utf-8'))
+      now = time.monotonic()
+      if self._evicting:
+        return True
+      if now - self._checked < self._check_interval and self._written < self._max_size // 10:
+        return True
+      self._checked = now
+      self._written = 0
+      self._evicting = True
+    threading.Thread(target = self._evict_background, daemon = True).start()
+    return True
+
+  def _evict_background(self):
+    try:
+      self.evict()
+    except OSError:
+      # Tried again at the next check.
+      pass
+    finally:
+      with self._lock:
+        self._evicting = False
+
+  def evict(self) -> int:
+    """
+    evict() - Remove least recently used files until total size is under the limit
+    Returns number of removed files.
+    """
+    files = []
+    total = 0
+    for (root, dirs, names) in os.walk(self._directory):
+      for name in names:
+        if name.startswith(u'.'):
+          # Temporary file being written
+          continue
+        path = os.path.join(root, name)
+        try:
+          st = os.stat(path)
+        except FileNotFoundError:
+          continue
+        files.append((st.st_mtime, st.st_size, path))
+        total += st.st_size
+
+    if total <= self._max_size:
+      return 0
+
+    # Remove down to 90% of the limit, not to check again soon.
+    removed = 0
+    files.sort()
+    for (mtime, size, path) in files:
+      if total <= self._max_size * 9 // 10:
+        break
+      try:
+        os.unlink(path)
+        removed += 1
+      except FileNotFoundError:
+        # Already removed by another process.
+        pass
+      total -= size
+    return removed
@@ -0,0 +1,350 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2020-2026 Kondo Taiki
+#
+# This file is part of "pgmaster2".
+#
+# "pgmaster2" is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# "pgmaster2" is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with "pgmaster2".  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import json
+import time
+import datetime
+import tempfile
+import threading
+import contextlib
+
+# Order of log levels
+LOG_LEVELS = ['LOG', 'INFO', 'WARNING', 'ERROR']
+
+def write_atomic(path: str, text: str):
+  """
+  write_atomic() - Write a file atomically, not to be read while writing
+    path : path to the file
+    text : content of the file
+  """
+  directory = os.path.dirname(os.path.abspath(path))
+  (fd, temp_path) = tempfile.mkstemp(dir = directory, prefix = u'.' + os.path.basename(path) + u'.')
+  try:
+    with os.fdopen(fd, 'w', encoding = 'utf-8') as f:
+      f.write(text)
+    os.chmod(temp_path, 0o644)
+    os.replace(temp_path, path)
+  except Exception:
+    os.unlink(temp_path)
+    raise
+
+class progress_log:
+  """
+  progress_log - Leveled logging, with rate-limited progress messages.
+  This is thread-safe.
+  """
+  def __init__(self, level: str = 'LOG', interval: float = 10.0):
+    """
+    progress_log() - Initialize logging
+      level    : minimum level to print (one of LOG_LEVELS)
+      interval : minimum seconds between progress messages of the same key
+    """
+    if level not in LOG_LEVELS:
+      raise ValueError(level)
+    self._level = LOG_LEVELS.index(level)
+    self._interval = interval
+    self._last = {}
+    self._lock = threading.Lock()
+    return
+
+  def enabled(self, level: str) -> bool:
+    """
+    enabled() - Check if the level is printed
+      level : log level
+    """
+    return LOG_LEVELS.index(level) >= self._level
+
+  def log(self, level: str, num: int, message: str):
+    """
+    log() - Print a message if the level is enabled
+      level   : log level
+      num     : number of the project (0 for whole of the run)
+      message : message to print
+    """
+    if self.enabled(level):
+      print(u"%s[%d] <%s>: %s" % (level, num, datetime.datetime.now().strftime(u'%H:%M:%S'), message))
+
+  def progress(self, key, num: int, message: str, level: str = 'LOG', force: bool = False) -> bool:
+    """
+    progress() - Print a progress message at most once in the interval for each key
+      key     : key of the progress (e.g. tuple of project and branch)
+      num     : number of the project
+      message : message to print
+      level   : log level
+      force   : print regardless of the interval (e.g. at the end of progress)
+    Returns True if printed.
+    """
+    now = time.monotonic()
+    with self._lock:
+      last = self._last.get(key)
+      if not force and last is not None and now - last < self._interval:
+        return False
+      if force:
+        self._last.pop(key, None)
+      else:
+        self._last[key] = now
+    self.log(level, num, message)
+    return True
+
+class run_metrics:
+  """
+  run_metrics - Timings and throughput of an update run.
+  Each value is recorded for each project, and for each branch or remote of it.
+  This is thread-safe.
+  """
+  def __init__(self):
+    self._projects = {}
+    self._lock = threading.Lock()
+    self.started = time.time()
+    self.finished = None
+    return
+
+  def _project(self, project: str) -> dict:
+    # Caller must hold the lock.
+    return self._projects.setdefault(project, {
+      'succeeded' : None,
+      'phases'    : {},
+      'branches'  : {},
+      'remotes'   : {}
+    })
+
+  def _branch(self, project: str, branch: str) -> dict:
+    # Caller must hold the lock.
+    return self._project(project)['branches'].setdefault(branch, {
+      'succeeded' : None,
+      'phases'    : {},
+      'commits'   : 0,
+      'rows'      : {},
+      'elapsed'   : None
+    })
+
+  def reset_project(self, project: str):
+    """
+    reset_project() - Clear values of the project, to record them again
+      project : project name
+    """
+    with self._lock:
+      self._projects.pop(project, None)
+
+  def add_time(self, project: str, phase: str, seconds: float, branch: str = None):
+    """
+    add_time() - Add time spent in the phase
+      project : project name
+      phase   : name of the phase (e.g. "fetch", "walk", "insert")
+      seconds : seconds to add
+      branch  : branch name (None for the phase of whole project)
+    """
+    with self._lock:
+      if branch is None:
+        phases = self._project(project)['phases']
+      else:
+        phases = self._branch(project, branch)['phases']
+      phases[phase] = phases.get(phase, 0.0) + seconds
+
+  @contextlib.contextmanager
+  def timer(self, project: str, phase: str, branch: str = None):
+    """
+    timer() - Measure time spent in "with" block as the phase (see add_time())
+    """
+    start = time.monotonic()
+    try:
+      yield
+    finally:
+      self.add_time(project, phase, time.monotonic() - start, branch)
+
+  def add_commits(self, project: str, branch: str, commits: int):
+    """
+    add_commits() - Add number of commits processed
+      project : project name
+      branch  : branch name
+      commits : number of commits to add
+    """
+    with self._lock:
+      self._branch(project, branch)['commits'] += commits
+
+  def add_rows(self, project: str, branch: str, table: str, rows: int):
+    """
+    add_rows() - Add number of rows written
+      project : project name
+      branch  : branch name
+      table   : name of the table (or "children" for updated parents)
+      rows    : number of rows to add
+    """
+    with self._lock:
+      counts = self._branch(project, branch)['rows']
+      counts[table] = counts.get(table, 0) + rows
+
+  def get_branch(self, project: str, branch: str) -> dict:
+    """
+    get_branch() - Get a copy of values of the branch
+      project : project name
+      branch  : branch name
+    """
+    with self._lock:
+      b = self._branch(project, branch)
+      return {
+        'commits' : b['commits'],
+        'rows'    : dict(b['rows'])
+      }
+
+  def set_branch(self, project: str, branch: str, succeeded: bool, elapsed: float = None):
+    """
+    set_branch() - Record the result of the branch
+      project   : project name
+      branch    : branch name
+      succeeded : True if succeeded
+      elapsed   : wall-clock seconds from reading the first commit to the end of loading
+    """
+    with self._lock:
+      b = self._branch(project, branch)
+      b['succeeded'] = succeeded
+      b['elapsed'] = elapsed
+
+  def set_project(self, project: str, succeeded: bool):
+    """
+    set_project() - Record the result of the project
+      project   : project name
+      succeeded : True if succeeded
+    """
+    with self._lock:
+      self._project(project)['succeeded'] = succeeded
+
+  def set_remote(self, project: str, remote: str, succeeded: bool, attempts: int, seconds: float):
+    """
+    set_remote() - Record the result of pushing to the mirror
+      project   : project name
+      remote    : remote name
+      succeeded : True if succeeded
+      attempts  : number of attempts
+      seconds   : total seconds of pushing
+    """
+    with self._lock:
+      self._project(project)['remotes'][remote] = {
+        'succeeded' : succeeded,
+        'attempts'  : attempts,
+        'seconds'   : seconds
+      }
+
+  def finish(self):
+    """
+    finish() - Mark the end of the run
+    """
+    self.finished = time.time()
+
+  def report(self) -> dict:
+    """
+    report() - Make the run report as dict (serializable to JSON)
+    """
+    finished = self.finished if self.finished is not None else time.time()
+    duration = finished - self.started
+    with self._lock:
+      projects = json.loads(json.dumps(self._projects))
+
+    total_commits = 0
+    total_rows = {}
+    for p in projects.values():
+      for b in p['branches'].values():
+        total_commits += b['commits']
+        for (table, rows) in b['rows'].items():
+          total_rows[table] = total_rows.get(table, 0) + rows
+        b['commits_per_second'] = (
+          b['commits'] / b['elapsed'] if b['elapsed'] is not None and b['elapsed'] > 0 else None
+        )
+
+    return {
+      'started'            : datetime.datetime.fromtimestamp(self.started).astimezone().isoformat(),
+      'finished'           : datetime.datetime.fromtimestamp(finished).astimezone().isoformat(),
+      'duration'           : duration,
+      'succeeded'          : all(p['succeeded'] for p in projects.values()),
+      'commits'            : total_commits,
+      'rows'               : total_rows,
+      'commits_per_second' : total_commits / duration if duration > 0 else None,
+      'projects'           : projects
+    }
+
+  def write_json(self, path: str):
+    """
+    write_json() - Write the run report as JSON
+      path : path to the file
+    """
+    write_atomic(path, json.dumps(self.report(), indent = 2, ensure_ascii = False) + u'\n')
+
+  def write_prometheus(self, path: str):
+    """
+    write_prometheus() - Write the run report in Prometheus text format
+    (for "textfile" collector of node_exporter)
+      path : path to the file (its name must end with ".prom")
+    """
+    report = self.report()
+    samples = {}
+    helps = {
+      'last_run_timestamp_seconds' : u'Time when the last update run finished.',
+      'run_duration_seconds'       : u'Duration of the last update run.',
+      'succeeded'                  : u'1 if the last update run succeeded.',
+      'project_succeeded'          : u'1 if updating the project succeeded.',
+      'phase_seconds'              : u'Seconds spent in each phase.',
+      'commits'                    : u'Number of commits processed.',
+      'rows_written'               : u'Number of rows written to each table.',
+      'commits_per_second'         : u'Commits processed per second.',
+      'push_seconds'               : u'Seconds spent in pushing to each mirror.',
+      'push_attempts'              : u'Number of attempts of pushing to each mirror.',
+      'push_succeeded'             : u'1 if pushing to the mirror succeeded.'
+    }
+
+    def add(name, labels, value):
+      if value is None:
+        return
+      samples.setdefault(name, []).append((labels, value))
+    # end of nested (internal) function
+
+    add('last_run_timestamp_seconds', {}, self.finished if self.finished is not None else time.time())
+    add('run_duration_seconds', {}, report['duration'])
+    add('succeeded', {}, 1 if report['succeeded'] else 0)
+    for (project, p) in sorted(report['projects'].items()):
+      add('project_succeeded', {'project': project}, 1 if p['succeeded'] else 0)
+      for (phase, seconds) in sorted(p['phases'].items()):
+        add('phase_seconds', {'project': project, 'phase': phase}, seconds)
+      for (branch, b) in sorted(p['branches'].items()):
+        for (phase, seconds) in sorted(b['phases'].items()):
+          add('phase_seconds', {'project': project, 'branch': branch, 'phase': phase}, seconds)
+        add('commits', {'project': project, 'branch': branch}, b['commits'])
+        for (table, rows) in sorted(b['rows'].items()):
+          add('rows_written', {'project': project, 'branch': branch, 'table': table}, rows)
+        add('commits_per_second', {'project': project, 'branch': branch}, b['commits_per_second'])
+      for (remote, r) in sorted(p['remotes'].items()):
+        add('push_seconds', {'project': project, 'remote': remote}, r['seconds'])
+        add('push_attempts', {'project': project, 'remote': remote}, r['attempts'])
+        add('push_succeeded', {'project': project, 'remote': remote}, 1 if r['succeeded'] else 0)
+
+    def escape(value):
+      return str(value).replace(u'\\', u'\\\\').replace(u'"', u'\\"').replace(u'\n', u'\\n')
+    # end of nested (internal) function
+
+    lines = []
+    for name in helps:
+      if name not in samples:
+        continue
+      metric = u'pgmaster_update_' + name
+      lines.append(u'# HELP %s %s' % (metric, helps[name]))
+      lines.append(u'# TYPE %s gauge' % metric)
+      for (labels, value) in samples[name]:
+        label_text = u','.join([u'%s="%s"' % (k, escape(v)) for (k, v) in labels.items()])
+        lines.append(u'%s%s %s' % (metric, u'{' + label_text + u'}' if label_text else u'', repr(float(value))))
+    write_atomic(path, u'\n'.join(lines) + u'\n')
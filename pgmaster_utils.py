@@ -17,6 +17,16 @@
 # You should have received a copy of the GNU General Public License
 # along with "pgmaster2".  If not, see <http://www.gnu.org/licenses/>.
 
+import os
+import re
+import errno
+import hashlib
+import fcntl
+import time
+import atexit
+import subprocess
+import threading
+import collections
 import git
 import psycopg2.extensions
 
@@ -37,27 +47,35 @@ def json_escape(s: str) -> str:
   """
   return s.translate(__trans_escaped)
 
+def lock_shared(fd, timeout: float):
+  """
+  lock_shared() - Acquire shared lock of the repository to read, waiting up to timeout
+    fd      : file object of the lock file ("git/.lock.<project>")
+    timeout : max seconds to wait (0 to fail immediately)
+  Raises OSError (EAGAIN) if the lock can't be acquired in time, same as LOCK_NB.
+  """
+  deadline = time.monotonic() + timeout
+  wait = 0.01
+  while True:
+    try:
+      fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+      return
+    except OSError as e:
+      if e.errno != errno.EACCES and e.errno != errno.EAGAIN:
+        raise
+      remaining = deadline - time.monotonic()
+      if remaining <= 0:
+        raise
+      # Exclusive lock is held only while switching refs, so it will be released soon.
+      time.sleep(min(wait, remaining))
+      wait = min(wait * 2, 0.2)
+
 def git_ancestor(commit: git.Commit):
   """
   git_ancestor() - Search and get parents of specified commit
     commit : git.Commit instance to get parents' commits
+  Parents of merge commit are searched instead of merge commit itself.
   """
-  def git_parents(p):
-    result = []
-    if p is None:
-      return result
-
-    if len(p.parents) > 1:
-      # Merge commit
-      for gp in p.parents:
-        result.extend(git_parents(gp))
-    else:
-      # Initial or Normal commit
-      result.extend([p.hexsha])
-
-    return result
-  # end of nested (internal) function
-
   if len(commit.parents) > 1:
     # Start point is a merge commit. Not supported.
     raise ValueError
@@ -65,7 +83,32 @@ def git_ancestor(commit: git.Commit):
     # Initial commit
     return None
 
-  return git_parents(commit.parents[0])
+  return git_ancestor_of(commit.parents[0])
+
+def git_ancestor_of(parent: git.Commit):
+  """
+  git_ancestor_of() - Get specified commit, or parents of it if it is a merge commit
+    parent : git.Commit instance to search
+  """
+  # Search iteratively (not recursively) to handle deep merge chains.
+  result = []
+  visited = set()
+  stack = [parent]
+  while len(stack) > 0:
+    p = stack.pop()
+    if p.hexsha in visited:
+      continue
+    visited.add(p.hexsha)
+
+    if len(p.parents) > 1:
+      # Merge commit
+      # Push in reverse order to search from the first parent.
+      stack.extend(reversed(p.parents))
+    else:
+      # Initial or Normal commit
+      result.append(p.hexsha)
+
+  return result
 
 def git_children(cur: psycopg2.extensions.cursor, project: str, commit: str):
   """
@@ -87,3 +130,812 @@ def git_children(cur: psycopg2.extensions.cursor, project: str, commit: str):
   if children is None:
     return None
   return children
+
+def get_keywords(cur: psycopg2.extensions.cursor, project: str, prefix: str = None, limit: int = None):
+  """
+  get_keywords() - Get keywords used in investigations of the project from database.
+    cur     : psycopg2.extensions.cursor instance of databse
+    project : project name
+    prefix  : get only keywords starting with this (for autocomplete), or None for all
+    limit   : max number of keywords (or None)
+  Keywords are sorted by name, or by number of uses if prefix is specified.
+  """
+  if prefix is None:
+    cur.execute(u"""SELECT
+        keyword
+      FROM
+        keyword_info
+      WHERE
+        project = %s
+      ORDER BY
+        keyword
+      LIMIT %s""",
+      [project, limit]
+    )
+  else:
+    # Escape wildcards of LIKE.
+    pattern = prefix.replace(u'\\', u'\\\\').replace(u'%', u'\\%').replace(u'_', u'\\_') + u'%'
+    cur.execute(u"""SELECT
+        keyword
+      FROM
+        keyword_info
+      WHERE
+        project = %s AND keyword LIKE %s
+      ORDER BY
+        usage DESC, keyword
+      LIMIT %s""",
+      [project, pattern, limit]
+    )
+  return [k for (k,) in cur.fetchall()]
+
+def update_keywords(cur: psycopg2.extensions.cursor, project: str, old_keywords, new_keywords):
+  """
+  update_keywords() - Update number of uses of keywords of the project.
+    cur          : psycopg2.extensions.cursor instance of databse
+    project      : project name
+    old_keywords : keywords of the investigation before modified (or None)
+    new_keywords : keywords of the investigation after modified (or None)
+  This must be called in the same transaction as modifying the investigation.
+  """
+  old_keywords = set(old_keywords or [])
+  new_keywords = set(new_keywords or [])
+  # Sorted to lock rows in the same order.
+  added = sorted(new_keywords - old_keywords)
+  removed = sorted(old_keywords - new_keywords)
+
+  if len(added) > 0:
+    cur.execute(u"""INSERT INTO
+        keyword_info (project, keyword, usage)
+      SELECT
+        %s, k, 1
+      FROM
+        unnest(%s::text[]) AS k
+      ORDER BY
+        k
+      ON CONFLICT ON CONSTRAINT keyword_info_pkey
+      DO UPDATE SET
+        usage = keyword_info.usage + 1""",
+      [project, added]
+    )
+  if len(removed) > 0:
+    cur.execute(u"""UPDATE
+        keyword_info
+      SET
+        usage = usage - 1
+      WHERE
+        project = %s AND keyword = ANY(%s)""",
+      [project, removed]
+    )
+    cur.execute(u"""DELETE FROM
+        keyword_info
+      WHERE
+        project = %s AND keyword = ANY(%s) AND usage <= 0""",
+      [project, removed]
+    )
+
+def get_commit_detail(cur: psycopg2.extensions.cursor, project: str, branch: str, commitid: str):
+  """
+  get_commit_detail() - Get everything about the commit on the branch from database at once.
+    cur      : psycopg2.extensions.cursor instance of databse
+    project  : project name
+    branch   : branch name
+    commitid : commitid (full)
+  Returns dict, or None if the commit is not on the branch.
+  "related" is dict of commit id and tuple (short commit id, branch name) of parents and children
+  found in database (branch is the specified one if they are on it).
+  "parents" are commits having this commit as a child, so they are NOT in order of git.
+  "backpatches" are list of tuple (commit id, short commit id, branch name) of other commits
+  in the same back-patch group, from latest to oldest.
+  """
+  cur.execute(u"""SELECT
+      b.scommitid,
+      b.commitdate_l,
+      b.timezone_int,
+      ci.updatetime,
+      ci.author,
+      ci.committer,
+      ci.commitlog,
+      ci.summary,
+      ci.children,
+      p.parents,
+      r.related,
+      i.updatetime,
+      i.snote,
+      i.note,
+      i.analysis,
+      i.keywords,
+      (SELECT array_agg(keyword ORDER BY keyword) FROM keyword_info WHERE project = b.project),
+      (SELECT repo_browse_url FROM project_info WHERE project = b.project),
+      (SELECT max(lastingested) FROM branch_stats WHERE project = b.project),
+      bp.backpatches
+    FROM
+      _branch b
+      JOIN _commitinfo ci ON (b.project = ci.project AND b.commitid = ci.commitid)
+      LEFT JOIN _investigation i ON (b.project = i.project AND b.branch = i.branch AND b.commitid = i.commitid)
+      CROSS JOIN LATERAL (
+        SELECT
+          array_agg(pc.commitid ORDER BY pc.commitid) AS parents
+        FROM
+          _commitinfo pc
+        WHERE
+          pc.project = b.project AND pc.children @> ARRAY[b.commitid]
+      ) p
+      CROSS JOIN LATERAL (
+        SELECT
+          array_agg(ARRAY[x.commitid, x.scommitid, x.branch]) AS related
+        FROM (
+          SELECT
+            rb.commitid,
+            min(rb.scommitid) AS scommitid,
+            (array_agg(rb.branch ORDER BY rb.branch = b.branch DESC, rb.branch))[1] AS branch
+          FROM
+            _branch rb
+          WHERE
+            rb.project = b.project AND
+            rb.commitid = ANY(coalesce(ci.children, '{}'::text[]) || coalesce(p.parents, '{}'::text[]))
+          GROUP BY
+            rb.commitid
+        ) x
+      ) r
+      CROSS JOIN LATERAL (
+        SELECT
+          array_agg(ARRAY[gb.commitid, gb.scommitid, gb.branch] ORDER BY gb.commitdate DESC, gb.branch) AS backpatches
+        FROM
+          _commitinfo g
+          JOIN _branch gb ON (g.project = gb.project AND g.commitid = gb.commitid)
+        WHERE
+          g.project = b.project AND g.bpgroup = ci.bpgroup AND
+          NOT (gb.commitid = b.commitid AND gb.branch = b.branch)
+      ) bp
+    WHERE
+      b.project = %s AND b.branch = %s AND b.commitid = %s""",
+    [project, branch, commitid]
+  )
+  c = cur.fetchone()
+  if c is None:
+    return None
+
+  return {
+    'id'              : commitid,
+    'sid'             : c[0],
+    'date'            : c[1],
+    'tz'              : c[2],
+    'updatetime'      : c[3],
+    'author'          : c[4],
+    'committer'       : c[5],
+    'message'         : c[6],
+    'summary'         : c[7],
+    'children'        : c[8] if c[8] is not None else [],
+    'parents'         : c[9] if c[9] is not None else [],
+    'related'         : {x[0]: (x[1], x[2]) for x in (c[10] or [])},
+    'investigation'   : {
+      'updatetime' : c[11],
+      'snote'      : c[12],
+      'note'       : c[13],
+      'analysis'   : c[14],
+      'keywords'   : c[15] if c[15] is not None else []
+    } if c[11] is not None else None,
+    'keywords'        : c[16] if c[16] is not None else [],  # of the project
+    'repo_browse_url' : c[17],
+    'lastingested'    : c[18],
+    'backpatches'     : [tuple(x) for x in (c[19] or [])]
+  }
+
+# This is the magic ID of "empty tree". (not commit id)
+# See https://stackoverflow.com/questions/40883798/how-to-get-git-diff-of-the-first-commit
+EMPTY_TREE = '4b825dc642cb6eb9a060e54bf8d69288fbee4904'
+
+def git_patch(commit: git.Commit):
+  """
+  git_patch() - Make patches of the commit for each file (against the first parent)
+    commit : git.Commit instance
+  Each patch is escaped to be inserted as Template string (ES6).
+  """
+  if len(commit.parents) > 0:
+    src = commit.parents[0]
+  else:
+    src = commit.repo.tree(EMPTY_TREE)
+
+  diffs = []
+  for d in src.diff(commit, create_patch = True):
+    a_path = 'a/%s' % d.a_rawpath.decode('utf-8') if d.a_rawpath is not None else '/dev/null'
+    b_path = 'b/%s' % d.b_rawpath.decode('utf-8') if d.b_rawpath is not None else '/dev/null'
+
+    # Sanitize diff
+    # This part will be inserted as Template string (ES6).
+    code_diff = json_escape(d.diff.decode('utf-8'))
+
+    # Real LF are not accepted in JSON string.
+    # We use Template string (ES6) instead.
+    patch_str = (
+      u'--- %s\n'
+      u'+++ %s\n'
+      u'\n'
+      u'%s'
+    ) % (
+      a_path,
+      b_path,
+      code_diff
+    )
+
+    diffs.append(patch_str)
+
+  return diffs
+
+def git_diff_files(commit: git.Commit):
+  """
+  git_diff_files() - List changed files of the commit with stats (against the first parent)
+    commit : git.Commit instance
+  Returns list of dict (index, path, old_path, added, deleted, binary).
+  "old_path" is None unless renamed, and "added" and "deleted" are None if binary.
+  """
+  src = commit.parents[0].hexsha if len(commit.parents) > 0 else EMPTY_TREE
+  out = subprocess.run(
+    ['git', '--git-dir=' + commit.repo.git_dir, 'diff-tree', '-r', '-M', '--numstat', '-z', src, commit.hexsha],
+    stdout = subprocess.PIPE,
+    check = True
+  ).stdout
+
+  # Each file is "<added>\t<deleted>\t<path>\0",
+  # or "<added>\t<deleted>\t\0<old path>\0<new path>\0" if renamed.
+  files = []
+  tokens = out.split(b'\0')
+  i = 0
+  while i < len(tokens) and tokens[i] != b'':
+    (added, deleted, path) = tokens[i].split(b'\t', 2)
+    old_path = None
+    if path == b'':
+      old_path = tokens[i + 1].decode('utf-8', errors = 'replace')
+      path = tokens[i + 2]
+      i += 3
+    else:
+      i += 1
+    binary = (added == b'-')
+    files.append({
+      'index'    : len(files),
+      'path'     : path.decode('utf-8', errors = 'replace'),
+      'old_path' : old_path,
+      'added'    : None if binary else int(added),
+      'deleted'  : None if binary else int(deleted),
+      'binary'   : binary
+    })
+  return files
+
+def git_file_patch(commit: git.Commit, file: dict, max_size: int):
+  """
+  git_file_patch() - Get patch of one file of the commit (against the first parent)
+    commit   : git.Commit instance
+    file     : dict of the file made by git_diff_files()
+    max_size : maximum bytes of the patch to read
+  Returns tuple (patch, True if truncated).
+  Reading is stopped at max_size, so huge file doesn't consume memory.
+  """
+  src = commit.parents[0].hexsha if len(commit.parents) > 0 else EMPTY_TREE
+  paths = [file['path']] if file['old_path'] is None else [file['old_path'], file['path']]
+  # Paths are not patterns (e.g. "a[1].txt" matches "a1.txt" as pathspec).
+  proc = subprocess.Popen(
+    ['git', '--git-dir=' + commit.repo.git_dir, '--literal-pathspecs', 'diff-tree', '-p', '-M', '--no-color', '--no-ext-diff', src, commit.hexsha, '--'] + paths,
+    stdout = subprocess.PIPE,
+    stderr = subprocess.DEVNULL
+  )
+  try:
+    data = proc.stdout.read(max_size + 1)
+    truncated = len(data) > max_size
+  finally:
+    proc.kill()
+    proc.stdout.close()
+    proc.wait()
+
+  if truncated:
+    # Cut at the end of the last line.
+    data = data[:max_size]
+    data = data[:data.rfind(b'\n') + 1]
+  return (data.decode('utf-8', errors = 'replace'), truncated)
+
+def load_diffs(commit: git.Commit, cache = None, lazy = False):
+  """
+  load_diffs() - Get changed files and patches of the commit, looking up the cache first
+    commit : git.Commit instance
+    cache  : pgmaster_cache.diff_cache instance (or None)
+    lazy   : True not to make patches, or function to tell it from the list of files
+  Returns tuple (list made by git_diff_files(), list made by git_patch() or None if lazy).
+  Both are cached by commit id, so the repository is not read again once cached.
+  """
+  value = cache.get(commit.hexsha) if cache is not None else None
+  updated = False
+  if value is None:
+    value = {'files' : git_diff_files(commit), 'diffs' : None}
+    updated = True
+  if callable(lazy):
+    lazy = lazy(value['files'])
+  if value['diffs'] is None and not lazy:
+    value['diffs'] = git_patch(commit)
+    updated = True
+  if updated and cache is not None:
+    cache.put(commit.hexsha, value)
+  return (value['files'], None if lazy else value['diffs'])
+
+def git_remote_changed(repo: git.Repo, remote: str = 'origin') -> bool:
+  """
+  git_remote_changed() - Check if refs on the remote differ from local refs by "git ls-remote",
+  without fetching any objects (for mirror repository)
+    repo   : git.Repo instance of the repository
+    remote : remote name
+  """
+  local = {}
+  for line in repo.git.for_each_ref(u'--format=%(objectname) %(refname)').splitlines():
+    (sha, ref) = line.split(u' ', 1)
+    local[ref] = sha
+
+  # Refs deleted on the remote are not checked, because they are not pruned by fetching.
+  for line in repo.git.ls_remote(remote).splitlines():
+    (sha, ref) = line.split(u'\t', 1)
+    if ref == u'HEAD' or ref.endswith(u'^{}'):
+      continue
+    if local.get(ref) != sha:
+      return True
+  return False
+
+def repository_signature(path: str):
+  """
+  repository_signature() - Get signature to detect changes of git repository
+    path : path to git repository (bare)
+  """
+  signature = []
+  for name in ('objects/pack', 'packed-refs', 'FETCH_HEAD'):
+    try:
+      signature.append(os.stat(os.path.join(path, name)).st_mtime_ns)
+    except FileNotFoundError:
+      signature.append(None)
+  return tuple(signature)
+
+class git_abbrev:
+  """
+  git_abbrev - Compute short commit ids in-process, like "git rev-parse --short".
+  All object ids in the repository are indexed once, then minimal unique prefix
+  is calculated with neighbours in sorted index.
+  This is thread-safe.
+  """
+  def __init__(self, path: str, min_length: int = 7):
+    """
+    git_abbrev() - Initialize and load index of object ids
+      path       : path to git repository (bare)
+      min_length : minimum length of short commit id
+    """
+    self._path = path
+    self._min_length = min_length
+    self._index = b''  # Sorted raw object ids
+    self._rawsz = 20   # Length of raw object id (SHA-1)
+    self._count = 0
+    self._signature = None
+    self._lock = threading.RLock()
+    self.refresh(force = True)
+    return
+
+  def refresh(self, force: bool = False) -> bool:
+    """
+    refresh() - Reload index of object ids if repository has changed.
+      force : reload even if repository has not changed
+    """
+    with self._lock:
+      return self._refresh(force)
+
+  def _refresh(self, force: bool) -> bool:
+    signature = repository_signature(self._path)
+    if not force and signature == self._signature:
+      return False
+
+    # Objects are listed in order sorted by their ids without duplicates,
+    # unless "--unordered" is specified.
+    out = subprocess.run(
+      ['git', '--git-dir=' + self._path, 'cat-file', '--batch-all-objects', '--batch-check=%(objectname)'],
+      stdout = subprocess.PIPE,
+      check = True
+    ).stdout
+    hexsz = out.find(b'\n')
+    if hexsz > 0:
+      self._rawsz = hexsz // 2
+    self._index = bytes.fromhex(out.replace(b'\n', b'').decode('ascii'))
+    self._count = len(self._index) // self._rawsz
+    self._signature = signature
+    return True
+
+  def _search(self, raw: bytes) -> int:
+    # Lower bound of raw in index
+    lo = 0
+    hi = self._count
+    sz = self._rawsz
+    while lo < hi:
+      mid = (lo + hi) // 2
+      if self._index[mid * sz:(mid + 1) * sz] < raw:
+        lo = mid + 1
+      else:
+        hi = mid
+    return lo
+
+  def _common_length(self, raw: bytes, pos: int) -> int:
+    # Number of common hex digits between raw and the object at pos
+    if pos < 0 or pos >= self._count:
+      return 0
+    other = self._index[pos * self._rawsz:(pos + 1) * self._rawsz]
+    diff = int.from_bytes(raw, 'big') ^ int.from_bytes(other, 'big')
+    return self._rawsz * 2 - (diff.bit_length() + 3) // 4
+
+  def abbrev(self, hexshas) -> dict:
+    """
+    abbrev() - Get short commit ids of specified commits
+      hexshas : iterable of (full) commit ids
+    Returns dict of commit id and its short commit id.
+    """
+    with self._lock:
+      self._refresh(False)
+      return self._abbrev(list(hexshas), refreshed = False)
+
+  def _abbrev(self, hexshas, refreshed: bool = True) -> dict:
+    result = {}
+    for hexsha in hexshas:
+      raw = bytes.fromhex(hexsha)
+      pos = self._search(raw)
+      found = (pos < self._count and self._index[pos * self._rawsz:(pos + 1) * self._rawsz] == raw)
+      if not found and not refreshed:
+        # New object is arrived. Reload index once in this call,
+        # and recalculate from the beginning to keep consistency.
+        # (Loose objects don't change the signature, so force reloading.)
+        self._refresh(True)
+        return self._abbrev(hexshas)
+
+      # Compare with neighbours. If found, the object itself is at pos.
+      common = max(
+        self._common_length(raw, pos - 1),
+        self._common_length(raw, pos + 1 if found else pos)
+      )
+      length = min(max(self._min_length, common + 1), len(hexsha))
+      result[hexsha] = hexsha[:length]
+
+    return result
+
+  def short(self, hexsha: str) -> str:
+    """
+    short() - Get short commit id of specified commit
+      hexsha : (full) commit id
+    """
+    return self.abbrev([hexsha])[hexsha]
+
+# Full commit id (SHA-1)
+_full_hexsha = re.compile(r'[0-9a-fA-F]{40}')
+
+class git_repository:
+  """
+  git_repository - Opened git.Repo instance of a project, with cache of commit objects.
+  Use via git_repositories. This is NOT thread-safe by itself.
+  """
+  def __init__(self, path: str, max_commits: int):
+    """
+    git_repository() - Open git repository
+      path        : path to git repository (bare)
+      max_commits : maximum number of cached commit objects
+    """
+    self.signature = repository_signature(path)
+    self.repo = git.Repo(path)
+    if not self.repo.bare:
+      self.repo.close()
+      raise FileNotFoundError(path)
+    self._commits = collections.OrderedDict()
+    self._max_commits = max_commits
+    return
+
+  def commit(self, rev: str) -> git.Commit:
+    """
+    commit() - Get commit object, like git.Repo.commit()
+      rev : revision (only full commit id is cached)
+    """
+    if _full_hexsha.fullmatch(rev) is None:
+      return self.repo.commit(rev)
+
+    rev = rev.lower()
+    commit = self._commits.get(rev)
+    if commit is not None:
+      self._commits.move_to_end(rev)
+      return commit
+
+    commit = self.repo.commit(rev)
+    self._commits[rev] = commit
+    while len(self._commits) > self._max_commits:
+      # Least recently used one is evicted.
+      self._commits.popitem(last = False)
+    return commit
+
+  def close(self):
+    """
+    close() - Close git repository (and terminate persistent git processes)
+    """
+    self._commits.clear()
+    self.repo.close()
+
+class git_repositories:
+  """
+  git_repositories - Registry of opened git repositories of projects, for each process.
+  Repository is reopened when its packs or refs are changed (see repository_signature()).
+  Each repository is used by only one thread at a time (between acquire() and release()),
+  because persistent git processes of GitPython can't be shared by threads.
+  This is thread-safe.
+  """
+  def __init__(self, base: str = u'git', max_commits: int = 1024):
+    """
+    git_repositories() - Initialize registry
+      base        : directory of git repositories
+      max_commits : maximum number of cached commit objects for each repository
+    """
+    self._base = base
+    self._max_commits = max_commits
+    self._entries = {}  # project -> [lock, git_repository or None]
+    self._lock = threading.Lock()
+    self._pid = os.getpid()
+    atexit.register(self.close)
+    return
+
+  def _entry(self, project: str) -> list:
+    with self._lock:
+      if self._pid != os.getpid():
+        # Forked (e.g. by uWSGI without "lazy-apps").
+        # Persistent git processes belong to the parent, so forget them without closing.
+        self._entries = {}
+        self._pid = os.getpid()
+      return self._entries.setdefault(project, [threading.Lock(), None])
+
+  def acquire(self, project: str) -> git_repository:
+    """
+    acquire() - Get git repository of the project, and lock it for this thread
+      project : project name
+    Call release() after use. Raises FileNotFoundError if not found.
+    """
+    entry = self._entry(project)
+    entry[0].acquire()
+    try:
+      path = os.path.join(self._base, project + u'.git')
+      handle = entry[1]
+      if handle is not None and handle.signature != repository_signature(path):
+        # Repository has been updated.
+        handle.close()
+        handle = entry[1] = None
+      if handle is None:
+        handle = entry[1] = git_repository(path, self._max_commits)
+      return handle
+    except Exception:
+      entry[0].release()
+      raise
+
+  def release(self, project: str):
+    """
+    release() - Unlock git repository of the project locked by acquire()
+      project : project name
+    """
+    self._entry(project)[0].release()
+
+  def close(self):
+    """
+    close() - Close all of git repositories (called at exit)
+    """
+    with self._lock:
+      if self._pid != os.getpid():
+        return
+      entries = list(self._entries.values())
+    for entry in entries:
+      # Don't wait for the repository in use (e.g. by a thread not finished at exit).
+      if entry[0].acquire(blocking = False):
+        try:
+          if entry[1] is not None:
+            entry[1].close()
+            entry[1] = None
+        finally:
+          entry[0].release()
+
+class commit_record:
+  """
+  commit_record - Compact record of a commit read from "git log"
+  """
+  __slots__ = (
+    'hexsha',            # commit id
+    'parents',           # commit ids of parents (parents of merge commits are searched), or None
+    'authored_date',     # authored date (seconds since epoch)
+    'author_tz_offset',  # timezone offset of author (seconds west of UTC, same as GitPython)
+    'author_name',       # name of author
+    'committer_name',    # name of committer
+    'message'            # commit message
+  )
+
+  def __init__(self, hexsha, parents, authored_date, author_tz_offset, author_name, committer_name, message):
+    self.hexsha = hexsha
+    self.parents = parents
+    self.authored_date = authored_date
+    self.author_tz_offset = author_tz_offset
+    self.author_name = author_name
+    self.committer_name = committer_name
+    self.message = message
+
+def git_log_records(repo: git.Repo, rev: str, since: str = None):
+  """
+  git_log_records() - Read non-merge commits from oldest to latest, through "git log" pipe
+    repo  : git.Repo instance of the repository
+    rev   : revision (range) to read
+    since : read only commits more recent than this date (or None)
+  This is a generator, yields commit_record instances.
+  """
+  # Fields are separated by US (0x1f), and each commit is terminated by NUL (-z).
+  # Commit message must be the last field, because it may contain any chars except NUL.
+  args = [
+    'git', '--git-dir=' + repo.git_dir, 'log',
+    '-z', '--reverse', '--date-order', '--boundary', '--date=raw',
+    '--format=%m%x1f%H%x1f%P%x1f%ad%x1f%an%x1f%cn%x1f%B'
+  ]
+  if since is not None:
+    args.append('--since=' + since)
+  args.extend([rev, '--'])
+
+  # "--date-order" shows parents before children with "--reverse",
+  # so merge commits are always known before their children.
+  merges = {}       # merge commit and its parents
+  boundaries = {}   # boundary commit (not to be inserted) and its parents
+  records = set()   # non-merge commits already read
+  resolved = {}     # commit neither read nor boundary, and its non-merge ancestors
+
+  def search_parents(parents):
+    result = []
+    visited = set()
+    stack = list(reversed(parents))
+    while len(stack) > 0:
+      p = stack.pop()
+      if p in visited:
+        continue
+      visited.add(p)
+
+      if p in merges:
+        stack.extend(reversed(merges[p]))
+      elif p in boundaries and len(boundaries[p]) > 1:
+        # Boundary merge commit. Parents of it are not read,
+        # so search them in the repository.
+        result.extend(git_ancestor_of(repo.commit(p)))
+      elif p in boundaries or p in records:
+        result.append(p)
+      else:
+        # Commit out of the range (e.g. older than "since") is not always shown as a boundary.
+        # It may be a merge commit, so search it in the repository.
+        if p not in resolved:
+          resolved[p] = git_ancestor_of(repo.commit(p))
+        result.extend(resolved[p])
+    return result
+  # end of nested (internal) function
+
+  proc = subprocess.Popen(args, stdout = subprocess.PIPE)
+  try:
+    pending = b''
+    for chunk in iter(lambda: proc.stdout.read(65536), b''):
+      entries = (pending + chunk).split(b'\0')
+      pending = entries.pop()
+      for entry in entries:
+        (mark, hexsha, parents, date, author_name, committer_name, message) = entry.split(b'\x1f', 6)
+        hexsha = hexsha.decode('ascii')
+        parents = parents.decode('ascii').split()
+
+        if mark == b'-':
+          boundaries[hexsha] = parents
+          continue
+        if len(parents) > 1:
+          merges[hexsha] = parents
+          continue
+
+        (timestamp, tz) = date.decode('ascii').split()
+        tz_offset = (int(tz[1:3]) * 3600 + int(tz[3:5]) * 60) * (1 if tz[0] == '-' else -1)
+        records.add(hexsha)
+        yield commit_record(
+          hexsha,
+          search_parents(parents) if len(parents) > 0 else None,
+          int(timestamp),
+          tz_offset,
+          author_name.decode('utf-8', 'replace'),
+          committer_name.decode('utf-8', 'replace'),
+          message.decode('utf-8', 'replace')
+        )
+    # end of for chunk
+
+    if proc.wait() != 0:
+      raise git.GitCommandError(args, proc.returncode)
+  finally:
+    if proc.poll() is None:
+      # Consumer stopped reading.
+      proc.kill()
+      proc.wait()
+    proc.stdout.close()
+
+def git_existing_commits(repo: git.Repo, hexshas) -> list:
+  """
+  git_existing_commits() - Filter commit ids by existence in the repository at once ("git cat-file --batch-check")
+    repo    : git.Repo instance of the repository
+    hexshas : list of commit ids
+  Returns list of commit ids found as commits, in the same order.
+  """
+  out = subprocess.run(
+    ['git', '--git-dir=' + repo.git_dir, 'cat-file', '--batch-check'],
+    input = u''.join([x + u'\n' for x in hexshas]).encode('ascii'),
+    stdout = subprocess.PIPE,
+    check = True
+  ).stdout
+  # "<object id> <type> <size>", or "<object id> missing"
+  found = set()
+  for line in out.decode('ascii').splitlines():
+    fields = line.split()
+    if len(fields) == 3 and fields[1] == u'commit':
+      found.add(fields[0])
+  return [x for x in hexshas if x in found]
+
+def git_patch_ids(repo: git.Repo, hexshas) -> dict:
+  """
+  git_patch_ids() - Calculate patch-ids of commits at once, through "git diff-tree | git patch-id" pipe
+    repo    : git.Repo instance of the repository
+    hexshas : list of commit ids (of non-merge commits)
+  Returns dict of commit id and its patch-id ("git patch-id --stable", against the first parent).
+  Commits without any changes are not included.
+  Patch-id is same for the same changes, even if they are applied to other branches (e.g. back-patched).
+  """
+  git_dir = '--git-dir=' + repo.git_dir
+  diff_args = ['git', git_dir, 'diff-tree', '--stdin', '-p', '--root']
+  patch_id_args = ['git', git_dir, 'patch-id', '--stable']
+  diff_tree = subprocess.Popen(diff_args, stdin = subprocess.PIPE, stdout = subprocess.PIPE)
+  patch_id = subprocess.Popen(patch_id_args, stdin = diff_tree.stdout, stdout = subprocess.PIPE)
+  diff_tree.stdout.close()  # Owned by "git patch-id" now.
+
+  # Commit ids are written by another thread,
+  # not to be blocked while both of pipes are full.
+  def feed():
+    try:
+      diff_tree.stdin.write(u''.join([x + u'\n' for x in hexshas]).encode('ascii'))
+    except BrokenPipeError:
+      pass
+    finally:
+      try:
+        diff_tree.stdin.close()
+      except BrokenPipeError:
+        pass
+  # end of nested (internal) function
+
+  writer = threading.Thread(target = feed, daemon = True)
+  writer.start()
+  result = {}
+  try:
+    for line in patch_id.stdout:
+      # "<patch-id> <commit id>"
+      (pid, hexsha) = line.decode('ascii').split()
+      result[hexsha] = pid
+
+    if diff_tree.wait() != 0:
+      raise git.GitCommandError(diff_args, diff_tree.returncode)
+    if patch_id.wait() != 0:
+      raise git.GitCommandError(patch_id_args, patch_id.returncode)
+  finally:
+    for proc in (diff_tree, patch_id):
+      if proc.poll() is None:
+        proc.kill()
+        proc.wait()
+    patch_id.stdout.close()
+    writer.join()
+  return result
+
+# Lines added by "git cherry-pick -x"
+_ptrn_cherry_picked = re.compile(r'\(cherry picked from commit [0-9a-f]+\)')
+
+def message_fingerprint(message: str) -> str:
+  """
+  message_fingerprint() - Make fingerprint of the commit message, to find back-patched commits
+    message : commit message
+  Differences of whitespaces, cases and lines added by "git cherry-pick -x" are ignored.
+  Returns None if the message is empty.
+  """
+  lines = []
+  for line in message.splitlines():
+    line = u' '.join(line.split()).casefold()
+    if len(line) <= 0 or _ptrn_cherry_picked.fullmatch(line):
+      continue
+    lines.append(line)
+  if len(lines) <= 0:
+    return None
+  return hashlib.sha1(u'\n'.join(lines).encode('utf-8')).hexdigest()
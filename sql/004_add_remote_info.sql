@@ -0,0 +1,37 @@
+/*
+  Copyright (C) 2020-2026 Kondo Taiki
+
+  This file is part of "pgmaster2".
+
+  "pgmaster2" is free software: you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation, either version 3 of the License, or
+  (at your option) any later version.
+
+  "pgmaster2" is distributed in the hope that it will be useful,
+  but WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+  GNU General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with "pgmaster2".  If not, see <http://www.gnu.org/licenses/>.
+*/
+
+/*
+  This is the migration script to record the result of mirroring.
+
+  "update_master.py" records the result of the last push to each mirror.
+*/
+
+CREATE TABLE IF NOT EXISTS remote_info
+(
+  project      text        NOT NULL,
+  remote       text        NOT NULL,
+  updatetime   timestamptz NOT NULL default now(),
+  succeeded    boolean     NOT NULL,  -- Result of the last push
+  attempts     integer     NOT NULL,  -- Number of attempts of the last push
+  duration     interval    NOT NULL,  -- Duration of the last push (including retries)
+  message      text,                  -- Error message of the last attempt
+  lastsuccess  timestamptz,           -- Time of the last successful push
+  PRIMARY KEY(project, remote)
+);
@@ -0,0 +1,32 @@
+/*
+  Copyright (C) 2020-2026 Kondo Taiki
+
+  This file is part of "pgmaster2".
+
+  "pgmaster2" is free software: you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation, either version 3 of the License, or
+  (at your option) any later version.
+
+  "pgmaster2" is distributed in the hope that it will be useful,
+  but WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+  GNU General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with "pgmaster2".  If not, see <http://www.gnu.org/licenses/>.
+*/
+
+/*
+  This is the migration script to store the summary of each commit.
+
+  Summary is the first line of the commit message (same as GitPython).
+  Listing pages read it with author from "_commitinfo", instead of git objects.
+  Existing commits are filled by this script, new commits by "update_master.py".
+*/
+
+ALTER TABLE _commitinfo ADD COLUMN summary text;
+
+UPDATE _commitinfo SET summary = split_part(commitlog, E'\n', 1);
+
+ALTER TABLE _commitinfo ALTER COLUMN summary SET NOT NULL;
@@ -0,0 +1,28 @@
+/*
+  Copyright (C) 2020-2026 Kondo Taiki
+
+  This file is part of "pgmaster2".
+
+  "pgmaster2" is free software: you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation, either version 3 of the License, or
+  (at your option) any later version.
+
+  "pgmaster2" is distributed in the hope that it will be useful,
+  but WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+  GNU General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with "pgmaster2".  If not, see <http://www.gnu.org/licenses/>.
+*/
+
+/*
+  This is the migration script to list commits of each branch by keyset pagination.
+
+  Branch page reads commits in order of "commitdate DESC, scommitid" after the cursor,
+  instead of skipping rows by OFFSET. This index is created on each partition.
+  Creating the index locks "_branch" for writing, so run this while "update_master.py" is stopped.
+*/
+
+CREATE INDEX IF NOT EXISTS _branch_keyset_idx ON _branch (commitdate DESC, scommitid) INCLUDE (commitid, commitdate_l, timezone_int);
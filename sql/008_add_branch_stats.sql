@@ -0,0 +1,46 @@
+/*
+  Copyright (C) 2020-2026 Kondo Taiki
+
+  This file is part of "pgmaster2".
+
+  "pgmaster2" is free software: you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation, either version 3 of the License, or
+  (at your option) any later version.
+
+  "pgmaster2" is distributed in the hope that it will be useful,
+  but WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+  GNU General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with "pgmaster2".  If not, see <http://www.gnu.org/licenses/>.
+*/
+
+/*
+  This is the migration script to keep statistics of each branch.
+
+  "update_master.py" updates these statistics in the same transaction as inserting commits,
+  and web pages read them instead of counting commits of the branch.
+  Statistics of existing commits are filled by this script.
+*/
+
+CREATE TABLE IF NOT EXISTS branch_stats
+(
+  project      text        NOT NULL,
+  branch       text        NOT NULL,
+  commits      bigint      NOT NULL,  -- Number of commits in "_branch"
+  newest       timestamptz,           -- commitdate of the newest commit
+  oldest       timestamptz,           -- commitdate of the oldest commit
+  lastingested timestamptz NOT NULL default now(),  -- Time when commits are ingested at last
+  PRIMARY KEY(project, branch)
+);
+
+INSERT INTO branch_stats (project, branch, commits, newest, oldest, lastingested)
+  SELECT
+    project, branch, count(*), max(commitdate), min(commitdate), max(updatetime)
+  FROM
+    _branch
+  GROUP BY
+    project, branch
+ON CONFLICT ON CONSTRAINT branch_stats_pkey DO NOTHING;
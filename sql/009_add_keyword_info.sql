@@ -0,0 +1,52 @@
+/*
+  Copyright (C) 2020-2026 Kondo Taiki
+
+  This file is part of "pgmaster2".
+
+  "pgmaster2" is free software: you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation, either version 3 of the License, or
+  (at your option) any later version.
+
+  "pgmaster2" is distributed in the hope that it will be useful,
+  but WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+  GNU General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with "pgmaster2".  If not, see <http://www.gnu.org/licenses/>.
+*/
+
+/*
+  This is the migration script to keep the dictionary of keywords of each project.
+
+  WebAPI updates number of uses of each keyword in the same transaction as modifying the investigation,
+  and web pages read keywords from here instead of aggregating all investigations of the project.
+  Keywords of existing investigations are filled by this script.
+*/
+
+CREATE TABLE IF NOT EXISTS keyword_info
+(
+  project      text    NOT NULL,
+  keyword      text    NOT NULL,
+  usage        integer NOT NULL,  -- Number of investigations having this keyword
+  PRIMARY KEY(project, keyword)
+);
+
+-- For prefix search (autocomplete) of keywords, regardless of collation
+CREATE INDEX IF NOT EXISTS keyword_info_prefix_idx ON keyword_info (project, keyword text_pattern_ops);
+
+INSERT INTO keyword_info (project, keyword, usage)
+  SELECT
+    project, k, count(*)
+  FROM (
+    SELECT DISTINCT
+      project, branch, commitid, UNNEST(keywords) AS k
+    FROM
+      _investigation
+    WHERE
+      keywords IS NOT NULL
+  ) AS t
+  GROUP BY
+    project, k
+ON CONFLICT ON CONSTRAINT keyword_info_pkey DO NOTHING;
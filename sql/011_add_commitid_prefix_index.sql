@@ -0,0 +1,28 @@
+/*
+  Copyright (C) 2020-2026 Kondo Taiki
+
+  This file is part of "pgmaster2".
+
+  "pgmaster2" is free software: you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation, either version 3 of the License, or
+  (at your option) any later version.
+
+  "pgmaster2" is distributed in the hope that it will be useful,
+  but WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+  GNU General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with "pgmaster2".  If not, see <http://www.gnu.org/licenses/>.
+*/
+
+/*
+  This is the migration script to search commits by a prefix of commit id.
+
+  Hash index of commitid can't be used for "LIKE 'abc123%'", and btree index with non-C collation can't
+  either, so short commit ids (in URL and commit messages) were searched by scanning partitions.
+  Index with "text_pattern_ops" serves prefix search regardless of collation.
+*/
+
+CREATE INDEX IF NOT EXISTS _branch_commitid_prefix_idx ON _branch (commitid text_pattern_ops);
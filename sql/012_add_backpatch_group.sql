@@ -0,0 +1,42 @@
+/*
+  Copyright (C) 2020-2026 Kondo Taiki
+
+  This file is part of "pgmaster2".
+
+  "pgmaster2" is free software: you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation, either version 3 of the License, or
+  (at your option) any later version.
+
+  "pgmaster2" is distributed in the hope that it will be useful,
+  but WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+  GNU General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with "pgmaster2".  If not, see <http://www.gnu.org/licenses/>.
+*/
+
+/*
+  This is the migration script to find back-patched commits by groups assigned at ingestion.
+
+  "update_master.py" calculates patch-id and fingerprint of the message of each commit,
+  and commits of the same author having the same one of them are assigned to the same group.
+  Patch-id can't be calculated by SQL, so each existing commit is put in its own group here.
+  Then they are assigned to groups only once by "update_master.py" (while "bpgroup_filled" is false).
+*/
+
+ALTER TABLE _commitinfo ADD COLUMN IF NOT EXISTS patchid text;  -- patch-id ("git patch-id --stable")
+ALTER TABLE _commitinfo ADD COLUMN IF NOT EXISTS msgid   text;  -- Fingerprint of commitlog
+ALTER TABLE _commitinfo ADD COLUMN IF NOT EXISTS bpgroup text;  -- commitid of the first commit in the back-patch group
+
+UPDATE _commitinfo SET bpgroup = commitid WHERE bpgroup IS NULL;
+ALTER TABLE _commitinfo ALTER COLUMN bpgroup SET NOT NULL;
+
+-- Existing projects are false, and projects added later are true.
+ALTER TABLE project_info ADD COLUMN IF NOT EXISTS bpgroup_filled boolean NOT NULL DEFAULT false;
+ALTER TABLE project_info ALTER COLUMN bpgroup_filled SET DEFAULT true;
+
+CREATE INDEX IF NOT EXISTS _commitinfo_patchid_idx ON _commitinfo (patchid);
+CREATE INDEX IF NOT EXISTS _commitinfo_msgid_idx ON _commitinfo (msgid);
+CREATE INDEX IF NOT EXISTS _commitinfo_bpgroup_idx ON _commitinfo (bpgroup);
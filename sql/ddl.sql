@@ -20,6 +20,9 @@
 --# uninstall each tables.
 DROP TABLE IF EXISTS project_info;
 DROP TABLE IF EXISTS repository_info;
+DROP TABLE IF EXISTS remote_info;
+DROP TABLE IF EXISTS branch_stats;
+DROP TABLE IF EXISTS keyword_info;
 DROP TABLE IF EXISTS _branch CASCADE;
 DROP TABLE IF EXISTS _investige CASCADE;
 DROP TABLE IF EXISTS _commitinfo CASCADE;
@@ -27,16 +30,54 @@ DROP TABLE IF EXISTS _commitinfo CASCADE;
 CREATE TABLE IF NOT EXISTS project_info
 (
   project          text PRIMARY KEY,
-  repo_browse_url  text
+  repo_browse_url  text,
+  update_interval  interval,  -- Update interval in daemon mode (NULL for default)
+  bpgroup_filled   boolean NOT NULL DEFAULT true  -- false until back-patch groups are assigned to old commits
 );
 
  CREATE TABLE IF NOT EXISTS repository_info
 (
-  project  text NOT NULL,
-  branch   text NOT NULL,
+  project      text NOT NULL,
+  branch       text NOT NULL,
+  tipcommitid  text,          -- commitid of the last ingested tip
   PRIMARY KEY(project, branch)
 );
 
+CREATE TABLE IF NOT EXISTS branch_stats
+(
+  project      text        NOT NULL,
+  branch       text        NOT NULL,
+  commits      bigint      NOT NULL,  -- Number of commits in "_branch"
+  newest       timestamptz,           -- commitdate of the newest commit
+  oldest       timestamptz,           -- commitdate of the oldest commit
+  lastingested timestamptz NOT NULL default now(),  -- Time when commits are ingested at last
+  PRIMARY KEY(project, branch)
+);
+
+CREATE TABLE IF NOT EXISTS keyword_info
+(
+  project      text    NOT NULL,
+  keyword      text    NOT NULL,
+  usage        integer NOT NULL,  -- Number of investigations having this keyword
+  PRIMARY KEY(project, keyword)
+);
+
+-- For prefix search (autocomplete) of keywords, regardless of collation
+CREATE INDEX keyword_info_prefix_idx ON keyword_info (project, keyword text_pattern_ops);
+
+CREATE TABLE IF NOT EXISTS remote_info
+(
+  project      text        NOT NULL,
+  remote       text        NOT NULL,
+  updatetime   timestamptz NOT NULL default now(),
+  succeeded    boolean     NOT NULL,  -- Result of the last push
+  attempts     integer     NOT NULL,  -- Number of attempts of the last push
+  duration     interval    NOT NULL,  -- Duration of the last push (including retries)
+  message      text,                  -- Error message of the last attempt
+  lastsuccess  timestamptz,           -- Time of the last successful push
+  PRIMARY KEY(project, remote)
+);
+
 CREATE TABLE IF NOT EXISTS _branch
 (
   project      text        NOT NULL,
@@ -53,6 +94,10 @@ PARTITION BY list ( project );
 
 CREATE INDEX _branch_commitdate_brin ON _branch USING brin(commitdate);
 CREATE INDEX _branch_commitid_hash ON _branch USING hash(commitid);
+-- For searching commits by a prefix of commitid (regardless of collation)
+CREATE INDEX _branch_commitid_prefix_idx ON _branch (commitid text_pattern_ops);
+-- For keyset pagination of each branch (in order of "commitdate DESC, scommitid")
+CREATE INDEX _branch_keyset_idx ON _branch (commitdate DESC, scommitid) INCLUDE (commitid, commitdate_l, timezone_int);
 
 CREATE TABLE IF NOT EXISTS _commitinfo
 (
@@ -62,12 +107,22 @@ CREATE TABLE IF NOT EXISTS _commitinfo
   author       text        NOT NULL,
   committer    text        NOT NULL,
   commitlog    text        NOT NULL,
+  summary      text        NOT NULL,  -- First line of commitlog
+  patchid      text,                  -- patch-id ("git patch-id --stable")
+  msgid        text,                  -- Fingerprint of commitlog
+  bpgroup      text        NOT NULL,  -- commitid of the first commit in the back-patch group
   children     text[],
   PRIMARY KEY(project, commitid)
 )
 PARTITION BY list ( project );
 
 CREATE INDEX _commitinfo_commitlog_hash ON _commitinfo USING hash(commitlog);
+-- For searching parents of a commit
+CREATE INDEX _commitinfo_children_gin ON _commitinfo USING gin(children);
+-- For assigning and searching back-patch groups
+CREATE INDEX _commitinfo_patchid_idx ON _commitinfo (patchid);
+CREATE INDEX _commitinfo_msgid_idx ON _commitinfo (msgid);
+CREATE INDEX _commitinfo_bpgroup_idx ON _commitinfo (bpgroup);
 
 CREATE TABLE IF NOT EXISTS _investigation
 (
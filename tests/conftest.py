@@ -0,0 +1,119 @@
+# Copyright (C) 2020-2022 Kondo Taiki
+#
+# This file is part of "pgmaster2".
+#
+# "pgmaster2" is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# "pgmaster2" is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with "pgmaster2".  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import subprocess
+import uuid
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+class work_repository:
+  """
+  work_repository - Non-bare git repository to make commits for tests
+  """
+  def __init__(self, path):
+    self.path = str(path)
+    self._tick = 0
+    os.makedirs(self.path, exist_ok = True)
+    self.git(u'init', u'-q', u'-b', u'master')
+    return
+
+  def git(self, *args, env=None):
+    """
+    git() - Run git command in this repository, and return its output
+    """
+    e = dict(os.environ)
+    e.update({
+      'GIT_AUTHOR_NAME'     : u'Author',
+      'GIT_AUTHOR_EMAIL'    : u'author@example.com',
+      'GIT_COMMITTER_NAME'  : u'Committer',
+      'GIT_COMMITTER_EMAIL' : u'committer@example.com',
+    })
+    if env is not None:
+      e.update(env)
+    return subprocess.run(
+      [u'git', u'-C', self.path] + list(args),
+      check = True, stdout = subprocess.PIPE, env = e, universal_newlines = True
+    ).stdout.strip()
+
+  def commit(self, message, files = None, author = None):
+    """
+    commit() - Write files and make a commit, and return its commit id
+    message : commit message
+    files   : dict of file name and its content (or None to make an empty commit)
+    author  : author name (or None to use the default)
+    """
+    for (name, content) in (files or {}).items():
+      path = os.path.join(self.path, name)
+      os.makedirs(os.path.dirname(path), exist_ok = True)
+      with open(path, 'w') as f:
+        f.write(content)
+      self.git(u'add', name)
+    # Give each commit its own date, so the order of log is stable.
+    self._tick += 1
+    date = u'%d +0900' % (1600000000 + self._tick * 60)
+    env = {'GIT_AUTHOR_DATE' : date, 'GIT_COMMITTER_DATE' : date}
+    if author is not None:
+      env['GIT_AUTHOR_NAME'] = author
+    self.git(u'commit', u'-q', u'--allow-empty', u'-m', message, env = env)
+    return self.git(u'rev-parse', u'HEAD')
+
+@pytest.fixture
+def work_repo(tmp_path):
+  """
+  work_repo - Empty working repository
+  """
+  return work_repository(tmp_path / u'work')
+
+@pytest.fixture
+def pg_connect():
+  """
+  pg_connect - Function to connect to the test database, with tables of sql/ddl.sql in a temporary schema
+  Skipped unless PGMASTER_TEST_DSN is set.
+  """
+  psycopg2 = pytest.importorskip('psycopg2')
+  dsn = os.environ.get('PGMASTER_TEST_DSN')
+  if not dsn:
+    pytest.skip(u'PGMASTER_TEST_DSN is not set.')
+
+  schema = u'pgmaster_test_%s' % uuid.uuid4().hex[:8]
+  conns = []
+  def connect():
+    conn = psycopg2.connect(dsn, options = u'-c search_path=%s' % schema)
+    conns.append(conn)
+    return conn
+  # end of nested (internal) function
+
+  conn = connect()
+  with conn.cursor() as cursor:
+    cursor.execute(u'CREATE SCHEMA %s' % schema)
+    with open(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), u'sql', u'ddl.sql')) as f:
+      cursor.execute(f.read())
+  conn.commit()
+  try:
+    yield connect
+  finally:
+    for c in conns:
+      c.rollback()
+    with conn.cursor() as cursor:
+      cursor.execute(u'DROP SCHEMA %s CASCADE' % schema)
+    conn.commit()
+    for c in conns:
+      c.close()
@@ -0,0 +1,179 @@
+# Copyright (C) 2020-2022 Kondo Taiki
+#
+# This file is part of "pgmaster2".
+#
+# "pgmaster2" is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# "pgmaster2" is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with "pgmaster2".  If not, see <http://www.gnu.org/licenses/>.
+
+import importlib
+import subprocess
+
+import pytest
+
+@pytest.fixture
+def pgmaster(tmp_path, monkeypatch):
+  """
+  pgmaster - Web application module (pgmaster.py), configured by a dummy pgmaster.ini
+  """
+  pytest.importorskip('flask')
+  with open(tmp_path / u'pgmaster.ini', 'w') as f:
+    f.write(u'[PGMASTER]\nServer = localhost\nPort = 5432\nDatabase = pgmaster\nUser = pgmaster\nPassword = \nPooling = 0\n')
+  monkeypatch.chdir(tmp_path)
+  return importlib.import_module('pgmaster')
+
+class test_connection:
+  """
+  test_connection - pg_connection like object to connect to the test database (see pg_connect)
+  """
+  def __init__(self, pg_connect):
+    self._connect = pg_connect
+
+  def connect(self):
+    return self._connect()
+
+  def close(self, conn):
+    conn.rollback()
+
+def test_validate_cursor(pgmaster):
+  assert pgmaster.validate_cursor({}) is None
+  assert pgmaster.validate_cursor({'page' : u'2'}) is None
+  assert pgmaster.validate_cursor({'after' : u'1600000000_0123abc'}) == (True, 1600000000, u'0123abc')
+  assert pgmaster.validate_cursor({'before' : u'1600000000_0123abc'}) == (False, 1600000000, u'0123abc')
+  # "after" is used if both are specified.
+  assert pgmaster.validate_cursor({'after' : u'1_abcdef', 'before' : u'2_abcdef'}) == (True, 1, u'abcdef')
+
+  # Cursor made by make_cursor() is accepted as is.
+  assert pgmaster.validate_cursor({'after' : pgmaster.make_cursor(1600000000, u'0123abc')}) == (True, 1600000000, u'0123abc')
+
+  for value in (u'1600000000', u'1600000000_', u'1600000000_abcde', u'1600000000_' + u'a' * 41,
+      u'1600000000_0123xyz', u'x_0123abc', u'_0123abc'):
+    with pytest.raises(ValueError):
+      pgmaster.validate_cursor({'after' : value})
+
+def test_branch_keyset_pagination(pgmaster, pg_connect, monkeypatch):
+  conn = pg_connect()
+  # Some commits have the same commitdate, so they are ordered by scommitid.
+  commits = [
+    (u'a000001', 1600000300),
+    (u'b000002', 1600000200),
+    (u'c000003', 1600000200),
+    (u'0000004', 1600000100),
+    (u'd000005', 1600000100),
+    (u'e000006', 1600000100),
+    (u'f000007', 1600000000),
+  ]
+  with conn.cursor() as cursor:
+    cursor.execute(u"""
+      CREATE TABLE branch_proj PARTITION OF _branch FOR VALUES IN ('proj');
+      CREATE TABLE commitinfo_proj PARTITION OF _commitinfo FOR VALUES IN ('proj');
+      INSERT INTO branch_stats (project, branch, commits) VALUES ('proj', 'master', %s)""",
+      [len(commits)])
+    for (sid, date) in reversed(commits):
+      cursor.execute(u"""
+        INSERT INTO _branch (project, branch, commitid, scommitid, commitdate, commitdate_l, timezone_int)
+          VALUES ('proj', 'master', %s, %s, to_timestamp(%s), to_timestamp(%s)::timestamp, 0);
+        INSERT INTO _commitinfo (project, commitid, author, committer, commitlog, summary, bpgroup)
+          VALUES ('proj', %s, 'a', 'c', %s, %s, %s)""",
+        [sid + u'0' * 33, sid, date, date, sid + u'0' * 33, sid, sid, sid + u'0' * 33])
+  conn.commit()
+
+  pages = []
+  def render_template(template, **kwargs):
+    pages.append(kwargs)
+    return u''
+  # end of nested (internal) function
+
+  monkeypatch.setattr(pgmaster, 'pg_conn', test_connection(pg_connect))
+  monkeypatch.setattr(pgmaster, 'render_template', render_template)
+  client = pgmaster.app.test_client()
+
+  def get(url):
+    response = client.get(url)
+    assert response.status_code == 200
+    page = pages.pop()
+    return ([c['sid'] for c in page['commits']], page['urls'])
+  # end of nested (internal) function
+
+  expected = [sid for (sid, date) in commits]
+
+  # Walk to the oldest page by "after" cursors, from the first page (by page number).
+  (sids, urls) = get(u'/p/proj/b/master/?page=1&num=2')
+  assert sids == expected[0:2]
+  assert urls['newer'] is None
+  walked = [sids]
+  while urls['older'] is not None:
+    (sids, urls) = get(urls['older'])
+    assert urls['newer'] is not None
+    walked.append(sids)
+  assert walked == [expected[i:i + 2] for i in range(0, len(expected), 2)]
+
+  # And walk back to the newest page by "before" cursors.
+  walked = [sids]
+  while urls['newer'] is not None:
+    (sids, urls) = get(urls['newer'])
+    assert urls['older'] is not None
+    walked.append(sids)
+  assert walked == [expected[i:i + 2] for i in range(0, len(expected), 2)][::-1]
+
+  # Cursor at the middle of commits with the same commitdate.
+  (sids, urls) = get(u'/p/proj/b/master/?num=2&after=%s' % pgmaster.make_cursor(1600000100, u'0000004'))
+  assert sids == [u'd000005', u'e000006']
+  (sids, urls) = get(u'/p/proj/b/master/?num=2&before=%s' % pgmaster.make_cursor(1600000100, u'e000006'))
+  assert sids == [u'0000004', u'd000005']
+
+  # Broken cursor is rejected, and nothing beyond the edge is found.
+  assert client.get(u'/p/proj/b/master/?num=2&after=1600000000_xyz').status_code == 403
+  assert client.get(u'/p/proj/b/master/?num=2&after=%s' % pgmaster.make_cursor(1600000000, u'f000007')).status_code == 404
+
+def test_investigate_etag_backpatches(pgmaster, pg_connect, work_repo, tmp_path, monkeypatch):
+  c1 = work_repo.commit(u'Fix typo.', {u'a.txt' : u'a\n'})
+  work_repo.git(u'checkout', u'-q', u'-b', u'rel1')
+  c2 = work_repo.commit(u'Fix typo.', {u'b.txt' : u'b\n'})
+  subprocess.run([u'git', u'clone', u'-q', u'--mirror', work_repo.path, str(tmp_path / u'git' / u'proj.git')], check = True)
+  open(tmp_path / u'git' / u'.lock.proj', 'w').close()
+
+  conn = pg_connect()
+  with conn.cursor() as cursor:
+    cursor.execute(u"""
+      CREATE TABLE branch_proj PARTITION OF _branch FOR VALUES IN ('proj');
+      CREATE TABLE commitinfo_proj PARTITION OF _commitinfo FOR VALUES IN ('proj');
+      INSERT INTO project_info (project) VALUES ('proj');
+      INSERT INTO branch_stats (project, branch, commits) VALUES ('proj', 'master', 1), ('proj', 'rel1', 1)""")
+    for (commit_id, branch) in ((c1, u'master'), (c2, u'rel1')):
+      cursor.execute(u"""
+        INSERT INTO _branch (project, branch, commitid, scommitid, commitdate, commitdate_l, timezone_int)
+          VALUES ('proj', %s, %s, %s, now(), now(), 0);
+        INSERT INTO _commitinfo (project, commitid, author, committer, commitlog, summary, bpgroup)
+          VALUES ('proj', %s, 'Author', 'Committer', 'Fix typo.', 'Fix typo.', %s)""",
+        [branch, commit_id, commit_id[:7], commit_id, commit_id])
+  conn.commit()
+
+  monkeypatch.setattr(pgmaster, 'pg_conn', test_connection(pg_connect))
+  monkeypatch.setattr(pgmaster, 'render_template', lambda template, **kwargs: u'')
+  monkeypatch.setitem(pgmaster.app.config, 'GIT_REPOSITORIES', pgmaster.pgmaster_utils.git_repositories(str(tmp_path / u'git')))
+  monkeypatch.setitem(pgmaster.app.config, 'DIFF_CACHE', None)
+  client = pgmaster.app.test_client()
+  url = u'/p/proj/b/master/c/%s/' % (c1)
+
+  response = client.get(url)
+  assert response.status_code == 200
+  etag = response.get_etag()[0]
+  assert client.get(url, headers = {'If-None-Match' : u'"%s"' % (etag)}).status_code == 304
+
+  # Group of the other commit is changed later (see recheck_bpgroups() of update_master.py).
+  with conn.cursor() as cursor:
+    cursor.execute(u"UPDATE _commitinfo SET bpgroup = %s WHERE commitid = %s", [c1, c2])
+  conn.commit()
+  response = client.get(url, headers = {'If-None-Match' : u'"%s"' % (etag)})
+  assert response.status_code == 200
+  assert response.get_etag()[0] != etag
@@ -0,0 +1,66 @@
+# Copyright (C) 2020-2022 Kondo Taiki
+#
+# This file is part of "pgmaster2".
+#
+# "pgmaster2" is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# "pgmaster2" is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with "pgmaster2".  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+
+import pytest
+
+import pgmaster_cache
+
+def test_get_put(tmp_path):
+  cache = pgmaster_cache.diff_cache(str(tmp_path), 1024 * 1024)
+  key = u'0123456789abcdef0123456789abcdef01234567'
+  assert cache.get(key) is None
+  assert not cache.contains(key)
+
+  assert cache.put(key, {'files' : [], 'diffs' : [u'あ']})
+  assert cache.contains(key)
+  assert cache.get(key) == {'files' : [], 'diffs' : [u'あ']}
+
+  # Key is never used as a path as it is.
+  with pytest.raises(ValueError):
+    cache.get(u'../' + key[3:])
+
+def test_evict(tmp_path):
+  # Files are written through another instance (e.g. of another process) without the limit.
+  writer = pgmaster_cache.diff_cache(str(tmp_path), 1024 * 1024, check_interval = 3600.0)
+  cache = pgmaster_cache.diff_cache(str(tmp_path), 1000, check_interval = 3600.0)
+  keys = [u'%040x' % i for i in range(5)]
+  for (i, key) in enumerate(keys):
+    # 302 bytes in UTF-8
+    writer.put(key, u'あ' * 100)
+    os.utime(writer._path(key), (1000000 + i, 1000000 + i))
+  # Written size is counted in bytes, not in characters (since checked at the first one).
+  assert writer._written == 4 * 302
+
+  # Least recently used ones are removed down to 90% of the limit.
+  assert cache.evict() == 3
+  assert [cache.contains(key) for key in keys] == [False, False, False, True, True]
+  assert cache.evict() == 0
+
+def test_evict_in_background(tmp_path):
+  cache = pgmaster_cache.diff_cache(str(tmp_path), 1000, check_interval = 3600.0)
+  keys = [u'%040x' % i for i in range(5)]
+  for key in keys:
+    cache.put(key, u'あ' * 100)
+
+  # Checked after more than 10% of the limit is written, without waiting for it.
+  deadline = time.monotonic() + 10.0
+  while sum([cache.contains(key) for key in keys]) > 2 and time.monotonic() < deadline:
+    time.sleep(0.01)
+  assert sum([cache.contains(key) for key in keys]) <= 2
@@ -0,0 +1,235 @@
+# Copyright (C) 2020-2022 Kondo Taiki
+#
+# This file is part of "pgmaster2".
+#
+# "pgmaster2" is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# "pgmaster2" is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with "pgmaster2".  If not, see <http://www.gnu.org/licenses/>.
+
+import subprocess
+
+import git
+
+import pgmaster_cache
+import pgmaster_utils
+
+def test_git_diff_files(work_repo):
+  work_repo.commit(u'first', {u'a.txt' : u'a\nb\nc\n', u'old.txt' : u'moved\n' * 10})
+  work_repo.git(u'mv', u'old.txt', u'new.txt')
+  with open(work_repo.path + u'/bin.dat', 'wb') as f:
+    f.write(b'\0\1\2')
+  work_repo.git(u'add', u'bin.dat')
+  second = work_repo.commit(u'second', {u'a.txt' : u'a\nB\nc\nd\n'})
+  repo = git.Repo(work_repo.path)
+
+  files = pgmaster_utils.git_diff_files(repo.commit(second))
+  assert [(f['index'], f['path'], f['old_path'], f['added'], f['deleted'], f['binary']) for f in files] == [
+    (0, u'a.txt', None, 2, 1, False),
+    (1, u'bin.dat', None, None, None, True),
+    (2, u'new.txt', u'old.txt', 0, 0, False)
+  ]
+
+  # Root commit is compared with the empty tree.
+  root = pgmaster_utils.git_diff_files(repo.commit(second).parents[0])
+  assert [(f['path'], f['added']) for f in root] == [(u'a.txt', 3), (u'old.txt', 10)]
+
+def test_git_file_patch(work_repo):
+  first = work_repo.commit(u'first', {u'a.txt' : u''.join([u'line %d\n' % i for i in range(100)])})
+  repo = git.Repo(work_repo.path)
+  file = pgmaster_utils.git_diff_files(repo.commit(first))[0]
+
+  (patch, truncated) = pgmaster_utils.git_file_patch(repo.commit(first), file, 1024 * 1024)
+  assert not truncated
+  assert u'+line 99\n' in patch
+
+  # Truncated at the end of a line.
+  (patch, truncated) = pgmaster_utils.git_file_patch(repo.commit(first), file, 300)
+  assert truncated
+  assert len(patch.encode('utf-8')) <= 300
+  assert patch.endswith(u'\n')
+
+def test_git_file_patch_literal(work_repo):
+  # Each of them matches the others as pathspec.
+  names = [u'a[1].txt', u'a1.txt', u'a*.txt', u':(glob)a?.txt']
+  first = work_repo.commit(u'first', {name : name + u'\n' for name in names})
+  repo = git.Repo(work_repo.path)
+
+  for file in pgmaster_utils.git_diff_files(repo.commit(first)):
+    (patch, truncated) = pgmaster_utils.git_file_patch(repo.commit(first), file, 1024 * 1024)
+    assert [line for line in patch.splitlines() if line.startswith(u'+++ ')] == [u'+++ b/' + file['path']]
+
+def test_load_diffs(work_repo, tmp_path, monkeypatch):
+  first = work_repo.commit(u'first', {u'a.txt' : u'a\n', u'b.txt' : u'b\n'})
+  repo = git.Repo(work_repo.path)
+  cache = pgmaster_cache.diff_cache(str(tmp_path / u'cache'), 1024 * 1024)
+
+  calls = []
+  git_diff_files = pgmaster_utils.git_diff_files
+  monkeypatch.setattr(pgmaster_utils, 'git_diff_files', lambda commit: calls.append(commit) or git_diff_files(commit))
+
+  # List of files is cached without patches if lazy.
+  (files, diffs) = pgmaster_utils.load_diffs(repo.commit(first), cache, lambda files: len(files) > 1)
+  assert [f['path'] for f in files] == [u'a.txt', u'b.txt']
+  assert diffs is None
+  assert cache.get(first)['diffs'] is None
+
+  # Patches are added to the cached entry, without listing files again.
+  (files, diffs) = pgmaster_utils.load_diffs(repo.commit(first), cache)
+  assert len(diffs) == 2
+  assert (files, diffs) == pgmaster_utils.load_diffs(repo.commit(first), cache)
+  assert pgmaster_utils.load_diffs(repo.commit(first), cache, lazy = True) == (files, None)
+  assert len(calls) == 1
+
+  # Without cache, the repository is read every time.
+  assert pgmaster_utils.load_diffs(repo.commit(first)) == (files, diffs)
+  assert len(calls) == 2
+
+def test_message_fingerprint():
+  fingerprint = pgmaster_utils.message_fingerprint(u'Fix a bug\n\nDetails  here.\n')
+  assert fingerprint == pgmaster_utils.message_fingerprint(
+    u'fix a  BUG\n\nDetails here.\n\n(cherry picked from commit 0123456789abcdef)\n')
+  assert fingerprint != pgmaster_utils.message_fingerprint(u'Fix another bug\n')
+  assert pgmaster_utils.message_fingerprint(u'\n \n') is None
+
+def test_git_patch_ids(work_repo):
+  base = work_repo.commit(u'base', {u'a.txt' : u'1\n2\n3\n', u'b.txt' : u'x\n'})
+  fix = work_repo.commit(u'Fix', {u'a.txt' : u'1\nTWO\n3\n'})
+  work_repo.git(u'checkout', u'-q', u'-b', u'rel1', base)
+  work_repo.commit(u'Other change', {u'b.txt' : u'y\n'})
+  work_repo.git(u'cherry-pick', u'-x', fix)
+  picked = work_repo.git(u'rev-parse', u'HEAD')
+  empty = work_repo.commit(u'Empty')
+  repo = git.Repo(work_repo.path)
+
+  # Same patch-id is given to back-patched commit, and commit without changes has no patch-id.
+  patch_ids = pgmaster_utils.git_patch_ids(repo, [base, fix, picked, empty])
+  assert sorted(patch_ids.keys()) == sorted([base, fix, picked])
+  assert patch_ids[fix] == patch_ids[picked]
+  assert patch_ids[fix] != patch_ids[base]
+
+  assert pgmaster_utils.git_existing_commits(repo, [fix, u'0' * 40, picked]) == [fix, picked]
+
+def import_blobs(work_repo, count):
+  """
+  import_blobs() - Add many blobs at once, to make prefixes of object ids ambiguous
+  """
+  stream = u''.join([u'blob\ndata %d\n%s\n' % (len(u'%d' % i), u'%d' % i) for i in range(count)])
+  subprocess.run([u'git', u'-C', work_repo.path, u'fast-import', u'--quiet'],
+    input = stream.encode('ascii'), check = True)
+
+def batch_check(work_repo, names):
+  """
+  batch_check() - Resolve names of objects by git at once
+  Returns list of object ids, or "ambiguous" or "missing".
+  """
+  out = subprocess.run([u'git', u'-C', work_repo.path, u'cat-file', u'--batch-check=%(objectname)'],
+    input = u''.join([x + u'\n' for x in names]).encode('ascii'), stdout = subprocess.PIPE, check = True).stdout
+  return [line.split()[-1] for line in out.decode('ascii').splitlines()]
+
+def assert_minimal(work_repo, result, min_length):
+  """
+  assert_minimal() - Check short commit ids are unique, and minimal as "git rev-parse --short"
+  """
+  assert batch_check(work_repo, list(result.values())) == list(result.keys())
+  longer = [x for x in result.values() if len(x) > min_length]
+  assert batch_check(work_repo, [x[:-1] for x in longer]) == [u'ambiguous'] * len(longer)
+  assert all([len(x) >= min_length for x in result.values()])
+
+def test_git_abbrev(work_repo):
+  import_blobs(work_repo, 2000)
+  commits = [work_repo.commit(u'commit %d' % i) for i in range(3)]
+  objects = work_repo.git(u'cat-file', u'--batch-all-objects', u'--batch-check=%(objectname)').split()
+
+  # Same as "git rev-parse --short", including ambiguous prefixes longer than the minimum.
+  abbrev = pgmaster_utils.git_abbrev(work_repo.path + u'/.git', min_length = 4)
+  result = abbrev.abbrev(objects)
+  assert_minimal(work_repo, result, 4)
+  assert max([len(x) for x in result.values()]) > 4
+  assert abbrev.short(commits[0]) == result[commits[0]]
+
+def test_git_abbrev_refresh(work_repo, tmp_path):
+  import_blobs(work_repo, 2000)
+  first = work_repo.commit(u'first')
+  abbrev = pgmaster_utils.git_abbrev(work_repo.path + u'/.git', min_length = 4)
+  objects = work_repo.git(u'cat-file', u'--batch-all-objects', u'--batch-check=%(objectname)').split()
+  assert_minimal(work_repo, abbrev.abbrev(objects), 4)
+
+  # New loose objects don't change the signature of the repository,
+  # but the index is reloaded when unknown commit is given, and prefixes of others are changed.
+  paths = []
+  for i in range(2000):
+    path = tmp_path / (u'loose%d' % i)
+    path.write_text(u'loose %d\n' % i)
+    paths.append(str(path))
+  subprocess.run([u'git', u'-C', work_repo.path, u'hash-object', u'-w', u'--stdin-paths'],
+    input = u'\n'.join(paths).encode('utf-8'), stdout = subprocess.DEVNULL, check = True)
+  second = work_repo.commit(u'second')
+  assert_minimal(work_repo, abbrev.abbrev([second] + objects), 4)
+
+  # New pack changes the signature, so the index is reloaded even if all of given objects are known.
+  import_blobs(work_repo, 6000)
+  assert_minimal(work_repo, abbrev.abbrev([first] + objects), 4)
+
+def test_git_log_records(work_repo):
+  # A - B ----- M1 - D - F - M2 - G   (master)
+  #  \         /     \       /
+  #   C ------        E -----         (topic, topic2)
+  a = work_repo.commit(u'A', {u'a.txt' : u'a\n'})
+  work_repo.git(u'branch', u'topic')
+  work_repo.commit(u'B', {u'b.txt' : u'b\n'})
+  work_repo.git(u'checkout', u'-q', u'topic')
+  c = work_repo.commit(u'C\n\nwith body\n', {u'c.txt' : u'c\n'}, author = u'Other')
+  work_repo.git(u'checkout', u'-q', u'master')
+  # Merge commits are dated between others (see work_repository.commit()), to read them by "since".
+  merge_date = lambda seconds: {'GIT_AUTHOR_DATE' : u'%d +0900' % (seconds), 'GIT_COMMITTER_DATE' : u'%d +0900' % (seconds)}
+  work_repo.git(u'merge', u'-q', u'--no-ff', u'-m', u'M1', u'topic', env = merge_date(1600000210))
+  m1 = work_repo.git(u'rev-parse', u'HEAD')
+  d = work_repo.commit(u'D', {u'd.txt' : u'd\n'})
+  work_repo.git(u'checkout', u'-q', u'-b', u'topic2')
+  e = work_repo.commit(u'E', {u'e.txt' : u'e\n'})
+  work_repo.git(u'checkout', u'-q', u'master')
+  f = work_repo.commit(u'F', {u'f.txt' : u'f\n'})
+  work_repo.git(u'merge', u'-q', u'--no-ff', u'-m', u'M2', u'topic2', env = merge_date(1600000390))
+  g = work_repo.commit(u'G', {u'g.txt' : u'g\n'})
+  repo = git.Repo(work_repo.path)
+
+  # With "since", M1 (or M2) is out of the range without being a boundary.
+  for (rev, since) in ((u'master', None), (u'%s..master' % (a), None), (u'%s..master' % (m1), None),
+      (u'%s..master' % (d), None), (u'%s..master' % (c), None), (u'master', u'@1600000220'), (u'master', u'@1600000400')):
+    records = list(pgmaster_utils.git_log_records(repo, rev, since))
+
+    # Only non-merge commits are read, from oldest to latest.
+    expected = work_repo.git(u'rev-list', u'--no-merges', u'--reverse', u'--topo-order',
+      *([rev] if since is None else [u'--since=' + since, rev])).split()
+    assert sorted([r.hexsha for r in records]) == sorted(expected)
+    read = set()
+    for r in records:
+      assert all([p not in expected or p in read for p in r.parents or []])
+      read.add(r.hexsha)
+
+    # Same as reading each commit by GitPython.
+    # Parents of merge commits (even if out of the range) are searched instead of merge commits.
+    for r in records:
+      commit = repo.commit(r.hexsha)
+      assert r.parents == pgmaster_utils.git_ancestor(commit)
+      assert (r.authored_date, r.author_tz_offset) == (commit.authored_date, commit.author_tz_offset)
+      assert (r.author_name, r.committer_name, r.message) == (commit.author.name, commit.committer.name, commit.message)
+
+  # Parents of D are B and C, through M1 at the boundary.
+  records = list(pgmaster_utils.git_log_records(repo, u'%s..master' % (m1)))
+  assert records[0].hexsha == d
+  assert records[0].parents == [repo.commit(m1).parents[0].hexsha, c]
+
+  # Parents of G are F and E, through M2 older than "since".
+  records = list(pgmaster_utils.git_log_records(repo, u'master', u'@1600000400'))
+  assert [r.hexsha for r in records] == [g]
+  assert records[0].parents == [f, e]
@@ -0,0 +1,372 @@
+# Copyright (C) 2020-2022 Kondo Taiki
+#
+# This file is part of "pgmaster2".
+#
+# "pgmaster2" is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# "pgmaster2" is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with "pgmaster2".  If not, see <http://www.gnu.org/licenses/>.
+
+import queue
+import subprocess
+import threading
+
+import git
+import pytest
+
+import update_master
+
+def test_fetch_staging_keeps_refs(work_repo, tmp_path):
+  first = work_repo.commit(u'first')
+  mirror_path = str(tmp_path / u'mirror.git')
+  subprocess.run([u'git', u'clone', u'-q', u'--mirror', work_repo.path, mirror_path], check = True)
+  mirror = git.Repo(mirror_path)
+  assert mirror.git.config(u'remote.origin.fetch') == u'+refs/*:refs/*'
+
+  second = work_repo.commit(u'second')
+  work_repo.git(u'branch', u'rel1')
+
+  # Only staging refs are written, even though the configured refspec covers refs/*.
+  update_master.fetch_staging(mirror)
+  assert mirror.git.rev_parse(u'refs/heads/master') == first
+  assert mirror.git.for_each_ref(u'refs/heads/rel1') == u''
+  assert mirror.git.rev_parse(update_master.STAGING_REFS + u'heads/master') == second
+  assert mirror.git.rev_parse(update_master.STAGING_REFS + u'heads/rel1') == second
+
+  update_master.switch_staging(mirror)
+  assert mirror.git.rev_parse(u'refs/heads/master') == second
+  assert mirror.git.rev_parse(u'refs/heads/rel1') == second
+
+def test_bulk_swap_partition(pg_connect):
+  psycopg2 = pytest.importorskip('psycopg2')
+  conn = pg_connect()
+  with conn.cursor() as cursor:
+    cursor.execute(u"""
+      CREATE TABLE commitinfo_proj PARTITION OF _commitinfo FOR VALUES IN ('proj');
+      INSERT INTO _commitinfo (project, commitid, author, committer, commitlog, summary, bpgroup)
+        VALUES ('proj', 'old', 'a', 'c', 'old commit', 'old commit', 'old')""")
+  conn.commit()
+
+  reader = pg_connect()
+  def count():
+    with reader.cursor() as cursor:
+      cursor.execute(u"SET lock_timeout = '200ms'")
+      cursor.execute(u"SELECT count(*) FROM _commitinfo WHERE project = 'proj'")
+      n = cursor.fetchone()[0]
+    reader.commit()
+    return n
+  # end of nested (internal) function
+
+  with conn.cursor() as cursor:
+    (swap, rows) = update_master.build_partition(cursor, update_master.get_table(cursor, u'_commitinfo'), u'proj',
+      psycopg2.sql.SQL(u"""(project, commitid, author, committer, commitlog, summary, bpgroup)
+        SELECT 'proj', x, 'a', 'c', 'new commit', 'new commit', x FROM unnest(%s::text[]) AS x"""),
+      [[u'new1', u'new2']])
+    assert rows == 2
+
+    # Readers are not blocked while building.
+    assert count() == 1
+
+    # Readers are blocked after swapping, until commit.
+    update_master.swap_partition(cursor, swap)
+    with pytest.raises(psycopg2.errors.LockNotAvailable):
+      count()
+    reader.rollback()
+  conn.commit()
+  assert count() == 2
+
+  # New partition has the same name, indexes and constraints as the old one (and no others).
+  with conn.cursor() as cursor:
+    cursor.execute(u"""SELECT
+        c.relname,
+        (SELECT array_agg(i.indexrelid::regclass::text ORDER BY 1) FROM pg_index i WHERE i.indrelid = c.oid),
+        (SELECT array_agg(k.conname::text ORDER BY 1) FROM pg_constraint k WHERE k.conrelid = c.oid)
+      FROM
+        pg_inherits h
+        JOIN pg_class c ON c.oid = h.inhrelid
+      WHERE
+        h.inhparent = '_commitinfo'::regclass""")
+    (name, indexes, constraints) = cursor.fetchone()
+  assert name == u'commitinfo_proj'
+  assert u'commitinfo_proj_pkey' in indexes
+  assert all([not x.startswith(u'_bulk_') for x in indexes])
+  assert constraints == [u'commitinfo_proj_pkey']
+
+DAY = 24 * 60 * 60
+
+def test_assign_bpgroups():
+  groups = update_master.assign_bpgroups([
+    (u'c1', u'alice', u'p1', u'm1', 0),
+    (u'c2', u'alice', u'p1', u'm2', 60),   # Same patch, message is edited.
+    (u'c3', u'alice', u'p3', u'm1', 120),  # Same message, patch is conflicted.
+    (u'c4', u'bob',   u'p1', u'm1', 180),  # Other author.
+    (u'c5', u'alice', None,  None,  240),  # Empty commit without message.
+    (u'c6', u'alice', None,  None,  300)
+  ])
+  assert groups == {u'c1' : u'c1', u'c2' : u'c1', u'c3' : u'c1', u'c4' : u'c4', u'c5' : u'c5', u'c6' : u'c6'}
+
+  # Groups of commits inserted before are kept.
+  known = {}
+  update_master.assign_bpgroups([(u'c1', u'alice', u'p1', u'm1', 0)], known)
+  assert update_master.assign_bpgroups([
+    (u'c1', u'alice', u'p9', u'm9', 0),
+    (u'c2', u'alice', None, u'm1', 60)
+  ], known) == {u'c1' : u'c1', u'c2' : u'c1'}
+
+def test_assign_bpgroups_window():
+  # Same short message (or same trivial patch) is grouped only within 1 day from the first commit of the group.
+  groups = update_master.assign_bpgroups([
+    (u'c1', u'alice', None,  u'typo', 0),
+    (u'c2', u'alice', None,  u'typo', DAY),
+    (u'c3', u'alice', None,  u'typo', DAY + 60),      # Far from c1, even though near c2.
+    (u'c4', u'alice', u'p1', u'typo', DAY * 365),
+    (u'c5', u'alice', u'p1', None,    DAY * 365 + 60),
+    (u'c6', u'alice', u'p1', None,    DAY * 730),
+  ])
+  assert groups == {u'c1' : u'c1', u'c2' : u'c1', u'c3' : u'c3', u'c4' : u'c4', u'c5' : u'c4', u'c6' : u'c6'}
+
+  # Back-patched commit older than the first one of the group (ingested later) is also grouped.
+  known = {}
+  update_master.assign_bpgroups([(u'c1', u'alice', u'p1', None, DAY * 10)], known)
+  assert update_master.assign_bpgroups([
+    (u'c0', u'alice', u'p1', None, DAY * 10 - 60),
+    (u'c9', u'alice', u'p1', None, DAY * 9 - 60)
+  ], known) == {u'c0' : u'c1', u'c9' : u'c9'}
+
+def insert_bpgroup_commit(cursor, commit, group):
+  """
+  insert_bpgroup_commit() - Insert a commit of tuple for assign_bpgroups() to "master" of "proj"
+  """
+  (commit_id, author, patch_id, fingerprint, commit_date) = commit
+  cursor.execute(u"""
+    INSERT INTO _branch (project, branch, commitid, scommitid, commitdate, commitdate_l, timezone_int)
+      VALUES ('proj', 'master', %s, %s, to_timestamp(%s), to_timestamp(%s)::timestamp, 0);
+    INSERT INTO _commitinfo (project, commitid, author, committer, commitlog, summary, patchid, msgid, bpgroup)
+      VALUES ('proj', %s, %s, %s, 'fix', 'fix', %s, %s, %s)""",
+    [commit_id, commit_id, commit_date, commit_date, commit_id, author, author, patch_id, fingerprint, group]
+  )
+
+def test_load_bpgroups_window(pg_connect):
+  conn = pg_connect()
+  with conn.cursor() as cursor:
+    cursor.execute(u"""
+      CREATE TABLE branch_proj PARTITION OF _branch FOR VALUES IN ('proj');
+      CREATE TABLE commitinfo_proj PARTITION OF _commitinfo FOR VALUES IN ('proj')""")
+    base = 1600000000
+    for commit in [(u'c1', u'alice', None, u'typo', base), (u'c2', u'alice', None, u'typo', base + DAY - 60)]:
+      insert_bpgroup_commit(cursor, commit, u'c1')
+
+    # Identical message years later is not merged, but it is merged on the next day.
+    assert update_master.load_bpgroups(cursor, u'proj', [
+      (u'c3', u'alice', None, u'typo', base + DAY * 365),
+      (u'c4', u'alice', None, u'typo', base + DAY * 365 + 60),
+      (u'c5', u'alice', None, u'typo', base + DAY - 30)
+    ]) == {u'c3' : u'c3', u'c4' : u'c3', u'c5' : u'c1'}
+  conn.commit()
+
+def test_recheck_bpgroups(pg_connect):
+  conn1 = pg_connect()
+  conn2 = pg_connect()
+  with conn1.cursor() as cursor:
+    cursor.execute(u"""
+      CREATE TABLE branch_proj PARTITION OF _branch FOR VALUES IN ('proj');
+      CREATE TABLE commitinfo_proj PARTITION OF _commitinfo FOR VALUES IN ('proj')""")
+  conn1.commit()
+
+  def insert(conn, commit_id):
+    commits = [(commit_id, u'alice', u'p1', None, 1600000000)]
+    with conn.cursor() as cursor:
+      groups = update_master.load_bpgroups(cursor, u'proj', commits)
+      insert_bpgroup_commit(cursor, commits[0], groups[commit_id])
+    return (commits, groups)
+  # end of nested (internal) function
+
+  # Both of them are assigned to their own groups, without seeing each other.
+  (commits1, groups1) = insert(conn1, u'c1')
+  (commits2, groups2) = insert(conn2, u'c2')
+  assert groups2 == {u'c2' : u'c2'}
+
+  with conn1.cursor() as cursor:
+    assert update_master.recheck_bpgroups(cursor, u'proj', commits1, groups1, [u'c1']) == 0
+  conn1.commit()
+  with conn2.cursor() as cursor:
+    assert update_master.recheck_bpgroups(cursor, u'proj', commits2, groups2, [u'c2']) == 1
+  conn2.commit()
+
+  with conn1.cursor() as cursor:
+    cursor.execute(u"SELECT commitid, bpgroup FROM _commitinfo ORDER BY 1")
+    assert cursor.fetchall() == [(u'c1', u'c1'), (u'c2', u'c1')]
+  conn1.commit()
+
+def test_build_children_map():
+  assert update_master.build_children_map([
+    (u'b', [u'a']),
+    (u'c', [u'a']),
+    (u'm', [u'b', u'c']),
+    (u'a', None)
+  ]) == {u'a' : {u'b', u'c'}, u'b' : {u'm'}, u'c' : {u'm'}}
+
+def test_update_children(pg_connect):
+  conn = pg_connect()
+  with conn.cursor() as cursor:
+    cursor.execute(u"""
+      CREATE TABLE commitinfo_proj PARTITION OF _commitinfo FOR VALUES IN ('proj');
+      INSERT INTO _commitinfo (project, commitid, author, committer, commitlog, summary, bpgroup, children)
+        SELECT 'proj', x, 'a', 'c', x, x, x, NULL FROM unnest(ARRAY['a', 'b', 'c']) AS x;
+      UPDATE _commitinfo SET children = '{x}' WHERE commitid = 'a'""")
+
+    # Children are merged with existing ones, and unknown parents are ignored.
+    children_map = update_master.build_children_map([(u'b', [u'a']), (u'c', [u'a', u'b']), (u'd', [u'z'])])
+    assert update_master.update_children(cursor, u'proj', children_map) == 2
+    cursor.execute(u"SELECT commitid, children FROM _commitinfo ORDER BY 1")
+    assert [(x, sorted(y or [])) for (x, y) in cursor.fetchall()] == [
+      (u'a', [u'b', u'c', u'x']),
+      (u'b', [u'c']),
+      (u'c', [])
+    ]
+
+    # Parents already having all of these children are not updated.
+    assert update_master.update_children(cursor, u'proj', children_map) == 0
+    assert update_master.update_children(cursor, u'proj', {}) == 0
+  conn.commit()
+
+def test_load_worker_reconnect(monkeypatch):
+  psycopg2 = pytest.importorskip('psycopg2')
+
+  class test_conn:
+    closed = 0
+
+  class test_connection:
+    def __init__(self):
+      self.conns = []
+      self.discarded = []
+      self.down = True
+
+    def connect(self):
+      if self.down:
+        raise psycopg2.OperationalError(u'could not connect to server')
+      self.conns.append(test_conn())
+      return self.conns[-1]
+
+    def close(self, conn, discard = False):
+      if discard:
+        self.discarded.append(conn)
+
+  loaded = []
+  def load_batch(conn, num, project, branch, entries):
+    if entries == [u'broken']:
+      raise psycopg2.OperationalError(u'server closed the connection unexpectedly')
+    loaded.append((conn, branch, entries))
+  # end of nested (internal) function
+
+  pg_conn = test_connection()
+  monkeypatch.setattr(update_master, 'pg_conn', pg_conn)
+  monkeypatch.setattr(update_master, 'load_batch', load_batch)
+  monkeypatch.setattr(update_master, 'update_tip', lambda conn, project, branch, new_tip: None)
+  monkeypatch.setattr(update_master, 'metrics', update_master.pgmaster_metrics.run_metrics())
+  monkeypatch.setattr(update_master, 'progress', update_master.pgmaster_metrics.progress_log(level = u'ERROR'))
+
+  load_queue = queue.Queue()
+  events = queue.Queue()
+  options = {'bulk' : False, 'batch_size' : 100, 'force' : False}
+  worker = threading.Thread(target = update_master.load_worker, args = (load_queue, events, options), daemon = True)
+  worker.start()
+
+  def load(branch, batches):
+    for entries in batches:
+      load_queue.put(('batch', u'proj', 1, branch, entries))
+    load_queue.put(('done', u'proj', 1, branch, u'tip', None, None))
+    return events.get(timeout = 10)[3]
+  # end of nested (internal) function
+
+  # Database is down at first, so the branch fails, but the next one connects.
+  assert load(u'b1', [[u'c1']]) is False
+  pg_conn.down = False
+  assert load(u'b2', [[u'c2']]) is True
+
+  # Broken connection is discarded, and following batches of the branch are discarded too.
+  assert load(u'b3', [[u'broken'], [u'c3']]) is False
+  assert pg_conn.discarded == [pg_conn.conns[0]]
+  assert load(u'b4', [[u'c4']]) is True
+
+  load_queue.put(None)
+  worker.join()
+  assert loaded == [(pg_conn.conns[0], u'b2', [u'c2']), (pg_conn.conns[1], u'b4', [u'c4'])]
+
+def test_backfill_bpgroups_once(work_repo, pg_connect, monkeypatch):
+  c1 = work_repo.commit(u'Fix typo.', {u'a.txt' : u'a\n'})
+  c2 = work_repo.commit(u'Fix typo.', {u'b.txt' : u'b\n'})
+  # Empty commit without message has neither patch-id nor fingerprint of message.
+  work_repo.git(u'commit', u'-q', u'--allow-empty', u'--allow-empty-message', u'-m', u'',
+    env = {'GIT_AUTHOR_DATE' : u'1600000600 +0900', 'GIT_COMMITTER_DATE' : u'1600000600 +0900'})
+  c3 = work_repo.git(u'rev-parse', u'HEAD')
+  repo = git.Repo(work_repo.path)
+
+  conn = pg_connect()
+  with conn.cursor() as cursor:
+    cursor.execute(u"""
+      CREATE TABLE branch_proj PARTITION OF _branch FOR VALUES IN ('proj');
+      CREATE TABLE commitinfo_proj PARTITION OF _commitinfo FOR VALUES IN ('proj');
+      INSERT INTO project_info (project, bpgroup_filled) VALUES ('proj', false)""")
+    for commit in repo.iter_commits(u'master'):
+      cursor.execute(u"""
+        INSERT INTO _branch (project, branch, commitid, scommitid, commitdate, commitdate_l, timezone_int)
+          VALUES ('proj', 'master', %s, %s, to_timestamp(%s), to_timestamp(%s)::timestamp, 0);
+        INSERT INTO _commitinfo (project, commitid, author, committer, commitlog, summary, bpgroup)
+          VALUES ('proj', %s, %s, %s, %s, %s, %s)""",
+        [commit.hexsha, commit.hexsha[:7], commit.authored_date, commit.authored_date,
+          commit.hexsha, commit.author.name, commit.committer.name, commit.message, commit.summary, commit.hexsha])
+  conn.commit()
+
+  calls = []
+  git_patch_ids = update_master.pgmaster_utils.git_patch_ids
+  monkeypatch.setattr(update_master.pgmaster_utils, 'git_patch_ids', lambda repo, hexshas: calls.append(hexshas) or git_patch_ids(repo, hexshas))
+  monkeypatch.setattr(update_master, 'progress', update_master.pgmaster_metrics.progress_log(level = u'ERROR'))
+
+  assert update_master.backfill_bpgroups(conn, repo, 1, u'proj', 2) == 3
+  assert len(calls) == 2
+  with conn.cursor() as cursor:
+    cursor.execute(u"SELECT commitid, bpgroup, patchid IS NULL AND msgid IS NULL FROM _commitinfo ORDER BY bpgroup, commitid")
+    assert sorted(cursor.fetchall()) == sorted([(c1, c1, False), (c2, c1, False), (c3, c3, True)])
+    cursor.execute(u"SELECT bpgroup_filled FROM project_info WHERE project = 'proj'")
+    assert cursor.fetchone() == (True,)
+  conn.commit()
+
+  # Commit having neither of them is not read again.
+  assert update_master.backfill_bpgroups(conn, repo, 1, u'proj', 2) == 0
+  assert len(calls) == 2
+
+def test_load_rows_force(work_repo, pg_connect, monkeypatch):
+  work_repo.commit(u'first', {u'a.txt' : u'a\n'})
+  work_repo.commit(u'second', {u'b.txt' : u'b\n'})
+  repo = git.Repo(work_repo.path)
+  entries = [
+    (update_master.make_commit_row(record, record.hexsha[:7], None), record.parents)
+    for record in update_master.pgmaster_utils.git_log_records(repo, u'master')
+  ]
+
+  conn = pg_connect()
+  with conn.cursor() as cursor:
+    cursor.execute(u"""
+      CREATE TABLE branch_proj PARTITION OF _branch FOR VALUES IN ('proj');
+      CREATE TABLE commitinfo_proj PARTITION OF _commitinfo FOR VALUES IN ('proj')""")
+  conn.commit()
+  monkeypatch.setattr(update_master, 'metrics', update_master.pgmaster_metrics.run_metrics())
+
+  assert update_master.load_rows(conn, 1, u'proj', u'master', entries, True) == 2
+  # Commits already inserted are skipped, and not counted.
+  assert update_master.load_rows(conn, 1, u'proj', u'master', entries, True) == 0
+  assert update_master.load_rows(conn, 1, u'proj', u'master', entries[1:], False) == 0
+  assert update_master.metrics.get_branch(u'proj', u'master')['rows'][u'_branch'] == 2
+  with conn.cursor() as cursor:
+    cursor.execute(u"SELECT commits FROM branch_stats WHERE project = 'proj' AND branch = 'master'")
+    assert cursor.fetchone() == (2,)
+  conn.commit()
@@ -20,19 +20,40 @@
 
 import sys
 import os
+import io
+import csv
 import psycopg2
+from psycopg2 import sql
 import datetime, time
+import calendar
 import fcntl
 import argparse
 import configparser
 import traceback
+import threading
+import queue
+import collections
+import multiprocessing
 import concurrent.futures
+import zlib
+import random
+import signal
 from git import *
 
 import pg_connection
 import pgmaster_utils
+import pgmaster_metrics
+import pgmaster_cache
 
 pg_conn = None
+metrics = None   # pgmaster_metrics.run_metrics instance of this run
+progress = None  # pgmaster_metrics.progress_log instance
+
+# Max number of attempts to load each batch (retry on deadlock)
+MAX_BATCH_ATTEMPTS = 3
+
+# Back-patched commits are grouped only within this period (seconds) from the first commit of the group
+BPGROUP_WINDOW = 24 * 60 * 60
 
 def get_now(with_date = False):
   """
@@ -44,221 +65,1811 @@ def get_now(with_date = False):
   else:
     return datetime.datetime.now().strftime(u'%H:%M:%S')
 
-def update_repo(param):
+def make_commit_row(record, s_commit_id: str, patch_id: str):
   """
-  update_repo - Update repository information
-  param : tuple of following
-    project : project name
-    num     : number of this worker
-    force   : DO force importing
+  make_commit_row() - Convert a commit into values to insert
+  record      : pgmaster_utils.commit_record instance to convert
+  s_commit_id : short commit id of this commit
+  patch_id    : patch-id of this commit (or None)
   """
-  (project, num, force) = param
+  commit_date = u"%s+0" % time.strftime(
+    u"%Y-%m-%d %H:%M:%S",
+    time.gmtime(record.authored_date)
+  )
+  time_zone = (-record.author_tz_offset // 36)  # (-1) * offset_sec / 3600 * 100
+  commit_date_local = time.strftime(
+    u"%Y-%m-%d %H:%M:%S",
+    time.gmtime(
+      record.authored_date + ((time_zone // 100) * 3600) + (time_zone % 100) * 60
+    )
+  )
 
-  fd = None
-  conn = pg_conn.connect()
-  print(u"LOG[%d] <%s>: Connect to database for %s" % (num, get_now(), project))
+  return (
+    record.hexsha,
+    s_commit_id,
+    commit_date,
+    commit_date_local,
+    time_zone,
+    record.author_name,
+    record.committer_name,
+    record.message,
+    record.message.split(u'\n', 1)[0],  # summary (same as GitPython)
+    patch_id,
+    pgmaster_utils.message_fingerprint(record.message)
+  )
+
+def build_children_map(rows):
+  """
+  build_children_map() - Build map of parent and its children in one pass
+  rows : iterable of tuple (commit id, list of commit ids of parents (or None))
+  """
+  children_map = {}
+  for (commit_id, parents) in rows:
+    if parents is None:
+      continue
+    for parent in parents:
+      children_map.setdefault(parent, set()).add(commit_id)
+  return children_map
+
+def update_children(cursor, project: str, children_map: dict) -> int:
+  """
+  update_children() - Record commit-ids of "children" to their parents at once
+  cursor       : psycopg2.extensions.cursor instance of databse
+  project      : project name
+  children_map : dict of parent commit id and set of its children
+  Returns number of updated parents.
+  """
+  if len(children_map) <= 0:
+    return 0
+
+  parents = []
+  children = []
+  # Sort by parent to lock rows in the same order.
+  for parent in sorted(children_map.keys()):
+    for child in sorted(children_map[parent]):
+      parents.append(parent)
+      children.append(child)
+
+  # Merge with existing children on the server side,
+  # and skip parents which already have all of these children.
+  cursor.execute(u"""UPDATE
+      _commitinfo c
+    SET
+      children = ARRAY(
+        SELECT DISTINCT unnest(coalesce(c.children, '{}'::text[]) || v.children)
+      ),
+      updatetime = now()
+    FROM (
+      SELECT
+        parent, array_agg(child) AS children
+      FROM
+        unnest(%s::text[], %s::text[]) AS t(parent, child)
+      GROUP BY
+        parent
+    ) v
+    WHERE
+      c.project = %s AND
+      c.commitid = v.parent AND
+      NOT (coalesce(c.children, '{}'::text[]) @> v.children)""",
+    [parents, children, project]
+  )
+  return cursor.rowcount
+
+def update_branch_stats(cursor, project: str, branch: str, commits: int, newest, oldest):
+  """
+  update_branch_stats() - Add inserted commits to statistics of the branch
+  cursor  : psycopg2.extensions.cursor instance of databse
+  project : project name
+  branch  : branch name
+  commits : number of inserted commits
+  newest  : commitdate of the newest one in inserted commits
+  oldest  : commitdate of the oldest one in inserted commits
+  This must be called in the same transaction as inserting commits.
+  """
+  if commits <= 0:
+    return
+
+  cursor.execute(u"""INSERT INTO
+      branch_stats (project, branch, commits, newest, oldest)
+    VALUES
+      (%s, %s, %s, %s, %s)
+    ON CONFLICT ON CONSTRAINT branch_stats_pkey
+    DO UPDATE SET
+      commits = branch_stats.commits + excluded.commits,
+      newest = greatest(branch_stats.newest, excluded.newest),
+      oldest = least(branch_stats.oldest, excluded.oldest),
+      lastingested = now()""",
+    [project, branch, commits, newest, oldest]
+  )
+
+def make_bpgroup_commit(row):
+  """
+  make_bpgroup_commit() - Convert a row made by make_commit_row() into tuple for assign_bpgroups()
+  row : tuple made by make_commit_row()
+  """
+  commit_date = calendar.timegm(time.strptime(row[2], u"%Y-%m-%d %H:%M:%S+0"))
+  return (row[0], row[5], row[9], row[10], commit_date)
+
+def assign_bpgroups(commits, known: dict = None):
+  """
+  assign_bpgroups() - Assign back-patch groups to commits
+  commits : list of tuple (commit id, author, patch-id, fingerprint of message, commitdate (seconds since epoch)),
+            from oldest to latest
+  known   : dict of keys and groups of commits already assigned (updated by this)
+  Returns dict of commit id and its group (commit id of the first commit in the group).
+  Commits of the same author are in the same group if they have the same patch-id
+  (message may be edited), or the same message (patch may be conflicted),
+  and are committed within BPGROUP_WINDOW from the first commit of the group.
+  """
+  if known is None:
+    known = {}
+  groups = {}
+  for (commit_id, author, patch_id, fingerprint, commit_date) in commits:
+    keys = []
+    if patch_id is not None:
+      keys.append((u'patch', author, patch_id))
+    if fingerprint is not None:
+      keys.append((u'message', author, fingerprint))
+
+    # Value of each key is list of tuple (group, commitdate of the first commit in the group).
+    group = known.get((u'commit', commit_id))
+    for key in keys:
+      if group is not None:
+        break
+      for (g, first_date) in known.get(key, []):
+        if first_date is not None and abs(commit_date - first_date) <= BPGROUP_WINDOW:
+          group = (g, first_date)
+          break
+    if group is None:
+      group = (commit_id, commit_date)
+
+    groups[commit_id] = group[0]
+    known[(u'commit', commit_id)] = group
+    for key in keys:
+      if group not in known.setdefault(key, []):
+        known[key].append(group)
+  return groups
+
+def load_bpgroups(cursor, project: str, commits, exclude = None) -> dict:
+  """
+  load_bpgroups() - Assign back-patch groups to commits, with groups of inserted commits
+  cursor  : psycopg2.extensions.cursor instance of databse
+  project : project name
+  commits : list of tuple (commit id, author, patch-id, fingerprint of message, commitdate), from oldest to latest
+  exclude : list of commit ids not to be referred (commits to be assigned, but already in the table)
+  Returns dict of commit id and its group (see assign_bpgroups()).
+  Groups committed by other workers meanwhile are not seen, so call recheck_bpgroups() at last.
+  """
+  if len(commits) <= 0:
+    return {}
+
+  # Commits of a group are within BPGROUP_WINDOW from its first commit,
+  # so commits in groups to be joined are within twice of it.
+  dates = [x[4] for x in commits]
+  cursor.execute(u"""SELECT
+      c.commitid,
+      c.author,
+      c.patchid,
+      c.msgid,
+      c.bpgroup,
+      extract(epoch FROM (
+        SELECT min(g.commitdate) FROM _branch g WHERE g.project = c.project AND g.commitid = c.bpgroup
+      ))::bigint
+    FROM
+      _commitinfo c
+    WHERE
+      c.project = %s AND
+      (
+        c.commitid = ANY(%s) OR
+        (
+          (c.patchid = ANY(%s) OR c.msgid = ANY(%s)) AND
+          EXISTS (
+            SELECT 1 FROM _branch b
+            WHERE
+              b.project = c.project AND
+              b.commitid = c.commitid AND
+              b.commitdate BETWEEN to_timestamp(%s) AND to_timestamp(%s)
+          )
+        )
+      ) AND
+      NOT (c.commitid = ANY(%s))
+    ORDER BY
+      c.bpgroup = c.commitid DESC, c.commitid""",
+    [
+      project,
+      [x[0] for x in commits],
+      [x[2] for x in commits if x[2] is not None],
+      [x[3] for x in commits if x[3] is not None],
+      min(dates) - BPGROUP_WINDOW * 2,
+      max(dates) + BPGROUP_WINDOW * 2,
+      exclude or []
+    ]
+  )
+  known = {}
+  for (commit_id, author, patch_id, fingerprint, group, first_date) in cursor.fetchall():
+    known[(u'commit', commit_id)] = (group, first_date)
+    if first_date is None:
+      # The first commit of the group is not in any branch, so nothing joins it.
+      continue
+    for key in ((u'patch', author, patch_id), (u'message', author, fingerprint)):
+      if key[2] is not None and (group, first_date) not in known.setdefault(key, []):
+        known[key].append((group, first_date))
+
+  return assign_bpgroups(commits, known)
+
+def recheck_bpgroups(cursor, project: str, commits, groups: dict, inserted) -> int:
+  """
+  recheck_bpgroups() - Fix back-patch groups of inserted commits, with groups committed by other workers
+  cursor   : psycopg2.extensions.cursor instance of databse
+  project  : project name
+  commits  : list of tuple passed to load_bpgroups()
+  groups   : dict returned by load_bpgroups() and recorded to inserted commits
+  inserted : list of commit ids inserted (or updated) with groups
+  Returns number of fixed commits.
+  This must be called at the end of the transaction inserting commits, and commit soon.
+  """
+  if len(inserted) <= 0:
+    return 0
+
+  # Serialize only this check of the project until commit.
+  # Then one of workers inserting commits of the same group sees the other one.
+  cursor.execute(u"""SELECT
+      pg_advisory_xact_lock(hashtext(%s))""",
+    [u'bpgroup\n' + project]
+  )
+  current = load_bpgroups(cursor, project, commits, exclude = inserted)
+  fixed = [commit_id for commit_id in inserted if current[commit_id] != groups[commit_id]]
+  if len(fixed) > 0:
+    cursor.execute(u"""UPDATE
+        _commitinfo c
+      SET
+        bpgroup = g.bpgroup,
+        updatetime = now()
+      FROM
+        unnest(%s::text[], %s::text[]) AS g(commitid, bpgroup)
+      WHERE
+        c.project = %s AND
+        c.commitid = g.commitid""",
+      [fixed, [current[x] for x in fixed], project]
+    )
+  return len(fixed)
+
+def backfill_bpgroups(conn, repo, num: int, project: str, batch_size: int) -> int:
+  """
+  backfill_bpgroups() - Assign back-patch groups to commits inserted before grouping was introduced
+  conn       : connection to the database
+  repo       : git.Repo instance of the repository
+  num        : number of this project
+  project    : project name
+  batch_size : number of commits in each transaction
+  Returns number of commits having neither patch-id nor fingerprint of message before this.
+  Commits are assigned from oldest to latest, and each of them is in its own group before this
+  (see sql/012_add_backpatch_group.sql).
+  This is done only once for each project, and "bpgroup_filled" of project_info is set at last.
+  Commits without any changes nor message are never assigned, so they are not read again.
+  """
+  with conn.cursor() as cursor:
+    cursor.execute(u"""SELECT
+        bpgroup_filled
+      FROM
+        project_info
+      WHERE
+        project = %s""",
+      [project]
+    )
+    row = cursor.fetchone()
+  conn.commit()
+  if row is None or row[0]:
+    return 0
+
+  with conn.cursor() as cursor:
+    cursor.execute(u"""SELECT
+        c.commitid,
+        extract(epoch FROM d.commitdate)::bigint
+      FROM
+        _commitinfo c,
+        LATERAL (SELECT min(b.commitdate) AS commitdate FROM _branch b WHERE b.project = c.project AND b.commitid = c.commitid) d
+      WHERE
+        c.project = %s AND
+        c.patchid IS NULL AND
+        c.msgid IS NULL
+      ORDER BY
+        d.commitdate,
+        c.commitid""",
+      [project]
+    )
+    rows = cursor.fetchall()
+  conn.commit()
+  ids = [commit_id for (commit_id, commit_date) in rows]
+  dates = dict(rows)
+
+  if len(ids) > 0:
+    progress.log(u'LOG', num, u"Assign back-patch groups to %d commits of %s." % (len(ids), project))
+  for i in range(0, len(ids), batch_size):
+    chunk = ids[i:i + batch_size]
+    # Commits not in the repository any more (or without any changes) have no patch-id.
+    patch_ids = pgmaster_utils.git_patch_ids(repo, pgmaster_utils.git_existing_commits(repo, chunk))
+    try:
+      with conn.cursor() as cursor:
+        cursor.execute(u"""SELECT
+            commitid, author, commitlog
+          FROM
+            _commitinfo
+          WHERE
+            project = %s AND
+            commitid = ANY(%s)""",
+          [project, chunk]
+        )
+        found = {commit_id: (author, commitlog) for (commit_id, author, commitlog) in cursor.fetchall()}
+        commits = [
+          (x, found[x][0], patch_ids.get(x), pgmaster_utils.message_fingerprint(found[x][1]), dates[x])
+          for x in chunk if x in found
+        ]
+        cursor.execute(u"""UPDATE
+            _commitinfo c
+          SET
+            patchid = g.patchid,
+            msgid = g.msgid,
+            updatetime = now()
+          FROM
+            unnest(%s::text[], %s::text[], %s::text[]) AS g(commitid, patchid, msgid)
+          WHERE
+            c.project = %s AND
+            c.commitid = g.commitid""",
+          [[x[0] for x in commits], [x[2] for x in commits], [x[3] for x in commits], project]
+        )
+        # Each commit is in its own group yet, so groups to be changed are recorded by recheck_bpgroups().
+        # Commits not in any branch have no commitdate, and are left in their own groups.
+        commits = [x for x in commits if x[4] is not None]
+        recheck_bpgroups(cursor, project, commits, {x[0]: x[0] for x in commits}, [x[0] for x in commits])
+      conn.commit()
+    except Exception as e:
+      conn.rollback()
+      raise
+
+  # All of old commits are assigned, and they are never read again.
+  with conn.cursor() as cursor:
+    cursor.execute(u"""UPDATE
+        project_info
+      SET
+        bpgroup_filled = true
+      WHERE
+        project = %s""",
+      [project]
+    )
+  conn.commit()
+  return len(ids)
+
+def load_rows(conn, num: int, project: str, branch: str, entries, force: bool) -> int:
+  """
+  load_rows() - Insert commits one by one (fallback path)
+  conn    : connection to the database
+  num     : number of this worker
+  project : project name
+  branch  : branch name
+  entries : list of tuple (row made by make_commit_row(), parents), from oldest to latest
+  force   : DO force importing
+  Returns number of inserted commits.
+  """
+  inserted = 0
+  with conn.cursor() as cursor:
+    for (row, parents) in entries:
+      commit_id = row[0]
+
+      try:
+        start = time.monotonic()
+        dml_insert_branch = u"""INSERT INTO
+            _branch (project, branch, commitid, scommitid, commitdate, commitdate_l, timezone_int)
+          VALUES
+            (%s, %s, %s, %s, %s, %s, %s)"""
+        if force:
+          # To simply skip when record is already existed, add "ON CONFLICT ... DO NOTHING" clause.
+          dml_insert_branch += u' ON CONFLICT ON CONSTRAINT _branch_pkey DO NOTHING'
+
+        cursor.execute(dml_insert_branch,
+          [project, branch, row[0], row[1], row[2], row[3], row[4]]
+        )
+        rows_branch = cursor.rowcount
+        update_branch_stats(cursor, project, branch, rows_branch, row[2], row[2])
+
+        # There is NO "branch" column on _commitinfo table,
+        # because we want to avoid duplicate records of large text data like commit message.
+        # This is why only this SQL has "ON CONFLICT ... DO NOTHING" clause.
+        commits = [make_bpgroup_commit(row)]
+        groups = load_bpgroups(cursor, project, commits)
+        cursor.execute(u"""INSERT INTO
+            _commitinfo (project, commitid, author, committer, commitlog, summary, patchid, msgid, bpgroup)
+          VALUES
+            (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+          ON CONFLICT ON CONSTRAINT _commitinfo_pkey DO NOTHING
+          RETURNING
+            commitid""",
+          [project, commit_id, row[5], row[6], row[7], row[8], row[9], row[10], groups[commit_id]]
+        )
+        inserted_ids = [x for (x,) in cursor.fetchall()]
+        rows_commitinfo = len(inserted_ids)
+        metrics.add_time(project, u'insert', time.monotonic() - start, branch)
+
+        # Record commit-ids of "child" here.
+        with metrics.timer(project, u'children', branch):
+          rows_children = update_children(cursor, project, build_children_map([(commit_id, parents)]))
+
+        with metrics.timer(project, u'insert', branch):
+          recheck_bpgroups(cursor, project, commits, groups, inserted_ids)
+          conn.commit()
+        # Commit already in the branch is skipped by "ON CONFLICT ... DO NOTHING" if forced.
+        inserted += rows_branch
+        metrics.add_rows(project, branch, u'_branch', rows_branch)
+        metrics.add_rows(project, branch, u'_commitinfo', rows_commitinfo)
+        metrics.add_rows(project, branch, u'children', rows_children)
+      except psycopg2.Error as e:
+        conn.rollback()
+        if e.pgcode == '23505':
+          # Unique constraint violation on _branch (partitioned) table.
+          # This is expected only while reconciling (see plan_branch()),
+          # because commits are read again from 1 day before the last commit date.
+          # Therefore, simply ignoring.
+          pass
+        else:
+          progress.log(u'ERROR', num, u"%s ERRORCODE: %s" % (e.pgerror, e.pgcode))
+          raise
+      except Exception as e:
+        conn.rollback()
+        raise
+    # end of for entries
+  # end of with
+  return inserted
+
+def load_batch(conn, num: int, project: str, branch: str, entries) -> int:
+  """
+  load_batch() - Insert commits at once via staging table
+  conn    : connection to the database
+  num     : number of this worker
+  project : project name
+  branch  : branch name
+  entries : list of tuple (row made by make_commit_row(), parents), from oldest to latest
+  Returns number of inserted commits.
+  """
+  children_map = build_children_map([(row[0], parents) for (row, parents) in entries])
+
+  # Each batch is loaded in its own transaction.
+  # "ON CONFLICT ... DO NOTHING" is used for both tables,
+  # so commits already inserted are simply skipped instead of raising unique violation.
+  for attempt in range(1, MAX_BATCH_ATTEMPTS + 1):
+    try:
+      with conn.cursor() as cursor:
+        start = time.monotonic()
+        cursor.execute(u"""CREATE TEMPORARY TABLE IF NOT EXISTS _stage_commit
+          (
+            commitid     text,
+            scommitid    text,
+            commitdate   timestamptz,
+            commitdate_l timestamp,
+            timezone_int smallint,
+            author       text,
+            committer    text,
+            commitlog    text,
+            summary      text,
+            patchid      text,
+            msgid        text
+          ) ON COMMIT DELETE ROWS""")
+
+        buf = io.StringIO()
+        # Quote all fields, because unquoted empty field is treated as NULL by COPY.
+        writer = csv.writer(buf, quoting = csv.QUOTE_ALL, lineterminator = u'\n')
+        for (row, parents) in entries:
+          writer.writerow(row)
+        buf.seek(0)
+        cursor.copy_expert(u"COPY _stage_commit FROM STDIN WITH (FORMAT csv, FORCE_NULL (patchid, msgid))", buf)
+
+        cursor.execute(u"""INSERT INTO
+            _branch (project, branch, commitid, scommitid, commitdate, commitdate_l, timezone_int)
+          SELECT
+            %s, %s, commitid, scommitid, commitdate, commitdate_l, timezone_int
+          FROM
+            _stage_commit
+          ON CONFLICT ON CONSTRAINT _branch_pkey DO NOTHING
+          RETURNING
+            commitdate""",
+          [project, branch]
+        )
+        dates = [d for (d,) in cursor.fetchall()]
+        rows_branch = len(dates)
+        if rows_branch > 0:
+          update_branch_stats(cursor, project, branch, rows_branch, max(dates), min(dates))
+
+        # Groups are assigned without waiting for other workers here,
+        # and checked again at the end of this transaction.
+        commits = [make_bpgroup_commit(row) for (row, parents) in entries]
+        groups = load_bpgroups(cursor, project, commits)
+        cursor.execute(u"""INSERT INTO
+            _commitinfo (project, commitid, author, committer, commitlog, summary, patchid, msgid, bpgroup)
+          SELECT
+            %s, s.commitid, s.author, s.committer, s.commitlog, s.summary, s.patchid, s.msgid, g.bpgroup
+          FROM
+            _stage_commit s
+            JOIN unnest(%s::text[], %s::text[]) AS g(commitid, bpgroup) ON g.commitid = s.commitid
+          ON CONFLICT ON CONSTRAINT _commitinfo_pkey DO NOTHING
+          RETURNING
+            commitid""",
+          [project, list(groups.keys()), list(groups.values())]
+        )
+        inserted_ids = [x for (x,) in cursor.fetchall()]
+        rows_commitinfo = len(inserted_ids)
+        metrics.add_time(project, u'insert', time.monotonic() - start, branch)
+
+        # Record commit-ids of "children" here.
+        # Parents in this batch are already inserted above.
+        with metrics.timer(project, u'children', branch):
+          rows_children = update_children(cursor, project, children_map)
+
+      with metrics.timer(project, u'insert', branch):
+        with conn.cursor() as cursor:
+          recheck_bpgroups(cursor, project, commits, groups, inserted_ids)
+        conn.commit()
+      break
+    except psycopg2.Error as e:
+      conn.rollback()
+      if e.pgcode == '40P01' and attempt < MAX_BATCH_ATTEMPTS:
+        # Deadlock with other workers updating children of same parents.
+        # One of them is aborted, so simply retry.
+        progress.log(u'WARNING', num, u"Deadlock detected on \"%s\". Retry." % (branch))
+        continue
+      progress.log(u'ERROR', num, u"%s ERRORCODE: %s" % (e.pgerror, e.pgcode))
+      raise
+    except Exception as e:
+      conn.rollback()
+      raise
+  # end of for attempt
 
+  metrics.add_rows(project, branch, u'_branch', rows_branch)
+  metrics.add_rows(project, branch, u'_commitinfo', rows_commitinfo)
+  metrics.add_rows(project, branch, u'children', rows_children)
+  return rows_branch
+
+def is_ancestor(repo, ancestor: str, commit: str) -> bool:
+  """
+  is_ancestor() - Check if a commit is an ancestor of another commit
+  repo     : git.Repo instance of the repository
+  ancestor : commit id of the ancestor
+  commit   : commit id of the descendant
+  """
   try:
-    fd = open(u'git/.lock.' + project, 'w')
-    fcntl.flock(fd, fcntl.LOCK_EX)  # LOCK
-    repo = Repo(u'git/' + project + u'.git')
-    git_cmd = repo.git
-    branches = []
+    return repo.is_ancestor(ancestor, commit)
+  except GitCommandError:
+    # Ancestor is no longer in the repository.
+    return False
 
+def update_tip(conn, project: str, branch: str, tip: str):
+  """
+  update_tip() - Record the last ingested tip of the branch
+  conn    : connection to the database
+  project : project name
+  branch  : branch name
+  tip     : commit id of the tip
+  """
+  try:
     with conn.cursor() as cursor:
+      cursor.execute(u"""UPDATE
+          repository_info
+        SET
+          tipcommitid = %s
+        WHERE
+          project = %s AND branch = %s""",
+        [tip, project, branch]
+      )
+    conn.commit()
+  except Exception as e:
+    conn.rollback()
+    raise
+
+def plan_branch(conn, repo, num: int, project: str, branch: str, old_tip: str, force: bool):
+  """
+  plan_branch() - Determine commits to insert into the branch
+  conn    : connection to the database
+  repo    : git.Repo instance of the repository
+  num     : number of this worker
+  project : project name
+  branch  : branch name
+  old_tip : commit id of the last ingested tip (or None)
+  force   : DO force importing
+  Returns tuple (revision to read, since, new tip), or None if no need to update.
+  """
+  new_tip = repo.commit(branch).hexsha
+  rev = new_tip
+  since = None
+  if force:
+    # When doing force importing, all commits are processed,
+    # so no need to calculate start point in this situation.
+    pass
+  elif old_tip == new_tip:
+    progress.log(u'INFO', num, u"\"%s\" is not moved. Skip." % (branch))
+    return None
+  elif old_tip is not None and is_ancestor(repo, old_tip, new_tip):
+    # Walk only commits after the last ingested tip.
+    rev = u'%s..%s' % (old_tip, new_tip)
+  else:
+    # The last ingested tip is unknown, or history was rewritten.
+    # Reconcile commits from 1 day before the last commit date.
+    if old_tip is not None:
+      progress.log(u'WARNING', num, u"\"%s\" is rewritten. Reconcile recent commits." % (branch))
+    with conn.cursor() as cursor:
+      # To avoid commit slipped out,
+      # start point is set to 1 day before the last commit date.
       cursor.execute(u"""SELECT
-          branch
+          (max(commitdate) - interval '1 day')::date
         FROM
-          repository_info
+          _branch
         WHERE
-          project = %s""",
-        [project]
+          project = %s and branch = %s
+        LIMIT 1""",
+        [project, branch]
       )
-      branches.extend([r for (r,) in cursor.fetchall()])
-    
-    print(u"LOG[%d] <%s>: Fetch from origin on %s" % (num, get_now(), project))
-    repo.remotes.origin.fetch()
-    print(u"LOG[%d] <%s>: Fetch done" % (num, get_now()))
+      (since,) = cursor.fetchone()
 
-    # Determine the start point to insert.
-    for branch in branches:
-      print(u"INFO[%d] <%s>: Start updating \"%s\"." % (num, get_now(), branch))
-      since = None
-      # When doing force importing, all commits are processed,
-      # so no need to calculate start point in this situation.
-      if not force:
-        with conn.cursor() as cursor:
-          # To avoid commit slipped out,
-          # start point is set to 1 day before the last commit date.
-          cursor.execute(u"""SELECT
-              (max(commitdate) - interval '1 day')::date
+  return (rev, since.strftime(u'%Y-%m-%d') if since is not None else None, new_tip)
+
+#
+# Bulk mode (force importing)
+#
+# Commits of all branches of each project are loaded into an unlogged staging table,
+# then partitions of the project are rebuilt from it and swapped at once.
+# Indexes of new partitions are built after all rows are inserted,
+# and attached to indexes of the parent by ATTACH PARTITION.
+#
+
+def stage_table(project: str):
+  """
+  stage_table() - Get identifier of the staging table of the project
+  project : project name
+  """
+  return sql.Identifier(u'_bulk_stage_' + project)
+
+def bulk_prepare(cursor, project: str):
+  """
+  bulk_prepare() - Create (or recreate) the staging table of the project
+  cursor  : psycopg2.extensions.cursor instance of databse
+  project : project name
+  """
+  cursor.execute(sql.SQL(u"DROP TABLE IF EXISTS {}").format(stage_table(project)))
+  cursor.execute(sql.SQL(u"""CREATE UNLOGGED TABLE {}
+    (
+      branch       text,
+      commitid     text,
+      scommitid    text,
+      commitdate   timestamptz,
+      commitdate_l timestamp,
+      timezone_int smallint,
+      author       text,
+      committer    text,
+      commitlog    text,
+      summary      text,
+      patchid      text,
+      msgid        text,
+      parents      text[]
+    )""").format(stage_table(project)))
+
+def load_bulk(conn, num: int, project: str, branch: str, entries) -> int:
+  """
+  load_bulk() - Insert commits into the staging table of the project
+  conn    : connection to the database
+  num     : number of this worker
+  project : project name
+  branch  : branch name
+  entries : list of tuple (row made by make_commit_row(), parents), from oldest to latest
+  Returns number of staged commits.
+  """
+  buf = io.StringIO()
+  # Quote all fields, because unquoted empty field is treated as NULL by COPY.
+  writer = csv.writer(buf, quoting = csv.QUOTE_ALL, lineterminator = u'\n')
+  for (row, parents) in entries:
+    writer.writerow((branch,) + row + (u'{' + u','.join(parents or []) + u'}',))
+  buf.seek(0)
+
+  try:
+    with metrics.timer(project, u'insert', branch):
+      with conn.cursor() as cursor:
+        cursor.copy_expert(sql.SQL(u"COPY {} FROM STDIN WITH (FORMAT csv, FORCE_NULL (patchid, msgid))").format(
+          stage_table(project)), buf)
+      conn.commit()
+  except Exception as e:
+    conn.rollback()
+    raise
+
+  metrics.add_rows(project, branch, u'staged', len(entries))
+  return len(entries)
+
+def get_table(cursor, name: str):
+  """
+  get_table() - Get the table by its name
+  cursor : psycopg2.extensions.cursor instance of databse
+  name   : name of the table
+  Returns tuple (oid, schema name, table name, relkind).
+  """
+  cursor.execute(u"""SELECT
+      c.oid,
+      n.nspname,
+      c.relname,
+      c.relkind
+    FROM
+      pg_class c
+      JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE
+      c.oid = %s::regclass""",
+    [name]
+  )
+  return cursor.fetchone()
+
+def find_partition(cursor, parent, value: str):
+  """
+  find_partition() - Find the partition of the value
+  cursor : psycopg2.extensions.cursor instance of databse
+  parent : partitioned table (tuple returned by get_table() or find_partition())
+  value  : value of the partition key
+  Returns tuple (oid, schema name, table name, relkind).
+  """
+  cursor.execute(u"""SELECT
+      c.oid,
+      n.nspname,
+      c.relname,
+      c.relkind
+    FROM
+      pg_inherits i
+      JOIN pg_class c ON c.oid = i.inhrelid
+      JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE
+      i.inhparent = %s AND
+      pg_get_expr(c.relpartbound, c.oid) = format('FOR VALUES IN (%%L)', %s::text)""",
+    [parent[0], value]
+  )
+  row = cursor.fetchone()
+  if row is None:
+    raise ValueError(u"Partition of %s for '%s' is not found." % (parent[2], value))
+  return row
+
+def build_partition(cursor, parent, value: str, query, params):
+  """
+  build_partition() - Build new table to replace the partition of the value
+  cursor : psycopg2.extensions.cursor instance of databse
+  parent : partitioned table (tuple returned by get_table() or find_partition())
+  value  : value of the partition key
+  query  : psycopg2.sql.Composable of column list and SELECT to fill the new partition
+  params : parameters of the query
+  Returns tuple (swap, number of rows of the new table). Pass swap to swap_partition().
+  The parent is not locked exclusively while building, so readers are not blocked.
+  """
+  (oid, schema, name, relkind) = find_partition(cursor, parent, value)
+  if relkind != 'r':
+    raise ValueError(u"Partition %s is not a table." % (name))
+  old = sql.Identifier(schema, name)
+  new_name = u'_bulk_%d' % oid
+  new = sql.Identifier(schema, new_name)
+
+  # Rows are inserted before any indexes are built.
+  cursor.execute(sql.SQL(u"CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS)").format(new, old))
+  cursor.execute(sql.SQL(u"INSERT INTO {} ").format(new) + query, params)
+  rows = cursor.rowcount
+
+  # Build same indexes (and constraints) as the old partition.
+  cursor.execute(u"""SELECT
+      c.relname,
+      pg_get_indexdef(x.indexrelid),
+      k.conname,
+      pg_get_constraintdef(k.oid)
+    FROM
+      pg_index x
+      JOIN pg_class c ON c.oid = x.indexrelid
+      LEFT JOIN pg_constraint k ON k.conindid = x.indexrelid AND k.conrelid = x.indrelid
+    WHERE
+      x.indrelid = %s
+    ORDER BY
+      c.relname""",
+    [oid]
+  )
+  renames = []
+  for (n, (index_name, indexdef, conname, condef)) in enumerate(cursor.fetchall()):
+    temp_name = sql.Identifier(u'%s_%d' % (new_name, n))
+    if conname is not None:
+      # Primary key must be added as a constraint, to be attached to one of the parent.
+      cursor.execute(sql.SQL(u"ALTER TABLE {} ADD CONSTRAINT {} ").format(new, temp_name) + sql.SQL(condef))
+      renames.append(sql.SQL(u"ALTER TABLE {} RENAME CONSTRAINT {} TO {}").format(
+        old, temp_name, sql.Identifier(conname)))
+    else:
+      unique = sql.SQL(u"UNIQUE " if indexdef.startswith(u'CREATE UNIQUE ') else u"")
+      cursor.execute(sql.SQL(u"CREATE {}INDEX {} ON {}").format(unique, temp_name, new) +
+        sql.SQL(indexdef[indexdef.index(u' USING '):]))
+      renames.append(sql.SQL(u"ALTER INDEX {} RENAME TO {}").format(
+        sql.Identifier(schema, u'%s_%d' % (new_name, n)), sql.Identifier(index_name)))
+
+  # ATTACH PARTITION scans the table to validate the partition constraint,
+  # unless it is implied by a CHECK constraint. So add it here, not to scan while the parent is locked.
+  cursor.execute(u"SELECT pg_get_partition_constraintdef(%s)", [oid])
+  check = sql.Identifier(new_name + u'_check')
+  cursor.execute(sql.SQL(u"ALTER TABLE {} ADD CONSTRAINT {} CHECK ").format(new, check) +
+    sql.SQL(u"(%s)" % cursor.fetchone()[0]))
+  cursor.execute(sql.SQL(u"ANALYZE {}").format(new))
+  return ((parent, value, old, new, name, check, renames), rows)
+
+def swap_partition(cursor, swap):
+  """
+  swap_partition() - Replace the partition with the table built by build_partition()
+  cursor : psycopg2.extensions.cursor instance of databse
+  swap   : swap returned by build_partition()
+  DETACH PARTITION locks the parent in ACCESS EXCLUSIVE mode until commit, and blocks readers.
+  So call this for all partitions after all of them are built, and commit soon.
+  """
+  (parent, value, old, new, name, check, renames) = swap
+  parent_table = sql.Identifier(parent[1], parent[2])
+
+  # Indexes built by build_partition() are attached to indexes of the parent, instead of building again.
+  cursor.execute(sql.SQL(u"ALTER TABLE {} DETACH PARTITION {}").format(parent_table, old))
+  cursor.execute(sql.SQL(u"ALTER TABLE {} ATTACH PARTITION {} FOR VALUES IN ({})").format(
+    parent_table, new, sql.Literal(value)))
+  cursor.execute(sql.SQL(u"ALTER TABLE {} DROP CONSTRAINT {}").format(new, check))
+  cursor.execute(sql.SQL(u"DROP TABLE {}").format(old))
+  cursor.execute(sql.SQL(u"ALTER TABLE {} RENAME TO {}").format(new, sql.Identifier(name)))
+  for rename in renames:
+    cursor.execute(rename)
+
+def bulk_swap(conn, num: int, project: str, tips):
+  """
+  bulk_swap() - Rebuild partitions of the project from the staging table, and record tips
+  conn    : connection to the database
+  num     : number of this project
+  project : project name
+  tips    : list of tuple (branch name, commit id of the new tip)
+  """
+  stage = stage_table(project)
+  try:
+    with conn.cursor() as cursor:
+      # Back-patch groups are assigned to all staged commits from oldest to latest.
+      cursor.execute(sql.SQL(u"""SELECT
+          commitid, author, patchid, msgid, extract(epoch FROM commitdate)::bigint
+        FROM (
+          SELECT DISTINCT ON (commitid)
+            commitid, author, patchid, msgid, commitdate
+          FROM
+            {stage}
+          ORDER BY
+            commitid
+        ) AS s
+        ORDER BY
+          commitdate, commitid""").format(stage = stage))
+      groups = assign_bpgroups(cursor.fetchall())
+
+      # All new partitions are built at first, then swapped at last.
+      # "children" are calculated from all staged commits at once.
+      swaps = []
+      (swap, rows) = build_partition(cursor, get_table(cursor, u'_commitinfo'), project, sql.SQL(u"""(
+          project, commitid, author, committer, commitlog, summary, patchid, msgid, bpgroup, children
+        ) SELECT DISTINCT ON (s.commitid)
+          %s, s.commitid, s.author, s.committer, s.commitlog, s.summary, s.patchid, s.msgid, g.bpgroup, c.children
+        FROM
+          {stage} s
+          JOIN unnest(%s::text[], %s::text[]) AS g(commitid, bpgroup) ON g.commitid = s.commitid
+          LEFT JOIN (
+            SELECT
+              p.parent, array_agg(DISTINCT s2.commitid) AS children
             FROM
-              _branch
-            WHERE
-              project = %s and branch = %s
-            LIMIT 1""",
-            [project, branch]
-          )
-          (since,) = cursor.fetchone()
-
-      # GitPython does NOT support "--no-merges" option,
-      # use "--max-parents=1" instead.
-      records = None
-      if since is not None:
-        records = repo.iter_commits(
-          branch, max_parents = 1, since=since.strftime(u'%Y-%m-%d')
+              {stage} s2, unnest(s2.parents) AS p(parent)
+            GROUP BY
+              p.parent
+          ) c ON c.parent = s.commitid
+        ORDER BY
+          s.commitid""").format(stage = stage),
+        [project, list(groups.keys()), list(groups.values())]
+      )
+      swaps.append(swap)
+      progress.log(u'LOG', num, u"%d commits are rebuilt in commitinfo of %s." % (rows, project))
+
+      parent = find_partition(cursor, get_table(cursor, u'_branch'), project)
+      for (branch, tip) in tips:
+        # Rows are ordered by commitdate, for BRIN index.
+        (swap, rows) = build_partition(cursor, parent, branch, sql.SQL(u"""(
+            project, branch, commitid, scommitid, commitdate, commitdate_l, timezone_int
+          ) SELECT
+            %s, branch, commitid, scommitid, commitdate, commitdate_l, timezone_int
+          FROM
+            {stage}
+          WHERE
+            branch = %s
+          ORDER BY
+            commitdate""").format(stage = stage),
+          [project, branch]
         )
-      else:
-        records = repo.iter_commits(
-          branch, max_parents = 1
+        swaps.append(swap)
+        metrics.add_rows(project, branch, u'_branch', rows)
+        progress.log(u'LOG', num, u"%d commits are rebuilt in \"%s\"." % (rows, branch))
+
+        cursor.execute(sql.SQL(u"""INSERT INTO
+            branch_stats (project, branch, commits, newest, oldest)
+          SELECT
+            %s, %s, count(*), max(commitdate), min(commitdate)
+          FROM
+            {stage}
+          WHERE
+            branch = %s
+          ON CONFLICT ON CONSTRAINT branch_stats_pkey
+          DO UPDATE SET
+            commits = excluded.commits,
+            newest = excluded.newest,
+            oldest = excluded.oldest,
+            lastingested = now()""").format(stage = stage),
+          [project, branch, branch]
         )
-      
-      # Insert to database
-      # repo.iter_commits returns from latest to oldest,
-      # so we have to reverse the record list.
-      with conn.cursor() as cursor:
-        for record in reversed(list(records)):
-          commit_id = record.hexsha
-          s_commit_id = git_cmd.rev_parse(commit_id, short=7)
-          commit_date = u"%s+0" % time.strftime(
-            u"%Y-%m-%d %H:%M:%S",
-            time.gmtime(record.authored_date)
-          )
-          time_zone = (-record.author_tz_offset // 36)  # (-1) * offset_sec / 3600 * 100
-          commit_date_local = time.strftime(
-            u"%Y-%m-%d %H:%M:%S",
-            time.gmtime(
-              record.authored_date + ((time_zone // 100) * 3600) + (time_zone % 100) * 60
-            )
-          )
 
+        cursor.execute(u"""UPDATE
+            repository_info
+          SET
+            tipcommitid = %s
+          WHERE
+            project = %s AND branch = %s""",
+          [tip, project, branch]
+        )
+
+      # All of commits are assigned above, so old commits need not be assigned again (see backfill_bpgroups()).
+      cursor.execute(u"""UPDATE
+          project_info
+        SET
+          bpgroup_filled = true
+        WHERE
+          project = %s""",
+        [project]
+      )
+
+      # Readers of _commitinfo and _branch are blocked from here until commit.
+      for swap in swaps:
+        swap_partition(cursor, swap)
+    conn.commit()
+  except Exception as e:
+    conn.rollback()
+    raise
+
+def bulk_finish(param):
+  """
+  bulk_finish() - Swap partitions if all branches are staged, and drop the staging table
+  param : tuple of following
+    project : project name
+    num     : number of this project
+    tips    : list of tuple (branch name, commit id of the new tip)
+    ok      : True if all branches are staged (False to drop the staging table only)
+    events  : queue to notify the coordinator
+  """
+  (project, num, tips, ok, events) = param
+
+  conn = None
+  try:
+    conn = pg_conn.connect()
+    if ok:
+      with metrics.timer(project, u'swap'):
+        bulk_swap(conn, num, project, tips)
+      progress.log(u'INFO', num, u"Partitions of %s are rebuilt." % (project))
+    else:
+      progress.log(u'ERROR', num, u"Partitions of %s are not rebuilt." % (project))
+  except Exception as e:
+    progress.log(u'ERROR', num, u"Error occurred while rebuilding partitions of %s. (%s)" % (project, str(e)))
+    print((u"DETAIL[%d]: " % (num)) + traceback.format_exc())
+    ok = False
+  finally:
+    try:
+      if conn is not None:
+        with conn.cursor() as cursor:
+          cursor.execute(sql.SQL(u"DROP TABLE IF EXISTS {}").format(stage_table(project)))
+        conn.commit()
+    except Exception as e:
+      conn.rollback()
+      progress.log(u'WARNING', num, u"Can't drop the staging table of %s. (%s)" % (project, str(e)))
+    finally:
+      if conn is not None:
+        pg_conn.close(conn)
+    events.put(('swapped', project, ok))
+
+#
+# Pipeline of updating
+#
+# Each stage has its own concurrency limit, and stages are connected by queues.
+#
+#   fetch  : threads (fetch_workers). Lock, fetch and plan each project,
+#            then send each branch to be updated to "parse" stage.
+#            Readers are blocked only while switching refs (see fetch_project()).
+#   parse  : processes (parse_workers). Read commits of each branch,
+#            and send them to "load" stage in batches.
+#   load   : threads (load_workers), each of them has its own connection.
+#            Insert batches, and record the tip of each branch.
+#   push   : threads (push_workers). Push to each mirror in parallel,
+#            after all branches of the project are loaded and it is unlocked.
+#
+# All batches of the same branch are sent to the same loader to keep the order,
+# and each queue to loaders is bounded to limit the memory usage.
+#
+
+# Number of commits sent to loader at once, when inserting one by one.
+ROW_BY_ROW_CHUNK = 100
+
+# Namespace of refs to fetch from origin, before switching refs of the repository.
+STAGING_REFS = u'refs/pgmaster/staging/'
+
+def fetch_staging(repo):
+  """
+  fetch_staging() - Fetch all refs of origin into STAGING_REFS
+  Refs of the repository are left untouched. "--refmap=" stops git from updating them
+  opportunistically by the refspec configured for origin ("+refs/*:refs/*" on mirrors),
+  so this can run without blocking readers.
+  repo : git.Repo instance of the project
+  """
+  repo.git.fetch(u'--refmap=', u'origin', u'+refs/*:' + STAGING_REFS + u'*')
+
+def switch_staging(repo):
+  """
+  switch_staging() - Update refs of the repository to STAGING_REFS at once
+  This is done locally (without network), so caller may block readers while switching.
+  repo : git.Repo instance of the project
+  """
+  repo.git.fetch(u'--atomic', u'.', u'+' + STAGING_REFS + u'*:refs/*')
+
+# git.Repo instances of each project, kept while running (for daemon mode)
+repos = {}
+repos_lock = threading.Lock()
+
+def get_repo(project: str):
+  """
+  get_repo() - Get git.Repo instance of the project
+  project : project name
+  """
+  with repos_lock:
+    if project not in repos:
+      repos[project] = Repo(u'git/' + project + u'.git')
+    return repos[project]
+
+def fetch_project(param):
+  """
+  fetch_project() - Lock, fetch and plan the project (run in "fetch" stage)
+
+  Two lock files are used for each project.
+    git/.update.<project> : held exclusively while updating, not to update the same project at once.
+    git/.lock.<project>   : shared by readers (web UI), held exclusively only while switching refs.
+  Objects are fetched into STAGING_REFS without blocking readers,
+  then refs of the repository are switched to them at once (locally, without network).
+
+  param : tuple of following
+    project     : project name
+    num         : number of this project
+    branches    : list of tuple (branch name, commit id of the last ingested tip)
+    options     : dict of options (see main())
+    locks       : dict of project name and file object of lock
+    parse_queue : queue to send branches to "parse" stage
+    events      : queue to notify the coordinator
+  """
+  (project, num, branches, options, locks, parse_queue, events) = param
+
+  plans = []
+  ok = False
+  conn = None
+  try:
+    repo = get_repo(project)
+
+    # Check refs on origin before locking, and skip fetching if nothing is changed.
+    # Branches are still planned, because the last ingestion may be failed.
+    changed = True
+    if not options['force']:
+      with metrics.timer(project, u'check'):
+        try:
+          changed = pgmaster_utils.git_remote_changed(repo)
+        except Exception as e:
+          progress.log(u'WARNING', num, u"Can't check refs on origin of %s. (%s)" % (project, str(e)))
+
+    fd = open(u'git/.update.' + project, 'w')
+    locks[project] = fd
+    with metrics.timer(project, u'lock'):
+      fcntl.flock(fd, fcntl.LOCK_EX)  # LOCK
+
+    if changed:
+      progress.log(u'LOG', num, u"Fetch from origin on %s" % (project))
+      with metrics.timer(project, u'fetch'):
+        fetch_staging(repo)
+      with metrics.timer(project, u'switch'):
+        with open(u'git/.lock.' + project, 'w') as fd_read:
+          fcntl.flock(fd_read, fcntl.LOCK_EX)  # LOCK readers
           try:
-            dml_insert_branch = u"""INSERT INTO
-                _branch (project, branch, commitid, scommitid, commitdate, commitdate_l, timezone_int)
-              VALUES
-                (%s, %s, %s, %s, %s, %s, %s)"""
-            if force:
-              # To simply skip when record is already existed, add "ON CONFLICT ... DO NOTHING" clause.
-              dml_insert_branch += u' ON CONFLICT ON CONSTRAINT _branch_pkey DO NOTHING'
-
-            cursor.execute(dml_insert_branch,
-              [project, branch, commit_id, s_commit_id, commit_date, commit_date_local, time_zone]
-            )
-
-            # There is NO "branch" column on _commitinfo table,
-            # because we want to avoid duplicate records of large text data like commit message.
-            # This is why only this SQL has "ON CONFLICT ... DO NOTHING" clause.
-            cursor.execute(u"""INSERT INTO
-                _commitinfo (project, commitid, author, committer, commitlog)
-              VALUES
-                (%s, %s, %s, %s, %s)
-              ON CONFLICT ON CONSTRAINT _commitinfo_pkey DO NOTHING""",
-              [project, commit_id, record.author.name, record.committer.name, record.message]
-            )
-
-            # Record commit-ids of "child" here.
-            parents = pgmaster_utils.git_ancestor(record)
-            if parents is not None:
-              for parent in parents:
-                children_old = pgmaster_utils.git_children(cursor, project, parent)
-                children = [commit_id]
-                children.extend(children_old if children_old is not None else [])
-                if set(children) != set(children_old if children_old is not None else []):
-                  # Need to update
-                  cursor.execute(u"""UPDATE
-                      _commitinfo
-                    SET
-                      children = %s,
-                      updatetime = now()
-                    WHERE
-                      project = %s and
-                      commitid = %s""",
-                    [list(set(children)), project, parent]
-                  )
-                  print(u"LOG[%d] <%s>: Commit '%s' updated for child '%s'." % (num, get_now(), parent, commit_id))
-                else:
-                  print(u"INFO[%d] <%s>: Commit '%s' is not needed to update. Skip" % (num, get_now(), parent))
-
-            conn.commit()
-            print(u"LOG[%d] <%s>: Commit '%s' inserted." % (num, get_now(), commit_id))
-          except psycopg2.Error as e:
-            conn.rollback()
-            if e.pgcode == '23505':
-              # Unique constraint violation on _branch (partitioned) table.
-              # This is expected because trying to insert from 1 day BEFORE last inserted.
-              # Therefore, simply ignoring.
-              print(u"INFO[%d] <%s>: Commit '%s' already exists. Skip." % (num, get_now(), commit_id))
-            else:
-              print(u"ERROR[%d] <%s>: %s ERRORCODE: %s" % (num, get_now(), e.pgerror, e.pgcode))
-              raise
-          except Exception as e:
-            conn.rollback()
+            switch_staging(repo)
+          finally:
+            fcntl.flock(fd_read, fcntl.LOCK_UN)  # UNLOCK readers
+      progress.log(u'LOG', num, u"Fetch done")
+    else:
+      progress.log(u'LOG', num, u"Nothing is changed on origin of %s. Skip fetching." % (project))
+
+    # Determine the start point to insert.
+    # Connection is used only while planning.
+    with metrics.timer(project, u'plan'):
+      conn = pg_conn.connect()
+      for (branch, old_tip) in branches:
+        try:
+          plan = plan_branch(conn, repo, num, project, branch, old_tip, options['force'])
+          if plan is not None:
+            plans.append((branch, plan))
+        except Exception as e:
+          if options['bulk']:
+            # All branches are needed to rebuild partitions.
             raise
-        # end of for records
-      # end of with
-      print(u"INFO[%d] <%s>: done." % (num, get_now()))
-    # end of for branches
-
-    # Push to other remote repositories if defined.
-    # Remote name must be other than "origin".
-    for remote_repo in repo.remotes:
-      if remote_repo.name == "origin":
-        print(u"INFO[%d] <%s>: Mirroring to remote 'origin' is skipped." % (num, get_now()))
-        continue
+          # Don't stop updating other branches.
+          progress.log(u'ERROR', num, u"Error occurred while planning \"%s\". (%s)" % (branch, str(e)))
+          print((u"DETAIL[%d]: " % (num)) + traceback.format_exc())
+      if options['bulk'] and len(plans) > 0:
+        with conn.cursor() as cursor:
+          bulk_prepare(cursor, project)
+        conn.commit()
+      else:
+        conn.rollback()  # End of read-only transaction.
+
+    # Commits inserted before back-patch groups were introduced are assigned only once.
+    # This is not needed in bulk mode, because all of commits are assigned again.
+    # And nothing is done if no branch is moved.
+    if not options['bulk'] and len(plans) > 0:
+      with metrics.timer(project, u'backfill'):
+        try:
+          backfill_bpgroups(conn, repo, num, project,
+            options['batch_size'] if options['batch_size'] > 0 else ROW_BY_ROW_CHUNK)
+        except Exception as e:
+          progress.log(u'WARNING', num, u"Can't assign back-patch groups to old commits of %s. (%s)" % (project, str(e)))
+    ok = True
+  except Exception as e:
+    progress.log(u'ERROR', num, u"Error occurred. (%s)" % (str(e)))
+    print((u"DETAIL[%d]: " % (num)) + traceback.format_exc())
+    plans = []
+  finally:
+    if conn is not None:
+      pg_conn.close(conn)
+
+  # Notify the count before sending, because loaders may finish soon.
+  events.put(('planned', project, len(plans), ok))
+  for (branch, plan) in plans:
+    # Choose the loader by the branch, to load all batches in order.
+    loader = zlib.crc32((u'%s/%s' % (project, branch)).encode('utf-8')) % options['load_workers']
+    parse_queue.put((project, num, branch, plan, loader))
+
+def unlock_project(project: str, num: int, locks: dict):
+  """
+  unlock_project() - Unlock the project
+  project : project name
+  num     : number of this project
+  locks   : dict of project name and file object of lock
+  """
+  fd = locks.pop(project, None)
+  if fd is not None:
+    fcntl.flock(fd, fcntl.LOCK_UN)  # UNLOCK
+    fd.close()
+
+def get_mirrors(project: str, num: int):
+  """
+  get_mirrors() - Get names of remote repositories to push
+  project : project name
+  num     : number of this project
+  """
+  mirrors = []
+  repo = get_repo(project)
+
+  # Push to other remote repositories if defined.
+  # Remote name must be other than "origin".
+  for remote_repo in repo.remotes:
+    if remote_repo.name == "origin":
+      progress.log(u'INFO', num, u"Mirroring to remote 'origin' is skipped.")
+      continue
+    mirrors.append(remote_repo.name)
+
+  return mirrors
+
+def record_push(project: str, remote: str, succeeded: bool, attempts: int, duration: float, message: str):
+  """
+  record_push() - Record the result of pushing to the mirror
+  project   : project name
+  remote    : remote name
+  succeeded : True if succeeded
+  attempts  : number of attempts
+  duration  : total seconds of pushing (including waiting to retry)
+  message   : error message of the last attempt (or None)
+  """
+  conn = pg_conn.connect()
+  try:
+    with conn.cursor() as cursor:
+      cursor.execute(u"""INSERT INTO remote_info (
+          project,
+          remote,
+          succeeded,
+          attempts,
+          duration,
+          message,
+          lastsuccess
+        ) VALUES (
+          %s,
+          %s,
+          %s,
+          %s,
+          make_interval(secs => %s),
+          %s,
+          CASE WHEN %s THEN now() END
+        ) ON CONFLICT ON CONSTRAINT remote_info_pkey
+        DO UPDATE SET
+          succeeded = excluded.succeeded,
+          attempts = excluded.attempts,
+          duration = excluded.duration,
+          message = excluded.message,
+          lastsuccess = coalesce(excluded.lastsuccess, remote_info.lastsuccess),
+          updatetime = now()""",
+        [project, remote, succeeded, attempts, duration, message, succeeded]
+      )
+    conn.commit()
+  except Exception as e:
+    conn.rollback()
+    raise
+  finally:
+    pg_conn.close(conn)
+
+def push_mirror(param):
+  """
+  push_mirror() - Push all branches and tags to the mirror (run in "push" stage)
+  param : tuple of following
+    project : project name
+    num     : number of this project
+    remote  : remote name
+    options : dict of options (see main())
+    events  : queue to notify the coordinator
+  """
+  (project, num, remote, options, events) = param
+
+  succeeded = False
+  message = None
+  attempt = 0
+  start = time.monotonic()
+  try:
+    git_cmd = get_repo(project).git
+    while attempt < options['push_retries'] + 1:
+      if attempt > 0:
+        # Exponential backoff
+        wait = options['push_backoff'] * (2 ** (attempt - 1))
+        progress.log(u'WARNING', num, u"Retry mirroring to '%s' after %d seconds." % (remote, wait))
+        time.sleep(wait)
+      attempt += 1
 
       try:
-        git_cmd.push(remote_repo.name, u'--all')
-        print(u"LOG[%d] <%s>: Pushed all branches to '%s'." % (num, get_now(), remote_repo.name))
-        git_cmd.push(remote_repo.name, u'--tags')
-        print(u"LOG[%d] <%s>: Pushed all tags to '%s'." % (num, get_now(), remote_repo.name))
+        # Hanging push is killed after timeout.
+        git_cmd.push(remote, u'--all', kill_after_timeout = options['push_timeout'])
+        progress.log(u'LOG', num, u"Pushed all branches to '%s'." % (remote))
+        git_cmd.push(remote, u'--tags', kill_after_timeout = options['push_timeout'])
+        progress.log(u'LOG', num, u"Pushed all tags to '%s'." % (remote))
+        succeeded = True
+        message = None
+        break
       except Exception as e:
-        print(u"ERROR[%d] <%s>: Error occurred while mirroring to '%s'. (%s)" % (num, get_now(), remote_repo.name, str(e)))
+        message = str(e)
+        progress.log(u'ERROR', num, u"Error occurred while mirroring to '%s'. (%s)" % (remote, message))
         print((u"DETAIL[%d]: " % (num)) + traceback.format_exc())
-        # Don't stop mirroring.
-
+    # end of while
   except Exception as e:
-    print(u"ERROR[%d] <%s>: Error occurred. (%s)" % (num, get_now(), str(e)))
+    message = str(e)
+    progress.log(u'ERROR', num, u"Error occurred while mirroring to '%s'. (%s)" % (remote, message))
     print((u"DETAIL[%d]: " % (num)) + traceback.format_exc())
+
+  duration = time.monotonic() - start
+  progress.log(u'LOG' if succeeded else u'ERROR', num, u"Mirroring to '%s' %s. (%d attempts, %.1f seconds)" % (
+    remote, u"succeeded" if succeeded else u"failed", attempt, duration))
+  metrics.set_remote(project, remote, succeeded, attempt, duration)
+
+  try:
+    record_push(project, remote, succeeded, attempt, duration, message)
+  except Exception as e:
+    progress.log(u'ERROR', num, u"Error occurred while recording mirroring to '%s'. (%s)" % (remote, str(e)))
   finally:
-    if fd is not None:
-      fcntl.flock(fd, fcntl.LOCK_UN)  # UNLOCK
-      fd.close()
-    pg_conn.close(conn)
+    events.put(('pushed', project, remote, succeeded))
 
-def main(force: bool = False):
+def make_progress(options: dict):
   """
-  Main
+  make_progress() - Make pgmaster_metrics.progress_log instance
+  options : dict of options (see main())
   """
+  return pgmaster_metrics.progress_log(level = options['log_level'], interval = options['log_interval'])
 
-  if force:
-    print("LOG[0] <%s>: Specified force importing." % get_now())
+def parse_worker(parse_queue, load_queues, options):
+  """
+  parse_worker() - Read commits of each branch, and send them to loaders (run in "parse" stage)
+  parse_queue : queue to receive branches, None to stop
+  load_queues : list of queues to send batches to each loader
+  options     : dict of options (see main())
+  """
+  global progress
+  # This runs in its own process, and globals set under "__main__" are not there
+  # unless the process is forked. So logging is set up again from options.
+  # ("metrics" is not used here. Statistics are sent to loaders with "done" instead.)
+  progress = make_progress(options)
+
+  repos = {}
+  abbrevs = {}
+  batch_size = options['batch_size'] if options['batch_size'] > 0 else ROW_BY_ROW_CHUNK
+  cache = None
+  if options['warm_diffs'] > 0 and options['diff_cache_dir'] is not None:
+    cache = pgmaster_cache.diff_cache(options['diff_cache_dir'], options['diff_cache_size'])
+
+  while True:
+    job = parse_queue.get()
+    if job is None:
+      break
+
+    (project, num, branch, (rev, since, new_tip), loader) = job
+    load_queue = load_queues[loader]
+    try:
+      if project not in repos:
+        repos[project] = Repo(u'git/' + project + u'.git')
+        # Index of all object ids to calculate short commit ids.
+        # This is reloaded automatically when the repository is fetched.
+        abbrevs[project] = pgmaster_utils.git_abbrev(u'git/' + project + u'.git')
+      repo = repos[project]
+      abbrev = abbrevs[project]
+
+      # Statistics of reading, sent to loader with "done".
+      # Time waiting for loaders is not included in "walk".
+      stats = {'started': time.time(), 'walk': 0.0, 'commits': 0}
+      walk_start = time.monotonic()
+
+      def send(batch):
+        # Short commit ids and patch-ids are calculated at once for each batch.
+        hexshas = [record.hexsha for record in batch]
+        s_commit_ids = abbrev.abbrev(hexshas)
+        patch_ids = pgmaster_utils.git_patch_ids(repo, hexshas)
+        entries = [
+          (make_commit_row(record, s_commit_ids[record.hexsha], patch_ids.get(record.hexsha)), record.parents)
+          for record in batch
+        ]
+        stats['walk'] += time.monotonic() - walk_start
+        stats['commits'] += len(batch)
+        load_queue.put(('batch', project, num, branch, entries))
+        return time.monotonic()
+      # end of nested (internal) function
+
+      # Merge commits are not inserted,
+      # and commits are read from oldest to latest with constant memory.
+      progress.log(u'INFO', num, u"Start updating \"%s\"." % (branch))
+      batch = []
+      newest = collections.deque(maxlen = options['warm_diffs'])
+      for record in pgmaster_utils.git_log_records(repo, rev, since = since):
+        batch.append(record)
+        if cache is not None:
+          newest.append(record.hexsha)
+        if len(batch) >= batch_size:
+          walk_start = send(batch)
+          batch = []
+      if len(batch) > 0:
+        walk_start = send(batch)
+      stats['walk'] += time.monotonic() - walk_start
+
+      load_queue.put(('done', project, num, branch, new_tip, None, stats))
+    except Exception as e:
+      progress.log(u'ERROR', num, u"Error occurred while reading \"%s\". (%s)" % (branch, str(e)))
+      print((u"DETAIL[%d]: " % (num)) + traceback.format_exc())
+      load_queue.put(('done', project, num, branch, None, str(e), None))
+      continue
+
+    if cache is not None and len(newest) > 0:
+      warm_diffs(cache, repo, num, branch, newest)
+
+def warm_diffs(cache, repo, num: int, branch: str, hexshas):
+  """
+  warm_diffs() - Render diffs of new commits into the cache of web UI (run in "parse" stage)
+  cache   : pgmaster_cache.diff_cache instance
+  repo    : git.Repo instance of the repository
+  num     : number of the project
+  branch  : branch name
+  hexshas : commit ids to render
+  This is done after the branch is sent to the loader, so loading is not delayed.
+  Failure is only logged, because caching is not necessary.
+  """
+  warmed = 0
+  try:
+    for hexsha in hexshas:
+      if cache.contains(hexsha):
+        continue
+      pgmaster_utils.load_diffs(repo.commit(hexsha), cache)
+      warmed += 1
+    progress.log(u'LOG', num, u"%d diffs of \"%s\" are cached." % (warmed, branch))
+  except Exception as e:
+    progress.log(u'WARNING', num, u"Can't cache diffs of \"%s\". (%s)" % (branch, str(e)))
+
+def load_worker(load_queue, events, options):
+  """
+  load_worker() - Insert batches into the database (run in "load" stage)
+  load_queue : queue to receive batches, None to stop
+  events     : queue to notify the coordinator
+  options    : dict of options (see main())
+  """
+  conn = None
+  failed = set()  # Branches failed to load. Following batches are discarded.
+
+  def connect():
+    # Connect (again) if not connected, or the last one is broken.
+    nonlocal conn
+    if conn is None:
+      conn = pg_conn.connect()
+    return conn
+  # end of nested (internal) function
 
+  def disconnect(e):
+    # Discard the connection if it is broken (e.g. database is restarted), to connect again for the next batch.
+    nonlocal conn
+    if conn is not None and (isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError)) or conn.closed):
+      try:
+        pg_conn.close(conn, discard = True)
+      except Exception:
+        pass
+      conn = None
+  # end of nested (internal) function
+
+  try:
+    while True:
+      msg = load_queue.get()
+      if msg is None:
+        break
+
+      if msg[0] == 'batch':
+        (_, project, num, branch, entries) = msg
+        if (project, branch) in failed:
+          continue
+        try:
+          if options['bulk']:
+            load_bulk(connect(), num, project, branch, entries)
+          elif options['batch_size'] > 0:
+            load_batch(connect(), num, project, branch, entries)
+          else:
+            load_rows(connect(), num, project, branch, entries, options['force'])
+          metrics.add_commits(project, branch, len(entries))
+          b = metrics.get_branch(project, branch)
+          progress.progress((project, branch), num, u"%d commits %s to \"%s\". (%d commits processed)" % (
+            b['rows'].get(u'staged' if options['bulk'] else u'_branch', 0),
+            u"staged" if options['bulk'] else u"inserted", branch, b['commits']))
+        except Exception as e:
+          # Don't stop updating other branches.
+          # Following batches of this branch are discarded not to leave a gap, even if reconnected.
+          progress.log(u'ERROR', num, u"Error occurred while updating \"%s\". (%s)" % (branch, str(e)))
+          print((u"DETAIL[%d]: " % (num)) + traceback.format_exc())
+          failed.add((project, branch))
+          disconnect(e)
+      else:
+        # All batches of this branch are sent.
+        (_, project, num, branch, new_tip, error, stats) = msg
+        ok = (error is None and (project, branch) not in failed)
+        failed.discard((project, branch))
+        if ok and not options['bulk']:
+          # In bulk mode, tips are recorded when partitions are swapped.
+          try:
+            # Record the tip, to start from here in the next time.
+            update_tip(connect(), project, branch, new_tip)
+          except Exception as e:
+            progress.log(u'ERROR', num, u"Error occurred while updating \"%s\". (%s)" % (branch, str(e)))
+            print((u"DETAIL[%d]: " % (num)) + traceback.format_exc())
+            ok = False
+            disconnect(e)
+
+        elapsed = None
+        if stats is not None:
+          metrics.add_time(project, u'walk', stats['walk'], branch)
+          elapsed = time.time() - stats['started']
+        metrics.set_branch(project, branch, ok, elapsed)
+        if ok:
+          b = metrics.get_branch(project, branch)
+          progress.progress((project, branch), num, u"\"%s\" done. (%d commits %s, %d commits processed, %.1f commits/sec)" % (
+            branch, b['rows'].get(u'staged' if options['bulk'] else u'_branch', 0),
+            u"staged" if options['bulk'] else u"inserted",
+            b['commits'], b['commits'] / elapsed if elapsed else 0.0), level = u'INFO', force = True)
+        events.put(('loaded', project, branch, ok, new_tip))
+  finally:
+    if conn is not None:
+      pg_conn.close(conn)
+
+def load_projects():
+  """
+  load_projects() - Read projects and branches to update
+  Returns tuple of following
+    dict of project name and its update interval in seconds (or None)
+    dict of project name and list of tuple (branch name, commit id of the last ingested tip)
+  """
   conn = pg_conn.connect()
-  rows = []
+  projects = {}
+  branches = {}
   try:
-    print("LOG[0] <%s>: connect for getting project informations." % get_now())
     with conn.cursor() as cursor:
       cursor.execute(u"""SELECT
-        project
-      FROM
-        project_info"""
+          project,
+          extract(epoch FROM update_interval)
+        FROM
+          project_info"""
+      )
+      for (p, interval) in cursor.fetchall():
+        projects[p] = float(interval) if interval is not None else None
+
+      cursor.execute(u"""SELECT
+          project,
+          branch,
+          tipcommitid
+        FROM
+          repository_info"""
       )
-      rows.extend([r for (r,) in cursor.fetchall()])
+      for (p, b, tip) in cursor.fetchall():
+        branches.setdefault(p, []).append((b, tip))
+    conn.rollback()  # End of read-only transaction.
+  finally:
+    pg_conn.close(conn)
+
+  return (projects, branches)
+
+def next_delay(interval: float, failures: int, options: dict) -> float:
+  """
+  next_delay() - Calculate seconds until the next update of the project
+  interval : update interval of the project in seconds
+  failures : number of consecutive failures of the project
+  options  : dict of options (see main())
+  """
+  # Exponential backoff on failure
+  delay = min(interval * (2 ** failures), max(interval, options['max_backoff']))
+  # Jitter not to update all projects at the same time
+  jitter = options['jitter'] / 100.0
+  return delay * random.uniform(1.0 - jitter, 1.0 + jitter)
+
+def main(options: dict):
+  """
+  Main
+  options : dict of following
+    force           : DO force importing
+    bulk            : rebuild partitions of each project from staged commits (with force)
+    daemon          : keep running and update each project periodically
+    interval        : default update interval of each project in seconds (daemon mode)
+    max_backoff     : max seconds of update interval after failures (daemon mode)
+    jitter          : percentage of random jitter of update interval (daemon mode)
+    reload_interval : seconds to reload projects and branches (daemon mode)
+    batch_size      : number of commits in each batch (0 to insert one by one)
+    fetch_workers   : number of projects fetched in parallel
+    parse_workers   : number of processes to read commits
+    load_workers    : number of connections to insert commits
+    queue_depth     : max number of batches waiting for each loader
+    push_workers    : number of mirrors pushed in parallel
+    push_timeout    : seconds to kill each push
+    push_retries    : number of retries of pushing to each mirror
+    push_backoff    : seconds to wait before the first retry (doubled each time)
+    report_json     : path to write the run report as JSON (or None)
+    report_prom     : path to write the run report as Prometheus textfile (or None)
+    warm_diffs      : number of the newest commits of each branch to cache diffs (0 to disable)
+    diff_cache_dir  : directory of the cache of diffs shared with web UI (or None)
+    diff_cache_size : maximum bytes of the cache of diffs
+    log_level       : minimum level of messages to print
+    log_interval    : minimum seconds between progress messages of each branch
+  """
+  force = options['force']
+  daemon = options['daemon']
+
+  if force:
+    progress.log(u'LOG', 0, u"Specified force importing.")
+
+  try:
+    progress.log(u'LOG', 0, u"connect for getting project informations.")
+    (projects, branches) = load_projects()
   except Exception as e:
-    print(u"ERROR[0] <%s>: Error occurred. (%s)" % (get_now(), str(e)))
+    progress.log(u'ERROR', 0, u"Error occurred. (%s)" % (str(e)))
     print(u"DETAIL[0]: " + traceback.format_exc())
     sys.exit(1)
+
+  if len(projects) <= 0 and not daemon:
+    return
+
+  # Stop scheduling by SIGTERM (or SIGINT) in daemon mode,
+  # and exit after running projects are finished.
+  stopping = threading.Event()
+  if daemon:
+    def stop(signum, frame):
+      progress.log(u'LOG', 0, u"Stopping after running projects are finished.")
+      stopping.set()
+    # end of nested (internal) function
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+  # Start processes before any threads, because they are forked.
+  parse_queue = multiprocessing.Queue()
+  load_queues = [multiprocessing.Queue(options['queue_depth']) for n in range(0, options['load_workers'])]
+  parsers = [
+    multiprocessing.Process(target = parse_worker, args = (parse_queue, load_queues, options))
+    for n in range(0, options['parse_workers'])
+  ]
+  for p in parsers:
+    p.start()
+
+  events = queue.Queue()
+  loaders = [
+    threading.Thread(target = load_worker, args = (q, events, options))
+    for q in load_queues
+  ]
+  for t in loaders:
+    t.start()
+
+  locks = {}
+  numbers = {}
+  try:
+    with concurrent.futures.ThreadPoolExecutor(max_workers = options['fetch_workers']) as executor, \
+         concurrent.futures.ThreadPoolExecutor(max_workers = options['push_workers']) as push_executor:
+      # Coordinate stages until all projects are finished.
+      # In daemon mode, each project is scheduled again after finished.
+      pending = {}
+      pushing = {}
+      push_started = {}
+      succeeded = {}
+      staged = {}  # Tips of staged branches of each project (bulk mode)
+      swapped = set()
+      running = set()
+      failures = {}
+      due = {}
+      reloaded = time.monotonic()
+
+      def schedule(now):
+        for project in sorted(projects.keys()):
+          if project not in numbers:
+            numbers[project] = len(numbers) + 1
+          if project not in due and project not in running:
+            due[project] = now
+        for project in list(due.keys()):
+          if project not in projects:
+            del due[project]
+      # end of nested (internal) function
+
+      def finish(project):
+        num = numbers[project]
+        metrics.set_project(project, succeeded[project])
+        progress.log(u'INFO', num, u"%s done." % (project))
+        running.discard(project)
+        if daemon and project in projects:
+          failures[project] = 0 if succeeded[project] else failures.get(project, 0) + 1
+          delay = next_delay(projects[project] or options['interval'], failures[project], options)
+          due[project] = time.monotonic() + delay
+          progress.log(u'LOG', num, u"Next update of %s is after %d seconds." % (project, delay))
+          write_report(options)
+      # end of nested (internal) function
+
+      schedule(time.monotonic())
+      while True:
+        now = time.monotonic()
+        if daemon and now - reloaded >= options['reload_interval'] and not stopping.is_set():
+          # Pick up added (or removed) projects and branches.
+          try:
+            (projects, loaded_branches) = load_projects()
+            for project in projects:
+              if project not in running:
+                branches[project] = loaded_branches.get(project, [])
+          except Exception as e:
+            progress.log(u'ERROR', 0, u"Can't reload project informations. (%s)" % (str(e)))
+          reloaded = now
+          schedule(now)
+
+        # Start projects to be updated.
+        if not stopping.is_set():
+          for project in sorted(due.keys(), key = lambda p: due[p]):
+            if due[project] > now:
+              break
+            del due[project]
+            running.add(project)
+            if daemon:
+              metrics.reset_project(project)
+            executor.submit(fetch_project, (
+              project, numbers[project], list(branches.get(project, [])), options, locks, parse_queue, events
+            ))
+
+        if len(running) <= 0 and (len(due) <= 0 or stopping.is_set()):
+          break
+
+        # Wait for events, or until the next project is due.
+        timeout = None
+        if daemon:
+          timeout = 1.0  # To check "stopping" periodically
+          if len(due) > 0 and not stopping.is_set():
+            timeout = max(0.0, min(timeout, min(due.values()) - now))
+        try:
+          event = events.get(timeout = timeout)
+        except queue.Empty:
+          continue
+
+        if event[0] == 'planned':
+          (_, project, count, ok) = event
+          pending[project] = count
+          succeeded[project] = ok
+          staged[project] = []
+          pushing.pop(project, None)
+          if not ok:
+            # Don't push when failed to fetch.
+            pushing[project] = None
+        elif event[0] == 'loaded':
+          (_, project, branch, ok, new_tip) = event
+          pending[project] -= 1
+          if ok:
+            # Start from here in the next time.
+            branches[project] = [
+              (b, new_tip if b == branch else tip) for (b, tip) in branches.get(project, [])
+            ]
+            staged[project].append((branch, new_tip))
+          else:
+            succeeded[project] = False
+            progress.log(u'ERROR', numbers[project], u"Failed to update \"%s\"." % (branch))
+        elif event[0] == 'pushed':
+          (_, project, remote, ok) = event
+          pushing[project] -= 1
+          if not ok:
+            succeeded[project] = False
+          if pushing[project] <= 0:
+            metrics.add_time(project, u'push', time.monotonic() - push_started[project])
+            finish(project)
+          continue
+        elif event[0] == 'swapped':
+          (_, project, ok) = event
+          swapped.add(project)
+          if not ok:
+            succeeded[project] = False
+
+        if pending[project] > 0:
+          continue
+
+        if options['bulk'] and project not in swapped:
+          # Rebuild partitions from staged commits, before unlocking.
+          executor.submit(bulk_finish, (
+            project, numbers[project], staged[project],
+            succeeded[project] and len(staged[project]) > 0, events
+          ))
+          continue
+        swapped.discard(project)
+
+        # All branches of this project are loaded.
+        # Unlock before pushing, not to block next update by slow mirrors.
+        num = numbers[project]
+        unlock_project(project, num, locks)
+        mirrors = []
+        if project not in pushing:
+          try:
+            mirrors = get_mirrors(project, num)
+          except Exception as e:
+            progress.log(u'ERROR', num, u"Error occurred. (%s)" % (str(e)))
+            print((u"DETAIL[%d]: " % (num)) + traceback.format_exc())
+
+        pushing[project] = len(mirrors)
+        if len(mirrors) > 0:
+          # Push to all mirrors in parallel.
+          push_started[project] = time.monotonic()
+          for remote in mirrors:
+            push_executor.submit(push_mirror, (project, num, remote, options, events))
+        else:
+          finish(project)
+    # end of with executor
   finally:
-    pg_conn.close(conn)
+    # Stop parsers first, because they may be sending to loaders.
+    for p in parsers:
+      parse_queue.put(None)
+    for p in parsers:
+      p.join()
+    for q in load_queues:
+      q.put(None)
+    for t in loaders:
+      t.join()
 
-  if len(rows) <= 0:
-    pass
-  elif len(rows) == 1:
-    update_repo((rows[0], 1, force))
-  else:
-    with concurrent.futures.ProcessPoolExecutor(max_workers = len(rows)) as executor:
-      params = map(lambda n : (rows[n], n + 1, force), range(0, len(rows)))
-      executor.map(update_repo, params)
+  metrics.finish()
+  report = metrics.report()
+  progress.log(u'INFO', 0, u"%d commits processed in %.1f seconds. (%.1f commits/sec)" % (
+    report['commits'], report['duration'], report['commits_per_second'] or 0.0))
+  write_report(options)
+
+def write_report(options: dict):
+  """
+  write_report() - Write the run report to files specified by options (see main())
+  options : dict of options
+  """
+  for (path, write) in [
+    (options['report_json'], metrics.write_json),
+    (options['report_prom'], metrics.write_prometheus)
+  ]:
+    if path is None:
+      continue
+    try:
+      write(path)
+    except Exception as e:
+      progress.log(u'ERROR', 0, u"Can't write the run report to \"%s\". (%s)" % (path, str(e)))
 
 if __name__ == "__main__":
   print("LOG[0] <%s>: Start to update repository information from <%s>" % (get_now(),get_now(True)))
@@ -266,6 +1877,15 @@ if __name__ == "__main__":
   # Parse arguments.
   arg_parser = argparse.ArgumentParser()
   arg_parser.add_argument("-f", "--force", action = 'store_true', help = u"Force import. (This may take a long time)")
+  arg_parser.add_argument("--bulk", action = 'store_true', help = u"Force import, and rebuild partitions of each project. (Implies -f)")
+  arg_parser.add_argument("-d", "--daemon", action = 'store_true', help = u"Keep running, and update each project periodically.")
+  arg_parser.add_argument("-b", "--batch-size", type = int, help = u"Number of commits inserted in each transaction. (0 to insert one by one)")
+  arg_parser.add_argument("--fetch-workers", type = int, help = u"Number of projects fetched in parallel.")
+  arg_parser.add_argument("--parse-workers", type = int, help = u"Number of processes to read commits.")
+  arg_parser.add_argument("--load-workers", type = int, help = u"Number of database connections to insert commits.")
+  arg_parser.add_argument("--report-json", help = u"Path to write the run report as JSON.")
+  arg_parser.add_argument("--report-prom", help = u"Path to write the run report as Prometheus textfile.")
+  arg_parser.add_argument("--log-level", choices = pgmaster_metrics.LOG_LEVELS, help = u"Minimum level of messages to print.")
   args = arg_parser.parse_args()
 
   # Read configuration file
@@ -273,16 +1893,63 @@ if __name__ == "__main__":
   config_ini.read('pgmaster.ini', encoding = 'utf-8')
   dbinfo = config_ini['PGMASTER']
 
+  # Command line option takes priority over the configuration file.
+  def get_option(value, key, default, minimum):
+    if value is None:
+      value = config_ini.getint('UPDATE', key, fallback = default)
+    if value < minimum:
+      arg_parser.error(u"%s must be %d or greater." % (key, minimum))
+    return value
+  # end of nested (internal) function
+
+  options = {
+    'force'           : args.force or args.bulk,
+    'bulk'            : args.bulk,
+    'daemon'          : args.daemon,
+    'interval'        : get_option(None, 'Interval', 600, 1),
+    'max_backoff'     : get_option(None, 'MaxBackoff', 3600, 1),
+    'jitter'          : get_option(None, 'Jitter', 10, 0),
+    'reload_interval' : get_option(None, 'ReloadInterval', 600, 1),
+    'batch_size'      : get_option(args.batch_size, 'BatchSize', 1000, 0),
+    'fetch_workers'   : get_option(args.fetch_workers, 'FetchWorkers', 4, 1),
+    'parse_workers'   : get_option(args.parse_workers, 'ParseWorkers', 2, 1),
+    'load_workers'    : get_option(args.load_workers, 'LoadWorkers', 4, 1),
+    'queue_depth'     : get_option(None, 'QueueDepth', 4, 1),
+    'push_workers'    : get_option(None, 'PushWorkers', 4, 1),
+    'push_timeout'    : get_option(None, 'PushTimeout', 300, 1),
+    'push_retries'    : get_option(None, 'PushRetries', 2, 0),
+    'push_backoff'    : get_option(None, 'PushBackoff', 10, 0),
+    'report_json'     : args.report_json or config_ini.get('UPDATE', 'ReportJson', fallback = None),
+    'report_prom'     : args.report_prom or config_ini.get('UPDATE', 'ReportPrometheus', fallback = None),
+    'warm_diffs'      : get_option(None, 'WarmDiffCache', 0, 0),
+    'diff_cache_dir'  : config_ini.get('WEB', 'DiffCacheDir', fallback = None) or None,
+    'diff_cache_size' : config_ini.getint('WEB', 'DiffCacheSize', fallback = 1024) * 1024 * 1024
+  }
+  if options['jitter'] >= 100:
+    arg_parser.error(u"Jitter must be less than 100.")
+  if (args.force or args.bulk) and args.daemon:
+    arg_parser.error(u"Force importing can't be specified with daemon mode.")
+
+  options['log_level'] = args.log_level or config_ini.get('UPDATE', 'LogLevel', fallback = 'LOG').upper()
+  if options['log_level'] not in pgmaster_metrics.LOG_LEVELS:
+    arg_parser.error(u"LogLevel must be one of %s." % (u', '.join(pgmaster_metrics.LOG_LEVELS)))
+  options['log_interval'] = get_option(None, 'ProgressInterval', 10, 0)
+  progress = make_progress(options)
+  metrics = pgmaster_metrics.run_metrics()
+
   # Connect to the database
+  # In daemon mode, connections are pooled for all workers (and the coordinator).
   pg_conn = pg_connection.pg_connection(
     server = dbinfo['Server'],
     port = dbinfo['Port'],
     database = dbinfo['Database'],
     user = dbinfo['User'],
     password = dbinfo['Password'],
-    pooling = 0 # Ignore setting
+    pooling = (
+      options['load_workers'] + options['fetch_workers'] + options['push_workers'] + 1
+    ) if options['daemon'] else 0 # Ignore setting
   )
 
-  main(args.force)
+  main(options)
 
   print("LOG[0] <%s>: All have done. <%s>" % (get_now(), get_now(True)))
@@ -17,40 +17,37 @@
 # You should have received a copy of the GNU General Public License
 # along with "pgmaster2".  If not, see <http://www.gnu.org/licenses/>.
 
+import errno
+import hashlib
 import traceback
 import psycopg2
 import fcntl
 from git import *
 from flask import *
 
+import pgmaster_utils
+
 api = Blueprint('webapi_v1', __name__)
 
 @api.route('/p/<project>/keyword')
 def keywords(project):
+  """
+  keywords() - Get keywords used in investigations.
+    project : project name
+  Query parameter "prefix" gets only keywords starting with it, most used first (for autocomplete),
+  and "limit" limits number of keywords.
+  """
+  prefix = request.args.get('prefix')
+  limit = request.args.get('limit', type = int)  # None if invalid
+  if limit is not None and limit < 0:
+    limit = None
+
   pg_conn = current_app.config['PG_CONNECTION']
   conn = pg_conn.connect()
   # Get keywords
-  # TODO: Commonalize logic between here and normal page.
-  keywords = []
   try:
     with conn.cursor() as cursor:
-      cursor.execute(u"""SELECT
-          array_agg(DISTINCT k)
-        FROM (
-          SELECT
-            UNNEST(keywords) AS k
-          FROM
-            _investigation i
-          WHERE
-            project = %s AND keywords IS NOT NULL
-          ORDER BY
-            k
-        ) AS t""",
-        [project]
-      )
-
-      c = cursor.fetchone()
-      keywords.extend(c[0] if c[0] is not None else [])
+      keywords = pgmaster_utils.get_keywords(cursor, project, prefix, limit)
   finally:
     pg_conn.close(conn)
 
@@ -59,6 +56,81 @@ def keywords(project):
     'keywords': keywords
   })
 
+@api.route('/p/<project>/b/<path:branch>/c/<commitid>', methods = ['GET'])
+def commit_detail(project, branch, commitid):
+  """
+  commit_detail() - Get information and investigation of the commit, without reading the repository.
+    project : project name
+    branch  : branch name
+    commitid: commitid
+  Parents are not in order of git (see pgmaster_utils.get_commit_detail()).
+  """
+  def make_links(commitid_list, related):
+    return [
+      {
+        'id'     : x,
+        'sid'    : related[x][0] if x in related else None,
+        'branch' : related[x][1] if x in related else None
+      } for x in commitid_list
+    ]
+  # end of nested (internal) function
+
+  def isoformat(value):
+    return value.isoformat() if value is not None else None
+  # end of nested (internal) function
+
+  pg_conn = current_app.config['PG_CONNECTION']
+  conn = pg_conn.connect()
+  try:
+    with conn.cursor() as cursor:
+      detail = pgmaster_utils.get_commit_detail(cursor, project, branch, commitid)
+  except psycopg2.Error as e:
+    return jsonify({
+      'succeed' : False,
+      'trace'   : traceback.format_exc()
+    }), 500
+  finally:
+    pg_conn.close(conn)
+
+  if detail is None:
+    return jsonify({
+      'succeed' : False,
+      'cause'   : u'Not Found.'
+    }), 404
+
+  investigation = detail['investigation']
+  if investigation is not None:
+    investigation = dict(investigation, updatetime = isoformat(investigation['updatetime']))
+  repo_browser = None
+  if detail['repo_browse_url'] is not None:
+    repo_browser = detail['repo_browse_url'].replace(u'%%COMMITID%%', commitid, 1)
+
+  return jsonify({
+    'succeed'       : True,
+    'commit'        : {
+      'id'        : detail['id'],
+      'sid'       : detail['sid'],
+      'date'      : isoformat(detail['date']),
+      'tz'        : detail['tz'],
+      'author'    : detail['author'],
+      'committer' : detail['committer'],
+      'summary'   : detail['summary'],
+      'message'   : detail['message'],
+      'parents'   : make_links(detail['parents'], detail['related']),
+      'children'  : make_links(detail['children'], detail['related'])
+    },
+    'backpatches'   : [
+      {
+        'id'     : x[0],
+        'sid'    : x[1],
+        'branch' : x[2]
+      } for x in detail['backpatches']
+    ],
+    'investigation' : investigation,
+    'keywords'      : detail['keywords'],
+    'repo_browser'  : repo_browser
+  })
+
 @api.route('/p/<project>/b/<path:branch>/c/<commitid>/modify', methods = ['POST'])
 def investigate_modify(project, branch, commitid):
   """
@@ -103,6 +175,23 @@ def investigate_modify(project, branch, commitid):
 
   try:
     with conn.cursor() as cursor:
+      # Serialize modifications of the same investigation until commit,
+      # to count keywords removed and added correctly.
+      cursor.execute(u"""SELECT
+          pg_advisory_xact_lock(hashtext(%s))""",
+        [u'\n'.join([project, branch, commitid])]
+      )
+      cursor.execute(u"""SELECT
+          keywords
+        FROM
+          _investigation
+        WHERE
+          project = %s AND branch = %s AND commitid = %s""",
+        [project, branch, commitid]
+      )
+      c = cursor.fetchone()
+      old_keywords = c[0] if c is not None else None
+
       cursor.execute(u"""INSERT INTO _investigation (
           project,
           branch,
@@ -140,6 +229,7 @@ def investigate_modify(project, branch, commitid):
           form_data['keywords']
         ]
       )
+      pgmaster_utils.update_keywords(cursor, project, old_keywords, form_data['keywords'])
     conn.commit()
   except psycopg2.Error as e:
     return jsonify({
@@ -198,30 +288,49 @@ def translate_commitlog(project, commitid):
   translate_to = 'ja'
 
   fd = None
+  handle = None
   try:
     # Connect to git repository
     fd = open(u'git/.lock.' + project, 'r')
-    fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)  # LOCK!
-    repo = Repo(u'git/' + project + u'.git')
+    pgmaster_utils.lock_shared(fd, current_app.config['LOCK_TIMEOUT'])  # LOCK!
+    handle = current_app.config['GIT_REPOSITORIES'].acquire(project)
 
-    if not repo.bare:
-      raise FileNotFoundError
+    # Read the message here, not to lock the repository while translating.
+    message = handle.commit(commitid).message
+    current_app.config['GIT_REPOSITORIES'].release(project)
+    handle = None
+    fcntl.flock(fd, fcntl.LOCK_UN)  # UNLOCK!
+    fd.close()
+    fd = None
 
     # Translate here
-    commit = repo.commit(commitid)
-    translated_message = translate(format_to_translation(commit.message), translate_from, translate_to)
+    translated_message = translate(format_to_translation(message), translate_from, translate_to)
 
   except (FileNotFoundError, ValueError) as e:
     return jsonify({
       'succeed' : False,
       'cause'   : u'Not Found.'
     }), 404
+  except OSError as e:
+    # Can't aquire lock
+    if e.errno == errno.EACCES or e.errno == errno.EAGAIN:
+      return jsonify({
+        'succeed' : False,
+        'cause'   : u'Repository is being updated.'
+      }), 503
+    return jsonify({
+      'succeed' : False,
+      'trace'   : traceback.format_exc()
+    }), 500
   except:
     return jsonify({
       'succeed' : False,
       'trace'   : traceback.format_exc()
     }), 500
   finally:
+    if handle is not None:
+      current_app.config['GIT_REPOSITORIES'].release(project)
+      handle = None
     if fd is not None:
       fcntl.flock(fd, fcntl.LOCK_UN)  # UNLOCK!
       fd.close()
@@ -231,3 +340,125 @@ def translate_commitlog(project, commitid):
     'succeed' : True,
     'message' : translated_message
   })
+
+# Responses determined only by commit id are cached for a year.
+IMMUTABLE_CACHE_CONTROL = u'public, max-age=31536000, immutable'
+
+def with_commit(project: str, commitid: str, func, etag: str = None):
+  """
+  with_commit() - Call func with the commit, while the repository is locked.
+    project  : project name
+    commitid : commitid (full)
+    func     : function to make the response from git.Commit instance
+    etag     : ETag of the response if it is immutable (or None)
+  Returns the response, or error response.
+  If "If-None-Match" matches etag, "304 Not Modified" is returned without reading the repository.
+  """
+  if len(commitid) != 40:
+    return jsonify({
+      'succeed' : False,
+      'cause'   : u'Not Found.'
+    }), 404
+
+  if etag is not None:
+    etag = hashlib.sha1(repr((current_app.config['ETAG_SALT'], project, etag)).encode('utf-8')).hexdigest()
+    if request.if_none_match.contains(etag):
+      response = Response(status = 304)
+      response.set_etag(etag)
+      response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+      return response
+
+  repos = current_app.config['GIT_REPOSITORIES']
+  fd = None
+  handle = None
+  try:
+    # Connect to git repository
+    fd = open(u'git/.lock.' + project, 'r')
+    pgmaster_utils.lock_shared(fd, current_app.config['LOCK_TIMEOUT'])  # LOCK!
+    handle = repos.acquire(project)
+    response = func(handle.commit(commitid))
+    if etag is not None:
+      response.set_etag(etag)
+      response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+    return response
+
+  except (FileNotFoundError, ValueError) as e:
+    return jsonify({
+      'succeed' : False,
+      'cause'   : u'Not Found.'
+    }), 404
+  except OSError as e:
+    # Can't aquire lock
+    if e.errno == errno.EACCES or e.errno == errno.EAGAIN:
+      return jsonify({
+        'succeed' : False,
+        'cause'   : u'Repository is being updated.'
+      }), 503
+    return jsonify({
+      'succeed' : False,
+      'trace'   : traceback.format_exc()
+    }), 500
+  except:
+    return jsonify({
+      'succeed' : False,
+      'trace'   : traceback.format_exc()
+    }), 500
+  finally:
+    if handle is not None:
+      repos.release(project)
+      handle = None
+    if fd is not None:
+      fcntl.flock(fd, fcntl.LOCK_UN)  # UNLOCK!
+      fd.close()
+      fd = None
+
+@api.route('/p/<project>/c/<commitid>/files', methods = ['GET'])
+def diff_files(project, commitid):
+  """
+  diff_files() - List changed files of the commit with number of added and deleted lines.
+    project : project name
+    commitid: commitid
+  """
+  return with_commit(project, commitid, lambda commit: jsonify({
+    'succeed' : True,
+    'files'   : pgmaster_utils.load_diffs(commit, current_app.config['DIFF_CACHE'], lazy = True)[0]
+  }), etag = u'files:%s' % (commitid))
+
+@api.route('/p/<project>/c/<commitid>/files/<int:index>', methods = ['GET'])
+def diff_file(project, commitid, index):
+  """
+  diff_file() - Get patch of one file of the commit.
+    project : project name
+    commitid: commitid
+    index   : index of the file in diff_files()
+  Patch larger than MaxPatchSize is truncated, and patch of binary file is not returned.
+  """
+  def make_patch_response(commit):
+    # List of files is cached, not to list them again for each file.
+    files = pgmaster_utils.load_diffs(commit, current_app.config['DIFF_CACHE'], lazy = True)[0]
+    if index < 0 or len(files) <= index:
+      raise FileNotFoundError
+
+    file = files[index]
+    if file['binary']:
+      return jsonify({
+        'succeed'   : True,
+        'file'      : file,
+        'patch'     : u'Binary file is not shown.\n',
+        'truncated' : False
+      })
+
+    max_size = current_app.config['MAX_PATCH_SIZE']
+    (patch, truncated) = pgmaster_utils.git_file_patch(commit, file, max_size)
+    if truncated:
+      patch += u'\n... (Truncated, because this patch is larger than %d bytes.)\n' % (max_size)
+    return jsonify({
+      'succeed'   : True,
+      'file'      : file,
+      'patch'     : patch,
+      'truncated' : truncated
+    })
+  # end of nested (internal) function
+
+  return with_commit(project, commitid, make_patch_response,
+    etag = u'files:%s:%d:%d' % (commitid, index, current_app.config['MAX_PATCH_SIZE']))